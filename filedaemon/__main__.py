@@ -1,15 +1,90 @@
 if __name__ == '__main__':
 
+    import os
+    import sys
     import logging
     from argparse import ArgumentParser
-    from app import create_app, setup_logging
-    from config import HOST, DEBUG
+
+    # python -m filedaemon runs from the parent directory, modules are imported from this one
+    here = os.path.dirname(os.path.abspath(__file__))
+    if here not in sys.path:
+        sys.path.insert(0, here)
 
     parser = ArgumentParser()
     parser.add_argument('-p', '--port', default=5000, type=int, help='port to listen on')
+    commands = parser.add_subparsers(dest='command')
+
+    export_parser = commands.add_parser('export', help='stream a point-in-time snapshot of the storage into an archive')
+    export_parser.add_argument('archive', help="archive path, '-' to write to stdout")
+
+    import_parser = commands.add_parser('import', help='ingest an archive made by export, stop the daemon first')
+    import_parser.add_argument('archive', help='archive path')
+    import_parser.add_argument('-w', '--workers', default=4, type=int, help='files ingested in parallel')
+    import_parser.add_argument('--trust-unnamed', action='store_true',
+                               help="import files that can't be verified instead of quarantining them")
+
+    fsck_parser = commands.add_parser('fsck', help='check names of stored files, orphans and duplicates')
+    fsck_parser.add_argument('--repair', action='store_true', help='repair what is found, stop the daemon first')
+    fsck_parser.add_argument('-w', '--workers', default=None, type=int, help='processes walking shards')
+
+    inventory_parser = commands.add_parser('inventory', help='list every stored file as JSON lines')
+    inventory_parser.add_argument('-w', '--workers', default=None, type=int, help='processes walking shards')
+
     args = parser.parse_args()
     port: int = args.port
 
+    if args.command in ('export', 'import'):
+        from storage.manager import StorageMaster
+        from storage.snapshot import export_snapshot, import_snapshot
+        from utils.progress import Progress
+
+        # export reads the storage of a running daemon, it's only claimed for import
+        if args.command == 'import':
+            StorageMaster.claim()
+        StorageMaster.load(read_only=args.command == 'export')
+
+        if args.command == 'export':
+            progress = Progress('exported')
+            if args.archive == '-':
+                export_snapshot(sys.stdout.buffer, progress=progress)
+            else:
+                with open(args.archive, 'wb') as archive:
+                    export_snapshot(archive, progress=progress)
+            progress.done()
+        else:
+            progress = Progress('imported')
+            stats = import_snapshot(args.archive, workers=args.workers, progress=progress,
+                                    trust_unnamed=args.trust_unnamed)
+            progress.done()
+            print(', '.join(f'{count} {result}' for result, count in stats.items()), file=sys.stderr)
+            sys.exit(1 if stats["corrupted"] or (stats["unverified"] and not args.trust_unnamed) else 0)
+        sys.exit(0)
+
+    if args.command in ('fsck', 'inventory'):
+        from storage.manager import StorageMaster
+        from storage.fsck import StorageCheck
+        from utils.progress import Progress
+
+        repair = args.command == 'fsck' and args.repair
+        if repair:
+            StorageMaster.claim()
+        StorageMaster.load(read_only=not repair)
+        progress = Progress('checked' if args.command == 'fsck' else 'listed')
+        check = StorageCheck(workers=args.workers, progress=progress)
+
+        if args.command == 'inventory':
+            check.inventory()
+            progress.done()
+            sys.exit(0)
+
+        stats = check.fsck(repair=args.repair)
+        progress.done()
+        print(', '.join(f'{count} {problem}' for problem, count in stats.items()), file=sys.stderr)
+        sys.exit(1 if stats["unrepaired"] else 0)
+
+    from app import create_app, setup_logging
+    from config import HOST, DEBUG
+
     setup_logging()
 
     application = create_app()
@@ -1,6 +1,7 @@
-from flask_restful import Resource, reqparse
+from flask import request
+from flask_restful import Resource, abort
 
-from typing import Tuple, Dict, Optional, Any, TypeVar
+from typing import Tuple, Dict, Optional, Any, TypeVar, Callable
 from typing_extensions import final
 from attr import dataclass
 
@@ -36,6 +37,7 @@ class Responses(object):
     """
 
     NotAllowed = "This method is not allowed. Please use {method} instead"
+    ReadOnly = {"message": "This daemon is a read-only follower", "status_code": 405}, 405
 
     Help = {"message": f"Welcome to {APP_NAME}", "status_code": 200}
 
@@ -43,7 +45,9 @@ class Responses(object):
     Response404 = {"message": "Not found", "status_code": 404}, 404
     Response413 = {"message": f"Max file size is {MAX_CONTENT_LENGTH_VERBOSE}", "status_code": 413}, 413
     Response418 = {"message": "Good try. But I'm a teapot", "status_code": 418}, 418
+    Response429 = {"message": "Too many requests. Please slow down", "status_code": 429}, 429
     Response500 = {"message": "Sorry, there had been internal error", "status_code": 500}, 500
+    Response503 = {"message": "Server is busy. Please retry later", "status_code": 503}, 503
 
     @staticmethod
     def Build(status_code: int = 200, **kw) -> StandartResponse:
@@ -59,6 +63,62 @@ class Responses(object):
         return {**kw, "status_code": status_code}, status_code
 
 
+def _json_source(r) -> Optional[Dict]:
+    # request.json raises 415 on non-json bodies,
+    # so we only look into bodies declared as json
+    if not r.is_json:
+        return None
+    body = r.get_json(silent=True)
+    return body if isinstance(body, dict) else None
+
+
+# Every location a Parameter can be looked up in.
+# Looking into 'form' or 'files' forces werkzeug to parse the whole
+# multipart body, so they should go after the cheap ones
+ParameterSources: Dict[str, Callable] = {
+    'view_args': lambda r: r.view_args,
+    'args': lambda r: r.args,
+    'headers': lambda r: r.headers,
+    'json': _json_source,
+    'form': lambda r: r.form,
+    'files': lambda r: r.files,
+}
+
+
+@final
+@dataclass(frozen=True, slots=True)
+class Parameter(object):
+    """
+    Declarative description of a request parameter.
+    Resources list them in Parameters and BaseRequest compiles
+    them once when the resource class is defined.
+    """
+
+    name: str
+    type: Callable = str
+    location: Tuple[str, ...] = ('view_args', 'args', 'json', 'form')
+    required: bool = False
+
+    def compile(self) -> Tuple['Parameter', Tuple[Callable, ...]]:
+        """Resolve locations to their getters
+
+        Raises:
+            ValueError: If one of the locations is unknown
+        """
+        try:
+            return self, tuple(ParameterSources[location] for location in self.location)
+        except KeyError as e:
+            raise ValueError(f"Unknown location {e} of parameter '{self.name}'") from None
+
+    def convert(self, value: Any) -> Any:
+        if value is None or (isinstance(self.type, type) and isinstance(value, self.type)):
+            return value
+        try:
+            return self.type(value)
+        except (TypeError, ValueError):
+            abort(400, message=f"Invalid value of '{self.name}' parameter", status_code=400)
+
+
 class BaseRequest(Resource):
     """
     Base Resource class
@@ -70,25 +130,55 @@ class BaseRequest(Resource):
     # not overwritten in child class
     AllowedMethod: str
 
+    # Parameters the resource reads from the request
+    Parameters: Tuple[Parameter, ...] = ()
 
-    def GetParameter(self, parameter_name: str, required: Optional[bool] = False, **kw: Any) -> Any:
-        """Lightweight interface to get parameter from json body
+    # Compiled Parameters of the class and all its parents
+    _schema: Dict[str, Tuple[Parameter, Tuple[Callable, ...]]] = {}
+
+    def __init_subclass__(cls, **kw: Any) -> None:
+        super().__init_subclass__(**kw)
+        cls._schema = {**cls._schema, **dict((p.name, p.compile()) for p in cls.Parameters)}
+
+    def __init__(self, *args: Any, **kw: Any) -> None:
+        super().__init__(*args, **kw)
+        self._parsed: Dict[str, Any] = {}
+
+    def GetParameter(self, parameter_name: str) -> Any:
+        """Lazily get a declared parameter of the request
+
+        Locations of the parameter are looked up in order
+        and the search stops at the first one that has it,
+        so the request body is only parsed when it's needed.
+        Parsed values are cached for the lifetime of the resource.
 
         Args:
-            parameter_name (str): parameter from json body of the request
-            required (Optional[bool]): . Defaults to False.
-                We prefer to set parameters as non-required
-                to be able to overwrite default missing json-body parameter
-                Flask response which missed the status_code filed
-            **kw (Any): Any settings to be passed in reqparse.RequestParser().add_argument()
+            parameter_name (str): name of a parameter listed in cls.Parameters
 
         Returns:
-            type: parameter from json body of the request
+            type: converted parameter or None if it's missing
+
+        Raises:
+            KeyError: If parameter was not declared in cls.Parameters
         """
-        parser = reqparse.RequestParser()
-        parser.add_argument(parameter_name, **kw, required=required)
-        args = parser.parse_args()
-        return args[parameter_name]
+        try:
+            return self._parsed[parameter_name]
+        except KeyError:
+            pass
+
+        parameter, sources = self._schema[parameter_name]
+        value = None
+        for source in sources:
+            values = source(request)
+            if values and parameter_name in values:
+                value = values[parameter_name]
+                break
+
+        if value is None and parameter.required:
+            abort(400, message=f"Missing required parameter '{parameter_name}'", status_code=400)
+
+        value = self._parsed[parameter_name] = parameter.convert(value)
+        return value
 
     def NotAllowed(self) -> StandartResponse:
         return Responses.Build(message=Responses.NotAllowed.format(method=self.AllowedMethod), status_code=405)
@@ -0,0 +1,97 @@
+import time
+import random
+import logging
+
+from typing import Any, Callable, Dict, Iterable, Iterator
+
+from flask import request
+
+from .throttling import client_key
+
+
+ACCESS_ENVIRON = 'filedaemon.access'
+
+
+def annotate(**fields: Any) -> None:
+    """
+    Add fields to the access log record of the current request
+    """
+
+    request.environ.setdefault(ACCESS_ENVIRON, {}).update(fields)
+
+
+class _LoggedResponse(object):
+    """
+    WSGI response iterable that logs the request once it's sent
+    """
+
+    def __init__(self, response: Iterable[bytes], finish: Callable[[int], None]):
+        self._response = response
+        self._finish = finish
+        self._sent = 0
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._response:
+            self._sent += len(chunk)
+            yield chunk
+
+    def close(self) -> None:
+        try:
+            if hasattr(self._response, 'close'):
+                self._response.close()
+        finally:
+            self._finish(self._sent)
+
+
+class AccessLog(object):
+    """
+    WSGI middleware writing one structured record per request.
+
+    Successful requests are sampled with sample_rate,
+    requests that failed are always logged
+    """
+
+    def __init__(self, wsgi_app: Callable, logger: logging.Logger, sample_rate: float = 1.0):
+        self.wsgi_app = wsgi_app
+        self.logger = logger
+        self.sample_rate = sample_rate
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+        if not self.logger.isEnabledFor(logging.INFO):
+            return self.wsgi_app(environ, start_response)
+
+        started = time.time()
+        response_headers: Dict[str, Any] = {}
+
+        def recording_start_response(status: str, headers: Any, *args: Any) -> Callable:
+            response_headers['status'] = int(status.split(' ', 1)[0])
+            response_headers['length'] = next((int(value) for name, value in headers
+                                               if name.lower() == 'content-length'), None)
+            return start_response(status, headers, *args)
+
+        def finish(sent: int) -> None:
+            status = response_headers.get('status', 500)
+            if status < 400 and self.sample_rate < 1 and random.random() >= self.sample_rate:
+                return
+            record = {
+                "time": started,
+                "method": environ.get('REQUEST_METHOD'),
+                "path": environ.get('PATH_INFO'),
+                "status": status,
+                "bytes_in": int(environ.get('CONTENT_LENGTH') or 0),
+                "bytes_out": sent if sent else response_headers.get('length') or 0,
+                "duration_ms": round((time.time() - started) * 1000, 3),
+                "client": client_key(environ),
+            }
+            record.update(environ.get(ACCESS_ENVIRON, {}))
+            self.logger.log(logging.ERROR if status >= 500 else logging.INFO, '', extra={"access": record})
+
+        response = self.wsgi_app(environ, recording_start_response)
+
+        # keep sendfile of file wrappers, the length is known from the headers
+        file_wrapper = environ.get('wsgi.file_wrapper')
+        if isinstance(file_wrapper, type) and isinstance(response, file_wrapper):
+            finish(0)
+            return response
+
+        return _LoggedResponse(response, finish)
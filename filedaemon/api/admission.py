@@ -0,0 +1,220 @@
+import json
+import math
+import os
+import time
+import threading
+
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional, Tuple
+
+from werkzeug.wsgi import FileWrapper
+
+from .abs import Responses
+from utils.latency import DecayingAverage, write_latency
+from utils.metrics import metrics
+
+
+def directory_size(path: str) -> int:
+    total = 0
+    try:
+        with os.scandir(path) as entries:
+            for entry in entries:
+                try:
+                    if entry.is_file(follow_symlinks=False):
+                        total += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    continue
+    except FileNotFoundError:
+        pass
+    return total
+
+
+class _ReleasingResponse(object):
+    """
+    WSGI response iterable that gives back the admitted budget once it's sent
+    """
+
+    def __init__(self, response: Iterable[bytes], release: Callable[[], None]):
+        self._response = response
+        self._release = release
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._response)
+
+    def close(self) -> None:
+        try:
+            if hasattr(self._response, 'close'):
+                self._response.close()
+        finally:
+            self._release()
+
+
+class AdmissionControl(object):
+    """
+    WSGI middleware refusing uploads with 503 and Retry-After before their body
+    is read, while the daemon can't take more: too many uploads or declared bytes
+    are being received, the temp dir is full or writes to it have slowed down.
+
+    Downloads have a budget of their own, so an upload burst never takes it.
+    A limit set to 0 is disabled
+    """
+
+    # temp dir isn't walked more often than this, seconds
+    TEMP_SCAN_INTERVAL = 1.0
+    # both take a whole file on upload paths
+    UPLOAD_METHODS = frozenset(('POST', 'PUT'))
+
+    def __init__(self, wsgi_app: Callable, upload_paths: Iterable[str], download_path: str, temp_dir: str,
+                 max_uploads: int = 0, max_upload_bytes: int = 0, max_temp_bytes: int = 0,
+                 max_write_latency: float = 0, max_downloads: int = 0, retry_after: float = 1,
+                 latency: DecayingAverage = write_latency,
+                 exempt: Optional[Callable[[Dict[str, Any]], bool]] = None):
+        self.wsgi_app = wsgi_app
+        self.upload_paths = frozenset(upload_paths)
+        self.download_path = download_path
+        self.temp_dir = temp_dir
+        self.max_uploads = max_uploads
+        self.max_upload_bytes = max_upload_bytes
+        self.max_temp_bytes = max_temp_bytes
+        self.max_write_latency = max_write_latency
+        self.max_downloads = max_downloads
+        self.retry_after = retry_after
+        self.latency = latency
+        self.exempt = exempt
+
+        self.uploads = 0
+        self.upload_bytes = 0
+        self.downloads = 0
+        self._temp_bytes = 0
+        self._temp_scanned = 0.0
+        self._lock = threading.Lock()
+        self._file_wrappers: Dict[type, type] = {}
+        metrics.register('admission', self.samples)
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        yield 'admission_uploads', {}, self.uploads
+        yield 'admission_upload_bytes', {}, self.upload_bytes
+        yield 'admission_downloads', {}, self.downloads
+        yield 'admission_temp_bytes', {}, self._temp_bytes
+        yield 'admission_write_latency_seconds', {}, self.latency.value
+
+    def temp_bytes(self) -> int:
+        now = time.monotonic()
+        if now - self._temp_scanned >= self.TEMP_SCAN_INTERVAL:
+            self._temp_scanned = now
+            self._temp_bytes = directory_size(self.temp_dir)
+        return self._temp_bytes
+
+    def admit_upload(self, length: int) -> Optional[Tuple[str, float]]:
+        """
+        Take the budget of an upload of length bytes
+
+        Returns:
+            Optional[Tuple[str, float]]: why it's refused and how overloaded the daemon is, None if admitted
+        """
+
+        if self.max_write_latency:
+            latency = self.latency.value
+            if latency > self.max_write_latency:
+                return 'write_latency', latency / self.max_write_latency
+        if self.max_temp_bytes and self.temp_bytes() >= self.max_temp_bytes:
+            return 'temp_bytes', 1
+
+        with self._lock:
+            if self.max_uploads and self.uploads >= self.max_uploads:
+                return 'uploads', 1
+            # a single upload over the limit still gets in when it's alone
+            if self.max_upload_bytes and self.upload_bytes and self.upload_bytes + length > self.max_upload_bytes:
+                return 'upload_bytes', (self.upload_bytes + length) / self.max_upload_bytes
+            self.uploads += 1
+            self.upload_bytes += length
+        return None
+
+    def release_upload(self, length: int) -> None:
+        with self._lock:
+            self.uploads -= 1
+            self.upload_bytes -= length
+
+    def admit_download(self) -> bool:
+        with self._lock:
+            if self.max_downloads and self.downloads >= self.max_downloads:
+                return False
+            self.downloads += 1
+        return True
+
+    def release_download(self) -> None:
+        with self._lock:
+            self.downloads -= 1
+
+    def service_unavailable(self, start_response: Callable, pressure: float) -> Iterable[bytes]:
+        body, status_code = Responses.Response503
+        payload = json.dumps(body).encode('utf-8')
+        start_response(f'{status_code} SERVICE UNAVAILABLE', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(payload))),
+            ('Retry-After', str(max(1, math.ceil(self.retry_after * pressure)))),
+        ])
+        return [payload]
+
+    def _file_wrapper(self, environ: Dict[str, Any]) -> type:
+        """
+        Subclass of the server's file wrapper that calls its release on close,
+        so downloads keep sendfile and still give back their budget once sent
+        """
+
+        base = environ.get('wsgi.file_wrapper', FileWrapper)
+        if not isinstance(base, type):
+            return base
+        wrapper = self._file_wrappers.get(base)
+        if wrapper is None:
+            def close(instance: Any) -> None:
+                try:
+                    base.close(instance)
+                finally:
+                    release, instance.release = instance.release, None
+                    if release is not None:
+                        release()
+
+            wrapper = self._file_wrappers[base] = type(base.__name__, (base,), {"release": None, "close": close})
+        return wrapper
+
+    def _download(self, environ: Dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+        if not self.admit_download():
+            metrics.inc('admission_rejected', reason='downloads')
+            return self.service_unavailable(start_response, 1)
+
+        try:
+            wrapper = environ['wsgi.file_wrapper'] = self._file_wrapper(environ)
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.release_download()
+            raise
+
+        if isinstance(wrapper, type) and isinstance(response, wrapper):
+            response.release = self.release_download
+            return response
+        return _ReleasingResponse(response, self.release_download)
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+        path, method = environ.get('PATH_INFO', ''), environ.get('REQUEST_METHOD')
+        if self.exempt is not None and self.exempt(environ):
+            return self.wsgi_app(environ, start_response)
+
+        if method == 'GET' and path.rstrip('/') == self.download_path:
+            return self._download(environ, start_response)
+
+        if method not in self.UPLOAD_METHODS or path.rstrip('/') not in self.upload_paths:
+            return self.wsgi_app(environ, start_response)
+
+        length = int(environ.get('CONTENT_LENGTH') or 0)
+        refused = self.admit_upload(length)
+        if refused is not None:
+            reason, pressure = refused
+            metrics.inc('admission_rejected', reason=reason)
+            return self.service_unavailable(start_response, pressure)
+
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            self.release_upload(length)
+            raise
+        return _ReleasingResponse(response, lambda: self.release_upload(length))
@@ -1,53 +1,255 @@
+import io
 import os
+import time
 
-from flask import send_from_directory
-from flask_restful import reqparse
+from typing import Any, List, Optional
+
+from flask import Response, request, send_file
 from werkzeug.datastructures import FileStorage
-from werkzeug import exceptions
 
-from .abs import BaseRequest, Responses, StandartResponse, ResponseBuilder
-from storage.manager import StorageMaster, EmptyFileException
+from .abs import BaseRequest, Parameter, Responses, StandartResponse, ResponseBuilder
+from .accesslog import annotate
+from .throttling import client_tenant
+from storage.manager import StorageMaster, EmptyFileException, QuotaExceededException, HashMismatchException
+from storage.scrubber import scrubber
+from storage.tiers import tiering
+from cluster.cluster import cluster, ANNOUNCED_HEADER, TENANT_HEADER, EXPIRES_HEADER
+from cluster.follower import follower
+from utils.delta import DeltaError, DeltaTooLargeError, DeltaStream, signature
 from utils.encryption import verify_hash
-from config import STORAGE_DIR
+from utils.iopolicy import StreamingReader
+from utils.memory import profiler
+from utils.metrics import metrics
+from config import DEFAULT_TENANT, EXPECTED_HASH_HEADER, MAX_CONTENT_LENGTH, DELTA_BLOCK_SIZE, DELTA_MIN_BLOCK_SIZE, DELTA_MAX_BLOCK_SIZE
 
 
 class UploadRequest(BaseRequest):
 
     AllowedMethod = "POST"
+    Parameters = (Parameter('file', type=FileStorage, location=('files',)), Parameter('ttl', type=int))
 
     def post(self, **kw) -> StandartResponse:
         """
         Requires:
             A file in form-data
+            Optional hash of the file in X-Expected-Hash header
+            Optional seconds the file is kept for in "ttl" field
         Returns:
             400 - file was not provided
+            400 - ttl is not a positive number
             400 - file is already on the disk
+            400 - file doesn't match the expected hash
             403 - empty file discarded
+            403 - invalid expected hash
+            405 - daemon is a read-only follower
+            413 - storage quota exceeded
             200 - eile succesfully uploaded
 
         """
 
-        file = self.GetParameter('file', type=FileStorage, location='files')
+        if follower.enabled:
+            return Responses.ReadOnly
+
+        internal = cluster.is_internal(request.headers)
+        tenant = self.Tenant()
+
+        # Refuse over-quota uploads before the body is read
+        try:
+            StorageMaster.check_quota(tenant, request.content_length or 0)
+        except QuotaExceededException as e:
+            return ResponseBuilder()(message=e.message, status_code=413)
+
+        # Re-uploads of stored files are answered before the body is read
+        expected_hash = request.headers.get(EXPECTED_HASH_HEADER)
+        if expected_hash is not None:
+            if not verify_hash(expected_hash):
+                return Responses.Response403
+            if StorageMaster.exists(expected_hash):
+                metrics.inc('uploads_skipped_duplicate')
+                return ResponseBuilder()(message="File you are trying to upload is already on the disk",
+                                         hash=expected_hash, status_code=400)
+
+        # ttl may be a form field, looking it up reads the body
+        ttl = self.GetParameter('ttl')
+        if ttl is not None and ttl <= 0:
+            return ResponseBuilder()(message="Time to live should be a positive number of seconds", status_code=400)
+        if internal:
+            expires = float(request.headers.get(EXPIRES_HEADER, 0))
+        else:
+            expires = time.time() + ttl if ttl else 0
+
+        file = self.ReceiveFile()
 
         if not file:
             return ResponseBuilder()(message="Please provide file to upload in a form-data with a key 'file'", status_code=400)
 
         try:
-            hash_string = StorageMaster.save(file)
+            hash_string = StorageMaster.save(file, tenant=tenant, expected_hash=expected_hash, expires=expires)
         except FileExistsError:
             return ResponseBuilder()(message="File you are trying to upload is already on the disk", status_code=400)
         except EmptyFileException:
             return ResponseBuilder()(message="Empty file discarded", status_code=403)
+        except QuotaExceededException as e:
+            return ResponseBuilder()(message=e.message, status_code=413)
+        except HashMismatchException as e:
+            return ResponseBuilder()(message=e.message, status_code=400)
+
+        annotate(hash=hash_string)
+
+        if cluster.enabled and not internal and not cluster.place(hash_string):
+            return ResponseBuilder()(message="File you are trying to upload is already on the disk", status_code=400)
 
-        return ResponseBuilder()(message="File succesfully uploaded", hash=hash_string, status_code=200)
+        extra = {"expires": expires} if expires else {}
+        return ResponseBuilder()(message="File succesfully uploaded", hash=hash_string, status_code=200, **extra)
 
     def put(self, **kw) -> StandartResponse:
         return self.post()
 
+    def ReceiveFile(self) -> Optional[FileStorage]:
+        return self.GetParameter('file')
+
+    def Tenant(self) -> str:
+        """
+        Owner of the upload, daemons of the cluster pass the one of the original upload
+        """
+
+        if cluster.is_internal(request.headers):
+            return request.headers.get(TENANT_HEADER, DEFAULT_TENANT)
+        return client_tenant(request.environ)
+
+
+class SignatureRequest(BaseRequest):
+
+    AllowedMethod = "GET"
+    Parameters = (Parameter('hash'), Parameter('block_size', type=int))
+
+    def get(self, **kw) -> StandartResponse:
+        """
+        Requires:
+            A hash in "hash" field
+            Optional size of blocks in "block_size" field
+        Returns:
+            400 - hash was not provided
+            400 - block size is out of range
+            403 - invalid hash
+            404 - file was not found
+            200 - (weak, strong) checksums of every block in "blocks" field
+                  and size of the file in "size" field
+
+        """
+
+        hash_string = self.GetParameter('hash')
+        block_size = self.GetParameter('block_size') or DELTA_BLOCK_SIZE
+
+        if not hash_string:
+            return ResponseBuilder()(message="Wrong usage. Please provide file hash to sign it", status_code=400)
+
+        if not verify_hash(hash_string):
+            return Responses.Response403
+
+        if not DELTA_MIN_BLOCK_SIZE <= block_size <= DELTA_MAX_BLOCK_SIZE:
+            return ResponseBuilder()(message=f"Block size should be between {DELTA_MIN_BLOCK_SIZE} "
+                                             f"and {DELTA_MAX_BLOCK_SIZE} bytes", status_code=400)
+
+        annotate(hash=hash_string)
+        found_file = StorageMaster.get(hash_string)
+        if found_file:
+            try:
+                with StorageMaster.open(found_file) as f:
+                    blocks = signature(f, block_size)
+                    size = f.tell()
+            except FileNotFoundError:
+                # deleted since it was found
+                found_file = None
+
+        if not found_file:
+            return ResponseBuilder()(message="Sorry, hash not found on the server", status_code=404)
+
+        return ResponseBuilder()(message="Signature of the file", hash=hash_string, size=size,
+                                 block_size=block_size, blocks=blocks, status_code=200)
+
+
+class DeltaUploadRequest(UploadRequest):
+    """
+    Upload of a new file as a delta against a stored one,
+    the file is rebuilt while it's hashed and stored as any other upload
+    """
+
+    AllowedMethod = "POST"
+    Parameters = (Parameter('base'), Parameter('name'))
+
+    def post(self, **kw) -> StandartResponse:
+        """
+        Requires:
+            Hash of the stored file the delta is made against in "base" field
+            Name of the new file in "name" field
+            A delta made with the signature of the base as the request body
+            Optional hash of the new file in X-Expected-Hash header
+            Optional seconds the file is kept for in "ttl" field
+        Returns:
+            400 - base or name was not provided
+            400 - delta is malformed
+            403 - invalid base hash
+            404 - base was not found
+            413 - delta makes a file over the quota or MAX_CONTENT_LENGTH
+            and every response of an upload
+
+        """
+
+        base, name = self.GetParameter('base'), self.GetParameter('name')
+
+        if not base or not name:
+            return ResponseBuilder()(message="Wrong usage. Please provide hash of the base file "
+                                             "and name of the new one", status_code=400)
+
+        if not verify_hash(base):
+            return Responses.Response403
+
+        annotate(base=base)
+        found_file = StorageMaster.get(base)
+        try:
+            base_file = StorageMaster.open(found_file) if found_file else None
+        except FileNotFoundError:
+            base_file = None
+        if base_file is None:
+            return ResponseBuilder()(message="Sorry, base hash not found on the server", status_code=404)
+
+        with base_file:
+            # packed files are read in memory, stored ones are read with preadv
+            if isinstance(base_file, io.BytesIO):
+                source = base_file.getbuffer()
+                size = len(source)
+            else:
+                source, size = base_file.fileno(), os.fstat(base_file.fileno()).st_size
+            # the body is small, what it makes is checked against the quota and the size limit
+            left = StorageMaster.quota_left(self.Tenant())
+            max_size = MAX_CONTENT_LENGTH if left is None else min(left, MAX_CONTENT_LENGTH)
+            self._delta = DeltaStream(request.stream, source, size, max_size=max_size)
+            try:
+                response = super().post()
+            except DeltaTooLargeError as e:
+                return ResponseBuilder()(message=e.message, status_code=413)
+            except DeltaError as e:
+                return ResponseBuilder()(message=e.message, status_code=400)
+            finally:
+                if isinstance(source, memoryview):
+                    source.release()
+
+        metrics.inc('delta_bytes_copied', self._delta.copied_bytes)
+        metrics.inc('delta_bytes_literal', self._delta.literal_bytes)
+        return response
+
+    def put(self, **kw) -> StandartResponse:
+        return self.post()
+
+    def ReceiveFile(self) -> Optional[FileStorage]:
+        return FileStorage(io.BufferedReader(self._delta), filename=self.GetParameter('name'))
+
 
 class DownloadRequest(BaseRequest):
 
     AllowedMethod = "GET"
+    Parameters = (Parameter('hash'),)
 
     def get(self, **kw) -> StandartResponse:
         """
@@ -57,13 +259,14 @@ class DownloadRequest(BaseRequest):
             400 - hash was not provided
             403 - invalid hash
             404 - file was not found
-            500 - file was found but can't be sent
+            206 - part of the file asked for with Range
+            416 - range is outside of the file
 
             file as as attachment if it's found
 
         """
 
-        hash_string = kw.get('hash') or self.GetParameter('hash', type=str)
+        hash_string = self.GetParameter('hash')
 
         if not hash_string:
             return ResponseBuilder()(message="Wrong usage. Please provide file hash to download it", status_code=400)
@@ -71,19 +274,111 @@ class DownloadRequest(BaseRequest):
         if not verify_hash(hash_string):
             return Responses.Response403
 
+        annotate(hash=hash_string)
         found_file = StorageMaster.get(hash_string)
         if found_file:
+            tiering.hit(hash_string)
 
+        if found_file and hash_string in StorageMaster.packs:
             try:
-                return send_from_directory(os.path.join(STORAGE_DIR, found_file[:2]), found_file, as_attachment=True)
-            except exceptions.NotFound:
-                # handle not found exception as internal
-                # because if everything works just fine
-                # this should not happen ever
-                return Responses.Response500
+                return send_file(StorageMaster.open(found_file), download_name=found_file, as_attachment=True)
+            except FileNotFoundError:
+                # deleted since it was found
+                found_file = None
+
+        if found_file:
+            try:
+                # large files are streamed around the page cache
+                f = StreamingReader(StorageMaster.path(found_file))
+            except FileNotFoundError:
+                # deleted since it was found
+                f = None
+            if f is not None:
+                response = send_file(f, download_name=found_file, as_attachment=True, etag=hash_string,
+                                     last_modified=os.fstat(f.fileno()).st_mtime, conditional=False)
+                response.content_length = f.size
+                return response.make_conditional(request, accept_ranges=True, complete_length=f.size)
+
+        if cluster.enabled and not cluster.is_internal(request.headers):
+            upstream = cluster.fetch(hash_string)
+            if upstream is not None:
+                headers = dict((name, upstream.getheader(name)) for name in
+                               ('Content-Type', 'Content-Length', 'Content-Disposition') if upstream.getheader(name))
+                return Response(cluster.stream(upstream), status=200, headers=headers, direct_passthrough=True)
+
+        return ResponseBuilder()(message="Sorry, hash not found on the server", status_code=404)
+
+
+def hash_list(value: Any) -> List[str]:
+    """
+    Hashes given as a JSON list or as a comma separated string
+    """
+
+    if isinstance(value, str):
+        value = value.split(',')
+    if not isinstance(value, list) or not all(isinstance(item, str) for item in value):
+        raise ValueError(value)
+    return [item.strip() for item in value if item.strip()]
+
+
+class ExistsRequest(BaseRequest):
+
+    AllowedMethod = "GET, HEAD or POST"
+    Parameters = (Parameter('hash'), Parameter('hashes', type=hash_list))
+
+    # Max number of hashes in one batch
+    BatchLimit = 10000
+
+    def get(self, **kw) -> StandartResponse:
+        """
+        Requires:
+            A hash in "hash" field
+        Returns:
+            400 - hash was not provided
+            403 - invalid hash
+            404 - file is not stored
+            200 - file is stored
+
+        """
+
+        hash_string = self.GetParameter('hash')
+
+        if not hash_string:
+            return ResponseBuilder()(message="Wrong usage. Please provide file hash to check it", status_code=400)
+
+        if not verify_hash(hash_string):
+            return Responses.Response403
+
+        annotate(hash=hash_string)
+        if StorageMaster.exists(hash_string):
+            return ResponseBuilder()(message="File exists", status_code=200)
 
         return ResponseBuilder()(message="Sorry, hash not found on the server", status_code=404)
 
+    def post(self, **kw) -> StandartResponse:
+        """
+        Requires:
+            A list of hashes in "hashes" field
+        Returns:
+            400 - hashes were not provided or there are too many of them
+            200 - stored hashes in "found" and the rest in "missing"
+
+        """
+
+        hashes = self.GetParameter('hashes')
+
+        if not hashes:
+            return self.get() if self.GetParameter('hash') else \
+                ResponseBuilder()(message="Wrong usage. Please provide a list of hashes to check", status_code=400)
+
+        if len(hashes) > self.BatchLimit:
+            return ResponseBuilder()(message=f"Sorry, no more than {self.BatchLimit} hashes at once", status_code=400)
+
+        found = [h for h in hashes if verify_hash(h) and StorageMaster.exists(h)]
+        found_set = set(found)
+        missing = [h for h in hashes if h not in found_set]
+        return ResponseBuilder()(message="Existence of hashes", found=found, missing=missing, status_code=200)
+
 
 class TeaPotRequest(BaseRequest):
 
@@ -96,6 +391,7 @@ class TeaPotRequest(BaseRequest):
 class DeleteRequest(BaseRequest):
 
     AllowedMethod = "GET, POST or DELETE"
+    Parameters = (Parameter('hash'),)
 
     def get(self, **kw) -> StandartResponse:
         """
@@ -106,24 +402,36 @@ class DeleteRequest(BaseRequest):
             403 - invalid hash
             404 - file was not found
             200 - file was deleted
+            405 - daemon is a read-only follower
             500 - PermissonError (only happens when running on windows)
 
         """
 
-        hash_string = self.GetParameter('hash', type=str)
+        if follower.enabled:
+            return Responses.ReadOnly
+
+        hash_string = self.GetParameter('hash')
         if not hash_string:
             return ResponseBuilder()(message="Wrong usage. Please provide file hash to delete it", status_code=400)
 
         if not verify_hash(hash_string):
             return Responses.Response403
 
+        annotate(hash=hash_string)
         found_file = StorageMaster.get(hash_string)
+        deleted = False
 
         if found_file:
             try:
                 StorageMaster.delete(found_file)
             except PermissionError:
                 return ResponseBuilder()(message="Sorry, cannot delete the file now. Somebody is still connected to it", status_code=500)
+            deleted = True
+
+        if cluster.enabled and not cluster.is_internal(request.headers):
+            deleted = cluster.delete(hash_string) or deleted
+
+        if deleted:
             return ResponseBuilder()(message="File was deleted", status_code=200)
 
         return ResponseBuilder()(message="Sorry, hash not found on the server", status_code=404)
@@ -135,6 +443,150 @@ class DeleteRequest(BaseRequest):
         return self.get()
 
 
+class MetricsRequest(BaseRequest):
+
+    AllowedMethod = "GET"
+
+    def get(self, **kw) -> StandartResponse:
+        """
+        Returns:
+            200 - every counter and gauge of the daemon
+        """
+
+        return ResponseBuilder()(message="Metrics", metrics=metrics.snapshot(), status_code=200)
+
+
+class ScrubRequest(BaseRequest):
+
+    AllowedMethod = "GET"
+
+    def get(self, **kw) -> StandartResponse:
+        """
+        Returns:
+            200 - progress and results of the integrity scrubber
+        """
+
+        return ResponseBuilder()(message="Scrubber status", scrubber=dict(scrubber.status), status_code=200)
+
+
+class TiersRequest(BaseRequest):
+
+    AllowedMethod = "GET"
+
+    def get(self, **kw) -> StandartResponse:
+        """
+        Returns:
+            200 - how files are placed in storage tiers and bytes downloaded lately
+        """
+
+        return ResponseBuilder()(message="Storage tiers", tiers=tiering.placement, mover=dict(tiering.status),
+                                 working_set_bytes=tiering.working_set(), status_code=200)
+
+
+class MemoryRequest(BaseRequest):
+
+    AllowedMethod = "GET"
+    Parameters = (Parameter('limit', type=int), Parameter('group'), Parameter('compare'))
+
+    def get(self, **kw) -> StandartResponse:
+        """
+        Requires:
+            Optional number of sites in "limit" field, "group" field with
+            lineno, filename or traceback and "compare" field to get sites
+            that grew most since the previous compared request
+            CLUSTER_SECRET in the replica header
+        Returns:
+            200 - RSS, open files and top allocation sites when tracing is on
+            400 - unknown group
+            403 - request without the secret
+        """
+
+        # snapshots of traced allocations are expensive and show the source
+        if not cluster.authenticates(request.headers):
+            return ResponseBuilder()(message="Memory is only shown with the secret", status_code=403)
+
+        limit = max(min(self.GetParameter('limit') or 20, 1000), 1)
+        compare = (self.GetParameter('compare') or '').lower() in ('1', 'true', 'yes')
+        try:
+            sites = profiler.top(limit, self.GetParameter('group') or 'lineno', compare)
+        except ValueError as e:
+            return ResponseBuilder()(message=str(e), status_code=400)
+        return ResponseBuilder()(message="Memory", memory=profiler.status, top=sites, status_code=200)
+
+
+class OplogRequest(BaseRequest):
+
+    AllowedMethod = "GET"
+    Parameters = (Parameter('since', type=int), Parameter('limit', type=int))
+
+    def get(self, **kw) -> StandartResponse:
+        """
+        Requires:
+            CLUSTER_SECRET in the replica header,
+            optional sequence number in "since" field
+            and max number of operations in "limit" field
+        Returns:
+            200 - saves and deletes following the since sequence number
+            403 - request without the secret
+        """
+
+        # hashes in the log are all it takes to download or delete a file
+        if not cluster.authenticates(request.headers):
+            return ResponseBuilder()(message="Operation log is only served to followers", status_code=403)
+
+        since = self.GetParameter('since') or 0
+        limit = min(self.GetParameter('limit') or 1000, 10000)
+        entries = StorageMaster.oplog.read(since, limit)
+        return ResponseBuilder()(message="Operation log", entries=entries, first_seq=StorageMaster.oplog.first_seq,
+                                 last_seq=StorageMaster.oplog.last_seq, status_code=200)
+
+
+class ClusterRequest(BaseRequest):
+
+    AllowedMethod = "GET or POST"
+    Parameters = (Parameter('join'), Parameter('leave'))
+
+    def get(self, **kw) -> StandartResponse:
+        """
+        Returns:
+            200 - members of the cluster
+        """
+
+        return ResponseBuilder()(message="Cluster status", cluster=cluster.status(),
+                                 follower=follower.status() if follower.enabled else None, status_code=200)
+
+    def post(self, **kw) -> StandartResponse:
+        """
+        Requires:
+            Base URL of a daemon in "join" or "leave" field
+            CLUSTER_SECRET in the replica header
+        Returns:
+            400 - neither was provided, or this daemon can't join a cluster
+            403 - request without the secret
+            200 - members of the cluster
+        """
+
+        if not cluster.authenticates(request.headers):
+            return ResponseBuilder()(message="Cluster is only changed with the secret", status_code=403)
+
+        join, leave = self.GetParameter('join'), self.GetParameter('leave')
+        if not join and not leave:
+            return ResponseBuilder()(message="Wrong usage. Please provide daemon URL to join or leave", status_code=400)
+
+        try:
+            if join:
+                cluster.join(join)
+        except ValueError as e:
+            return ResponseBuilder()(message=str(e), status_code=400)
+        if leave:
+            cluster.leave(leave)
+
+        if ANNOUNCED_HEADER not in request.headers:
+            cluster.announce(**dict((k, v) for k, v in (('join', join), ('leave', leave)) if v))
+
+        return self.get()
+
+
 class DefaultRequest(BaseRequest):
 
     AllowedMethod = "GET"
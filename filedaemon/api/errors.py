@@ -1,8 +1,9 @@
-import traceback
+import logging
 
 from werkzeug.exceptions import HTTPException
 
 from .abs import Responses
+from .accesslog import annotate
 
 
 def not_found(error):
@@ -24,9 +25,9 @@ def default_error_handler(error):
 
     # code = 500
 
-    print(traceback.format_exc())
-
     if isinstance(error, HTTPException):
         return Responses.Build(message=str(error), status_code=error.code)
 
+    annotate(error=repr(error))
+    logging.getLogger('file').exception('Unhandled error')
     return Responses.Response500
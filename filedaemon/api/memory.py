@@ -0,0 +1,58 @@
+from typing import Any, Callable, Dict, Iterable, Iterator
+
+from .accesslog import ACCESS_ENVIRON
+from utils.memory import MemoryProfiler, profiler as default_profiler
+
+
+class _MeasuredResponse(object):
+    """
+    WSGI response iterable that ends the measurement once it's sent.
+    Sampled downloads lose sendfile, the file is read while it's measured
+    """
+
+    def __init__(self, response: Iterable[bytes], finish: Callable[[], None]):
+        self._response = response
+        self._finish = finish
+
+    def __iter__(self) -> Iterator[bytes]:
+        return iter(self._response)
+
+    def close(self) -> None:
+        try:
+            if hasattr(self._response, 'close'):
+                self._response.close()
+        finally:
+            self._finish()
+
+
+class PeakAllocation(object):
+    """
+    WSGI middleware measuring the peak allocation of sampled requests to paths,
+    from the start of the request until its response is sent.
+    The peak is counted in metrics and written to the access log
+    """
+
+    def __init__(self, wsgi_app: Callable, paths: Iterable[str], profiler: MemoryProfiler = default_profiler):
+        self.wsgi_app = wsgi_app
+        self.paths = frozenset(paths)
+        self.profiler = profiler
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+        path = environ.get('PATH_INFO', '').rstrip('/')
+        if path not in self.paths:
+            return self.wsgi_app(environ, start_response)
+
+        started = self.profiler.begin()
+        if started is None:
+            return self.wsgi_app(environ, start_response)
+
+        def finish() -> None:
+            peak = self.profiler.end(started, path)
+            environ.setdefault(ACCESS_ENVIRON, {})["alloc_peak_bytes"] = peak
+
+        try:
+            response = self.wsgi_app(environ, start_response)
+        except BaseException:
+            finish()
+            raise
+        return _MeasuredResponse(response, finish)
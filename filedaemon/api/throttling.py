@@ -0,0 +1,192 @@
+import json
+import time
+import threading
+from collections import OrderedDict
+
+from typing import Any, Callable, Dict, Iterable, Iterator, Optional
+
+from .abs import Responses
+from utils.encryption import encrypt_string
+from utils.metrics import metrics
+from utils.ratelimit import TokenBucket
+from config import API_KEY_HEADER, API_KEYS, DEFAULT_TENANT
+
+
+def client_key(environ: Dict[str, Any]) -> str:
+    """
+    Identify the client of a WSGI request.
+    Only keys listed in API_KEYS are trusted, a random key per request
+    would get a fresh budget otherwise. Keys are hashed so they never show up in counters
+    """
+
+    api_key = environ.get('HTTP_' + API_KEY_HEADER.upper().replace('-', '_'))
+    if api_key and api_key in API_KEYS:
+        return 'key:' + encrypt_string(api_key)[:16]
+    return 'ip:' + environ.get('REMOTE_ADDR', 'unknown')
+
+
+def client_tenant(environ: Dict[str, Any]) -> str:
+    """
+    Tenant owning files uploaded by the client.
+    Clients without a known API key share the default tenant
+    """
+
+    key = client_key(environ)
+    return key if key.startswith('key:') else DEFAULT_TENANT
+
+
+class ThrottledStream(object):
+    """
+    wsgi.input wrapper that pays for every chunk read from the client
+    """
+
+    def __init__(self, stream: Any, bucket: TokenBucket, client: str):
+        self._stream = stream
+        self._bucket = bucket
+        self._client = client
+
+    def _account(self, size: int) -> None:
+        if size:
+            metrics.inc('client_bytes_in', size, client=self._client)
+            delay = self._bucket.consume(size)
+            if delay:
+                time.sleep(delay)
+
+    def read(self, *args: Any) -> bytes:
+        data = self._stream.read(*args)
+        self._account(len(data))
+        return data
+
+    def readline(self, *args: Any) -> bytes:
+        data = self._stream.readline(*args)
+        self._account(len(data))
+        return data
+
+    def readinto(self, buffer: Any) -> int:
+        size = self._stream.readinto(buffer)
+        self._account(size or 0)
+        return size
+
+    def __iter__(self) -> Iterator[bytes]:
+        while True:
+            line = self.readline()
+            if not line:
+                return
+            yield line
+
+    def __getattr__(self, name: str) -> Any:
+        return getattr(self._stream, name)
+
+
+class ThrottledResponse(object):
+    """
+    WSGI response iterable that pays for every chunk sent to the client
+    """
+
+    def __init__(self, response: Iterable[bytes], bucket: TokenBucket, client: str):
+        self._response = response
+        self._bucket = bucket
+        self._client = client
+
+    def __iter__(self) -> Iterator[bytes]:
+        for chunk in self._response:
+            if chunk:
+                metrics.inc('client_bytes_out', len(chunk), client=self._client)
+                delay = self._bucket.consume(len(chunk))
+                if delay:
+                    time.sleep(delay)
+            yield chunk
+
+    def close(self) -> None:
+        if hasattr(self._response, 'close'):
+            self._response.close()
+
+
+class _Client(object):
+
+    __slots__ = ('requests', 'bandwidth')
+
+    def __init__(self, requests: Optional[TokenBucket], bandwidth: Optional[TokenBucket]):
+        self.requests = requests
+        self.bandwidth = bandwidth
+
+
+class ClientThrottle(object):
+    """
+    WSGI middleware limiting requests per second and bytes per second
+    of every client. Request bodies and responses are shaped chunk by chunk,
+    so large transfers are slowed down instead of being refused.
+
+    A limit set to 0 is disabled
+    """
+
+    def __init__(self, wsgi_app: Callable, requests_per_second: float = 0, burst: float = 0,
+                 bytes_per_second: float = 0, bytes_burst: float = 0, max_clients: int = 10000,
+                 exempt: Optional[Callable[[Dict[str, Any]], bool]] = None):
+        self.wsgi_app = wsgi_app
+        self.exempt = exempt
+        self.requests_per_second = requests_per_second
+        self.burst = burst
+        self.bytes_per_second = bytes_per_second
+        self.bytes_burst = bytes_burst
+        self.max_clients = max_clients
+        self._clients: 'OrderedDict[str, _Client]' = OrderedDict()
+        self._lock = threading.Lock()
+
+    def client(self, key: str) -> _Client:
+        with self._lock:
+            try:
+                self._clients.move_to_end(key)
+                return self._clients[key]
+            except KeyError:
+                pass
+
+            client = self._clients[key] = _Client(
+                TokenBucket(self.requests_per_second, self.burst) if self.requests_per_second else None,
+                TokenBucket(self.bytes_per_second, self.bytes_burst) if self.bytes_per_second else None,
+            )
+            if len(self._clients) > self.max_clients:
+                forgotten, _ = self._clients.popitem(last=False)
+                metrics.forget(client=forgotten)
+            return client
+
+    @staticmethod
+    def too_many_requests(start_response: Callable, retry_after: float) -> Iterable[bytes]:
+        body, status_code = Responses.Response429
+        payload = json.dumps(body).encode('utf-8')
+        start_response(f'{status_code} TOO MANY REQUESTS', [
+            ('Content-Type', 'application/json'),
+            ('Content-Length', str(len(payload))),
+            ('Retry-After', str(max(1, int(retry_after + 0.999)))),
+        ])
+        return [payload]
+
+    def __call__(self, environ: Dict[str, Any], start_response: Callable) -> Iterable[bytes]:
+        if self.exempt is not None and self.exempt(environ):
+            return self.wsgi_app(environ, start_response)
+
+        key = client_key(environ)
+        client = self.client(key)
+
+        if client.requests is not None and not client.requests.try_consume():
+            metrics.inc('client_requests_rejected', client=key)
+            return self.too_many_requests(start_response, client.requests.retry_after())
+
+        metrics.inc('client_requests', client=key)
+
+        if client.bandwidth is None:
+            # Nothing to shape, keep wsgi.file_wrapper and sendfile intact
+            # and only count declared lengths
+            metrics.inc('client_bytes_in', int(environ.get('CONTENT_LENGTH') or 0), client=key)
+
+            def counting_start_response(status: str, headers: Any, *args: Any) -> Callable:
+                for name, value in headers:
+                    if name.lower() == 'content-length':
+                        metrics.inc('client_bytes_out', int(value), client=key)
+                return start_response(status, headers, *args)
+
+            return self.wsgi_app(environ, counting_start_response)
+
+        environ['wsgi.input'] = ThrottledStream(environ['wsgi.input'], client.bandwidth, key)
+        environ.pop('wsgi.file_wrapper', None)
+        return ThrottledResponse(self.wsgi_app(environ, start_response), client.bandwidth, key)
@@ -1,14 +1,36 @@
 import logging
 import os
 
+from typing import BinaryIO, Optional
+
 import flask as fl
 from flask_restful import Api
+from werkzeug.datastructures import EnvironHeaders
 
 
 from api.api import (UploadRequest, DownloadRequest,
-                     DeleteRequest, TeaPotRequest, DefaultRequest)
+                     DeleteRequest, TeaPotRequest, DefaultRequest, MetricsRequest, ScrubRequest,
+                     ClusterRequest, OplogRequest, ExistsRequest, TiersRequest,
+                     SignatureRequest, DeltaUploadRequest, MemoryRequest)
 from api.errors import not_found, request_entity_too_large, default_error_handler
-from config import APP_NAME, HOST, DEBUG, MAX_CONTENT_LENGTH, BASE_DIR, STORAGE_DIR, API, API_VERSION, LOG_DIR
+from api.accesslog import AccessLog, annotate
+from api.admission import AdmissionControl
+from api.memory import PeakAllocation
+from api.throttling import ClientThrottle
+from storage.manager import StorageMaster
+from storage.scrubber import scrubber
+from storage.tiers import tiering
+from storage.expiry import expirer
+from cluster.cluster import cluster
+from cluster.follower import follower
+from utils.asynclog import BatchingFileHandler
+from utils.iopolicy import spool
+from utils.memory import profiler
+from config import (APP_NAME, HOST, DEBUG, MAX_CONTENT_LENGTH, BASE_DIR, STORAGE_DIR, API, API_VERSION, LOG_DIR,
+                    RATE_LIMIT_REQUESTS, RATE_LIMIT_BURST, RATE_LIMIT_BYTES, RATE_LIMIT_BYTES_BURST,
+                    RATE_LIMIT_MAX_CLIENTS, SCRUB_INTERVAL, ACCESS_LOG_SAMPLE_RATE,
+                    ADMISSION_UPLOADS, ADMISSION_UPLOAD_BYTES, ADMISSION_TEMP_BYTES, ADMISSION_WRITE_LATENCY,
+                    ADMISSION_DOWNLOADS, ADMISSION_RETRY_AFTER)
 
 
 class Route:
@@ -19,6 +41,28 @@ class Route:
     upload = f'{API}/upload'
     download = f'{API}/download'
     delete = f'{API}/delete'
+    metrics = f'{API}/metrics'
+    scrub = f'{API}/scrub'
+    cluster = f'{API}/cluster'
+    oplog = f'{API}/oplog'
+    exists = f'{API}/exists'
+    tiers = f'{API}/tiers'
+    signature = f'{API}/signature'
+    delta = f'{API}/delta'
+    memory = f'{API}/memory'
+
+
+class SpoolingRequest(fl.Request):
+    """
+    Request parsing large uploads into the temp dir around the page cache
+    """
+
+    def _get_file_stream(self, total_content_length: Optional[int], content_type: Optional[str],
+                         filename: Optional[str] = None, content_length: Optional[int] = None) -> BinaryIO:
+        stream = spool(StorageMaster.TEMP, total_content_length or 0)
+        if stream is None:
+            return super()._get_file_stream(total_content_length, content_type, filename, content_length)
+        return stream
 
 
 def create_app() -> fl.app.Flask:
@@ -28,6 +72,7 @@ def create_app() -> fl.app.Flask:
     """
 
     app = fl.Flask(__name__)
+    app.request_class = SpoolingRequest
     api = Api(app)
 
     app.config['MAX_CONTENT_LENGTH'] = MAX_CONTENT_LENGTH
@@ -38,22 +83,76 @@ def create_app() -> fl.app.Flask:
 
     app.app_context().push()
 
+    StorageMaster.setup()
+    profiler.start()
+    if SCRUB_INTERVAL:
+        scrubber.start()
+    tiering.start()
+    cluster.start()
+    follower.start()
+    # followers delete expired files after their primary does
+    if not follower.enabled:
+        expirer.start()
+
     api.add_resource(DefaultRequest, '/')
     api.add_resource(UploadRequest, Route.upload)
     api.add_resource(DownloadRequest, Route.download, f'{Route.download}/')
     api.add_resource(DeleteRequest,  Route.delete,  f'{Route.delete}/<string:hash>')
+    api.add_resource(MetricsRequest, Route.metrics)
+    api.add_resource(ScrubRequest, Route.scrub)
+    api.add_resource(ClusterRequest, Route.cluster)
+    api.add_resource(OplogRequest, Route.oplog)
+    api.add_resource(TiersRequest, Route.tiers)
+    api.add_resource(SignatureRequest, Route.signature)
+    api.add_resource(DeltaUploadRequest, Route.delta)
+    api.add_resource(MemoryRequest, Route.memory)
+    api.add_resource(ExistsRequest, Route.exists, f'{Route.exists}/<string:hash>')
     api.add_resource(TeaPotRequest, '/admin', f'{API}/admin',  f'{API}/admin/<string:anything>')
 
     app.errorhandler(404)(not_found)
     app.errorhandler(413)(request_entity_too_large)
     app.register_error_handler(Exception, default_error_handler)
 
+    @app.before_request
+    def annotate_route() -> None:
+        if fl.request.url_rule is not None:
+            annotate(route=fl.request.url_rule.rule)
+
+    app.wsgi_app = PeakAllocation(app.wsgi_app, paths=(Route.upload, Route.delta, Route.download))
+    app.wsgi_app = AdmissionControl(
+        app.wsgi_app,
+        upload_paths=(Route.upload, Route.delta),
+        download_path=Route.download,
+        temp_dir=StorageMaster.TEMP,
+        max_uploads=ADMISSION_UPLOADS,
+        max_upload_bytes=ADMISSION_UPLOAD_BYTES,
+        max_temp_bytes=ADMISSION_TEMP_BYTES,
+        max_write_latency=ADMISSION_WRITE_LATENCY,
+        max_downloads=ADMISSION_DOWNLOADS,
+        retry_after=ADMISSION_RETRY_AFTER,
+        exempt=lambda environ: cluster.is_internal(EnvironHeaders(environ)),
+    )
+    app.wsgi_app = ClientThrottle(
+        app.wsgi_app,
+        requests_per_second=RATE_LIMIT_REQUESTS,
+        burst=RATE_LIMIT_BURST,
+        bytes_per_second=RATE_LIMIT_BYTES,
+        bytes_burst=RATE_LIMIT_BYTES_BURST,
+        max_clients=RATE_LIMIT_MAX_CLIENTS,
+        # daemons of the cluster are never throttled
+        exempt=lambda environ: cluster.is_internal(EnvironHeaders(environ)),
+    )
+    # outermost, so throttled requests are logged too
+    app.wsgi_app = AccessLog(app.wsgi_app, logging.getLogger('access'), sample_rate=ACCESS_LOG_SAMPLE_RATE)
+
     return app
 
 
-def filelog_constructor(*args, **kw) -> logging.FileHandler:
+def filelog_constructor(*args, filename: str = 'std_out.log', maxBytes: int = 0, backupCount: int = 0,
+                        **kw) -> logging.Handler:
     """
-    Called from logging.yml file to set log file path
+    Called from logging.yml file to set log file path.
+    Records are written by a background thread, so logging never waits for the disk
     """
 
     import os
@@ -61,8 +160,8 @@ def filelog_constructor(*args, **kw) -> logging.FileHandler:
     if not os.path.exists(LOG_DIR):
         os.mkdir(LOG_DIR)
 
-    LOG_FILE = os.path.join(LOG_DIR, 'std_out.log')
-    return logging.FileHandler(LOG_FILE)
+    LOG_FILE = os.path.join(LOG_DIR, filename)
+    return BatchingFileHandler(LOG_FILE, maxBytes=maxBytes, backupCount=backupCount)
 
 
 def setup_logging() -> None:
@@ -0,0 +1,150 @@
+"""
+How much of a hot set of files the page cache still serves after a large transfer,
+with and without page cache policies (IO_CACHE_POLICY)
+
+    python filedaemon/benchmarks/pagecache.py --large-mb 4096
+
+The large file has to be bigger than the free memory for the cache to be under pressure,
+run it in a memory-limited container (docker run -m 1g) to see a difference with less.
+Hit rate is worked out from /proc/self/io of the daemon, shown in /api/v1/metrics
+"""
+
+import io
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+import urllib.request
+from argparse import ArgumentParser
+
+from typing import Dict
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+sys.path.append(os.path.dirname(BASE_DIR))
+
+from filedaemon.client.client import FileDaemonClient  # noqa: E402
+from utils.iopolicy import advise  # noqa: E402
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def io_counters(base_url: str) -> Dict[str, int]:
+    with urllib.request.urlopen(base_url + '/api/v1/metrics', timeout=10) as response:
+        metrics = json.loads(response.read())['metrics']
+    return dict((name[len('process_io_'):], metrics[name][0]['value'])
+                for name in metrics if name.startswith('process_io_'))
+
+
+def drop_cache(directory: str) -> None:
+    for path in [os.path.join(root, name) for root, _, files in os.walk(directory) for name in files]:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            advise(fd, 0, 0, 'POSIX_FADV_DONTNEED')
+        finally:
+            os.close(fd)
+
+
+class RandomFile(io.RawIOBase):
+    """
+    size random bytes that never touch the disk of the benchmark itself
+    """
+
+    def __init__(self, size: int):
+        super().__init__()
+        self.size = size
+        self.position = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def seekable(self) -> bool:
+        return True
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        self.position = {os.SEEK_SET: 0, os.SEEK_CUR: self.position, os.SEEK_END: self.size}[whence] + offset
+        return self.position
+
+    def tell(self) -> int:
+        return self.position
+
+    def read(self, size: int = -1) -> bytes:
+        size = self.size - self.position if size < 0 else min(size, self.size - self.position)
+        self.position += size
+        return os.urandom(size)
+
+
+def run(policy: bool, hot: int, hot_size: int, large: int, scratch: str) -> Dict[str, float]:
+    storage = tempfile.mkdtemp(prefix='filedaemon-pagecache-', dir=scratch)
+    port = free_port()
+    env = dict(os.environ, FILEDAEMON_STORAGE_DIR=storage, FILEDAEMON_IO_CACHE_POLICY=json.dumps(policy))
+    process = subprocess.Popen([sys.executable, BASE_DIR, '-p', str(port)], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    base_url = f'http://127.0.0.1:{port}'
+    try:
+        deadline = time.time() + 60
+        while True:
+            try:
+                io_counters(base_url)
+                break
+            except OSError:
+                if time.time() > deadline:
+                    raise
+                time.sleep(0.1)
+
+        with FileDaemonClient(base_url, pool_size=4) as client:
+            hashes = [client.upload(RandomFile(hot_size), f'hot-{i}.bin', skip_existing=False) for i in range(hot)]
+
+            drop_cache(storage)
+            for hash_string in hashes:
+                client.read(hash_string)
+
+            started = time.time()
+            large_hash = client.upload(RandomFile(large), 'large.bin', skip_existing=False)
+            with open(os.devnull, 'wb') as devnull:
+                client.download(large_hash, devnull)
+            transfer = time.time() - started
+
+            before = io_counters(base_url)
+            for hash_string in hashes:
+                client.read(hash_string)
+            after = io_counters(base_url)
+
+        read, from_disk = after['rchar'] - before['rchar'], after['read_bytes'] - before['read_bytes']
+        return {"hit_rate": 1 - min(from_disk, read) / read if read else 0,
+                "from_disk_mb": from_disk / 2 ** 20, "read_mb": read / 2 ** 20, "transfer_s": transfer}
+    finally:
+        process.kill()
+        process.wait()
+        shutil.rmtree(storage, ignore_errors=True)
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('--hot', default=40, type=int, help='files of the hot set')
+    parser.add_argument('--hot-mb', default=2, type=int, help='size of every hot file')
+    parser.add_argument('--large-mb', default=2048, type=int, help='size of the large file uploaded and downloaded')
+    parser.add_argument('--dir', default=None, help='scratch directory on the disk to measure')
+    args = parser.parse_args()
+
+    scratch = tempfile.mkdtemp(prefix='filedaemon-bench-', dir=args.dir)
+    try:
+        for policy in (False, True):
+            result = run(policy, args.hot, args.hot_mb * 2 ** 20, args.large_mb * 2 ** 20, scratch)
+            print(f'IO_CACHE_POLICY={policy}: hot set hit rate {result["hit_rate"]:.1%} '
+                  f'({result["from_disk_mb"]:.1f}mb of {result["read_mb"]:.1f}mb read from the disk), '
+                  f'large upload and download took {result["transfer_s"]:.2f}s')
+    finally:
+        shutil.rmtree(scratch, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
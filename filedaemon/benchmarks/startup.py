@@ -0,0 +1,102 @@
+"""
+How long a restarted daemon takes to serve requests with a large catalog
+
+    python filedaemon/benchmarks/startup.py --objects 1000000
+"""
+
+import os
+import sys
+import json
+import time
+import shutil
+import socket
+import tempfile
+import subprocess
+import urllib.request
+from argparse import ArgumentParser
+
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.append(BASE_DIR)
+
+from storage.catalog import Catalog, ObjectRecord  # noqa: E402
+from storage.oplog import OperationLog  # noqa: E402
+from utils.encryption import encrypt_string  # noqa: E402
+
+
+def fill_storage(storage: str, objects: int) -> None:
+    """
+    Catalog and operation log of a storage with objects files.
+    Files themselves are not needed to start
+    """
+
+    os.makedirs(storage, exist_ok=True)
+    catalog = Catalog(storage)
+    oplog = OperationLog(storage, fsync=False)
+    with open(oplog.path, 'w', encoding='utf-8') as f:
+        for i in range(objects):
+            record = ObjectRecord(encrypt_string(str(i)), '.bin', 8192, f'key:{i % 100:016d}', f'file{i}.bin')
+            catalog.records[record.hash] = record
+            f.write(json.dumps({"seq": i + 1, "op": "save", "time": 0, **record.dump()}) + '\n')
+    catalog.usage = {f'key:{i:016d}': 8192 * len(range(i, objects, 100)) for i in range(min(objects, 100))}
+    catalog.total = 8192 * objects
+    catalog.compact()
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def time_to_serve(storage: str, timeout: float = 120) -> float:
+    """
+    Seconds from starting `python filedaemon` to its first answer
+    """
+
+    port = free_port()
+    env = dict(os.environ, FILEDAEMON_STORAGE_DIR=storage)
+    started = time.time()
+    process = subprocess.Popen([sys.executable, BASE_DIR, '-p', str(port)], env=env,
+                               stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        while time.time() - started < timeout:
+            try:
+                with urllib.request.urlopen(f'http://127.0.0.1:{port}/', timeout=1):
+                    return time.time() - started
+            except OSError:
+                time.sleep(0.01)
+        raise TimeoutError('Daemon did not start')
+    finally:
+        process.kill()
+        process.wait()
+
+
+def main() -> None:
+    parser = ArgumentParser()
+    parser.add_argument('-n', '--objects', default=1000000, type=int, help='objects in the catalog')
+    parser.add_argument('-r', '--runs', default=3, type=int, help='restarts to measure')
+    args = parser.parse_args()
+
+    storage = tempfile.mkdtemp(prefix='filedaemon-startup-')
+    try:
+        started = time.time()
+        fill_storage(storage, args.objects)
+        print(f'{args.objects} objects written in {time.time() - started:.2f}s')
+
+        started = time.time()
+        catalog = Catalog(storage)
+        catalog.load()
+        print(f'catalog loaded in {time.time() - started:.2f}s')
+
+        started = time.time()
+        assert catalog.verify()
+        print(f'catalog verified in {time.time() - started:.2f}s')
+
+        for run in range(args.runs):
+            print(f'run {run + 1}: serving after {time_to_serve(storage):.2f}s')
+    finally:
+        shutil.rmtree(storage)
+
+
+if __name__ == '__main__':
+    main()
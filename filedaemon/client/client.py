@@ -0,0 +1,409 @@
+import io
+import os
+import json
+import mmap
+import queue
+import tempfile
+import threading
+import http.client
+from contextlib import contextmanager
+from functools import partial
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit, urlencode
+
+from typing import (Any, BinaryIO, Callable, Dict, Iterable, Iterator, List, Optional,
+                    Set, Tuple, TypeVar, Union)
+
+from werkzeug.utils import secure_filename
+
+# relative, so the client is imported as filedaemon.client by services
+from ..utils.delta import compute_delta
+from ..utils.multipart import MultipartFile
+from ..config import API, API_KEY_HEADER, EXPECTED_HASH_HEADER, HASHING_METHOD, READING_FILE_BUF_SIZE
+
+
+T = TypeVar('T')
+
+# Max number of hashes the daemon checks at once
+EXISTS_BATCH = 10000
+# Deltas bigger than this are spooled to a temporary file
+DELTA_SPOOL_SIZE = 16 * 2 ** 20
+
+
+class FileDaemonError(Exception):
+    """
+    Raised if the daemon answers with an error
+    """
+
+    def __init__(self, status: int, message: str):
+        self.status = status
+        self.message = message
+        super().__init__(f'{status}: {message}')
+
+
+def file_hash(fileobj: BinaryIO, filename: str) -> str:
+    """
+    Hash of a file the way the daemon computes it, from the filename and the content.
+    The file is read from its current position which is restored afterwards
+    """
+
+    hash_instance = HASHING_METHOD(secure_filename(filename).encode('utf-8'))
+    position = fileobj.tell()
+    for chunk in iter(lambda: fileobj.read(READING_FILE_BUF_SIZE), b''):
+        hash_instance.update(chunk)
+    fileobj.seek(position)
+    return hash_instance.hexdigest()
+
+
+class ConnectionPool(object):
+    """
+    At most size keep-alive connections to one daemon.
+    Connections the daemon closed are replaced with new ones
+    """
+
+    def __init__(self, host: str, port: int, size: int, timeout: float, secure: bool = False):
+        self.host = host
+        self.port = port
+        self.timeout = timeout
+        self._connection_class = http.client.HTTPSConnection if secure else http.client.HTTPConnection
+        self._idle: 'queue.LifoQueue[http.client.HTTPConnection]' = queue.LifoQueue()
+        self._slots = threading.BoundedSemaphore(size)
+
+    @contextmanager
+    def connection(self) -> Iterator[http.client.HTTPConnection]:
+        with self._slots:
+            try:
+                connection = self._idle.get_nowait()
+            except queue.Empty:
+                connection = self._connection_class(self.host, self.port, timeout=self.timeout)
+            try:
+                yield connection
+            except BaseException:
+                connection.close()
+                raise
+            self._idle.put(connection)
+
+    def close(self) -> None:
+        while True:
+            try:
+                self._idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class FileDaemonClient(object):
+    """
+    Client of the file daemon API.
+
+    Requests share a pool of keep-alive connections, so one client
+    is meant to be used by every thread of a service.
+    Files are streamed both ways and never loaded in memory.
+    """
+
+    def __init__(self, base_url: str, api_key: Optional[str] = None, pool_size: int = 8, timeout: float = 30):
+        url = urlsplit(base_url)
+        if url.scheme not in ('http', 'https'):
+            raise ValueError(f"Unsupported scheme of '{base_url}', use http or https")
+        secure = url.scheme == 'https'
+        self.base_path = url.path.rstrip('/')
+        self.headers = {API_KEY_HEADER: api_key} if api_key else {}
+        self.pool_size = pool_size
+        self.pool = ConnectionPool(url.hostname, url.port or (443 if secure else 80), pool_size, timeout, secure)
+
+    def __enter__(self) -> 'FileDaemonClient':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def close(self) -> None:
+        self.pool.close()
+
+    def _call(self, method: str, path: str, handle: Callable[[http.client.HTTPResponse], T],
+              query: Optional[Dict[str, Any]] = None, body: Any = None,
+              headers: Optional[Dict[str, str]] = None) -> T:
+        """
+        Send a request and pass the response to handle while the connection is held.
+        A request on a connection the daemon has closed meanwhile is sent once more,
+        so a streamed body is given as a function that makes it
+        """
+
+        path = self.base_path + path + ('?' + urlencode(query) if query else '')
+        for attempt in (1, 2):
+            with self.pool.connection() as connection:
+                try:
+                    connection.request(method, path, body=body() if callable(body) else body,
+                                       headers={**self.headers, **(headers or {})})
+                    response = connection.getresponse()
+                except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                    connection.close()
+                    if attempt == 2:
+                        raise
+                    continue
+
+                try:
+                    return handle(response)
+                finally:
+                    # the rest of the body has to be read before the connection is reused
+                    response.read()
+                    if response.will_close:
+                        connection.close()
+        raise AssertionError('unreachable')
+
+    @staticmethod
+    def _json(response: http.client.HTTPResponse) -> Dict[str, Any]:
+        try:
+            return json.loads(response.read() or b'{}')
+        except ValueError:
+            return {}
+
+    def _check(self, response: http.client.HTTPResponse) -> Dict[str, Any]:
+        payload = self._json(response)
+        if response.status != 200:
+            raise FileDaemonError(response.status, payload.get('message', response.reason))
+        return payload
+
+    # Single files
+
+    def upload(self, fileobj: BinaryIO, filename: str, ttl: Optional[int] = None, skip_existing: bool = True) -> str:
+        """
+        Upload a file from its current position to the end
+
+        Args:
+            skip_existing: hash the file first, so a stored file isn't sent again
+
+        Returns:
+            str: hash of the stored file
+        """
+
+        expected_hash = None
+        if skip_existing:
+            expected_hash = file_hash(fileobj, filename)
+            if self.exists(expected_hash):
+                return expected_hash
+        return self._send(fileobj, filename, ttl, expected_hash)
+
+    def _send(self, fileobj: BinaryIO, filename: str, ttl: Optional[int], expected_hash: Optional[str]) -> str:
+        headers = {EXPECTED_HASH_HEADER: expected_hash} if expected_hash else {}
+        query = {"ttl": ttl} if ttl else None
+        position = fileobj.tell()
+        form = MultipartFile(fileobj, secure_filename(filename))
+        headers.update({'Content-Type': form.content_type, 'Content-Length': str(form.length)})
+
+        def body() -> MultipartFile:
+            # sent again on a new connection
+            fileobj.seek(position)
+            return MultipartFile(fileobj, secure_filename(filename), boundary=form.boundary)
+
+        return self._call('POST', f'{API}/upload', partial(self._uploaded, expected_hash),
+                          query=query, body=body, headers=headers)
+
+    def _uploaded(self, expected_hash: Optional[str], response: http.client.HTTPResponse) -> str:
+        payload = self._json(response)
+        if response.status == 200:
+            return payload['hash']
+        # stored already
+        if response.status == 400 and expected_hash is not None and payload.get('hash') == expected_hash:
+            return payload['hash']
+        raise FileDaemonError(response.status, payload.get('message', response.reason))
+
+    def upload_file(self, path: str, **kw: Any) -> str:
+        with open(path, 'rb') as f:
+            return self.upload(f, os.path.basename(path), **kw)
+
+    def signature(self, hash_string: str, block_size: Optional[int] = None) -> Dict[str, Any]:
+        """
+        Checksums of every block of a stored file, see utils.delta
+        """
+
+        query = {"hash": hash_string, **({"block_size": block_size} if block_size else {})}
+        return self._call('GET', f'{API}/signature', self._check, query=query)
+
+    def upload_delta(self, fileobj: BinaryIO, filename: str, base: str, ttl: Optional[int] = None,
+                     block_size: Optional[int] = None, skip_existing: bool = True) -> str:
+        """
+        Upload a new version of the stored file base, sending only what's changed.
+        The file is read from its current position to the end
+
+        Returns:
+            str: hash of the stored file
+        """
+
+        headers = {'Content-Type': 'application/octet-stream'}
+        if skip_existing:
+            headers[EXPECTED_HASH_HEADER] = file_hash(fileobj, filename)
+            if self.exists(headers[EXPECTED_HASH_HEADER]):
+                return headers[EXPECTED_HASH_HEADER]
+
+        signed = self.signature(base, block_size)
+        delta = tempfile.SpooledTemporaryFile(max_size=DELTA_SPOOL_SIZE)
+        with delta, self._mapped(fileobj) as data:
+            for chunk in compute_delta(data, [tuple(block) for block in signed['blocks']],
+                                       signed['block_size'], signed['size']):
+                delta.write(chunk)
+            headers['Content-Length'] = str(delta.tell())
+
+            def body() -> BinaryIO:
+                delta.seek(0)
+                return delta
+
+            query = {"base": base, "name": secure_filename(filename), **({"ttl": ttl} if ttl else {})}
+            return self._call('POST', f'{API}/delta', partial(self._uploaded, headers.get(EXPECTED_HASH_HEADER)),
+                              query=query, body=body, headers=headers)
+
+    @staticmethod
+    @contextmanager
+    def _mapped(fileobj: BinaryIO) -> Iterator[Union[bytes, memoryview]]:
+        """
+        Rest of the file, mapped in memory if it's a file on the disk
+        """
+
+        position = fileobj.tell()
+        try:
+            fileno = fileobj.fileno()
+        except (AttributeError, OSError):
+            yield fileobj.read()
+            return
+
+        size = os.fstat(fileno).st_size
+        if size <= position:
+            yield b''
+            return
+        with mmap.mmap(fileno, 0, access=mmap.ACCESS_READ) as mapped:
+            view = memoryview(mapped)[position:]
+            try:
+                yield view
+            finally:
+                view.release()
+
+    def download(self, hash_string: str, fileobj: BinaryIO) -> int:
+        """
+        Write a stored file to fileobj
+
+        Returns:
+            int: number of written bytes
+        """
+
+        def handle(response: http.client.HTTPResponse) -> int:
+            if response.status != 200:
+                self._check(response)
+            written = 0
+            for chunk in iter(lambda: response.read(READING_FILE_BUF_SIZE), b''):
+                fileobj.write(chunk)
+                written += len(chunk)
+            return written
+
+        return self._call('GET', f'{API}/download', handle, query={"hash": hash_string})
+
+    def download_file(self, hash_string: str, path: str) -> int:
+        """
+        Download a stored file to path, nothing is left there if it fails
+        """
+
+        temp_path = path + '.part'
+        try:
+            with open(temp_path, 'wb') as f:
+                written = self.download(hash_string, f)
+            os.replace(temp_path, path)
+            return written
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def read(self, hash_string: str) -> bytes:
+        buffer = io.BytesIO()
+        self.download(hash_string, buffer)
+        return buffer.getvalue()
+
+    def delete(self, hash_string: str) -> bool:
+        """
+        Returns:
+            bool: False if the file was not stored
+        """
+
+        def handle(response: http.client.HTTPResponse) -> bool:
+            if response.status == 404:
+                return False
+            self._check(response)
+            return True
+
+        return self._call('DELETE', f'{API}/delete/{hash_string}', handle)
+
+    def exists(self, hash_string: str) -> bool:
+        return self._call('HEAD', f'{API}/exists/{hash_string}', lambda response: response.status == 200)
+
+    # Many files at once
+
+    def exists_many(self, hashes: Iterable[str]) -> Set[str]:
+        """
+        Which of hashes are stored
+        """
+
+        hashes = list(hashes)
+        found: Set[str] = set()
+        for start in range(0, len(hashes), EXISTS_BATCH):
+            body = json.dumps({"hashes": hashes[start:start + EXISTS_BATCH]}).encode('utf-8')
+            payload = self._call('POST', f'{API}/exists', self._check, body=body,
+                                 headers={'Content-Type': 'application/json'})
+            found.update(payload['found'])
+        return found
+
+    def _map(self, function: Callable[[Any], T], items: Iterable[Any],
+             workers: Optional[int]) -> Iterator[Tuple[Any, Union[T, Exception]]]:
+        """
+        Call function for every item by at most workers threads,
+        results and exceptions are yielded in order
+        """
+
+        def call(item: Any) -> Union[T, Exception]:
+            try:
+                return function(item)
+            except (OSError, FileDaemonError) as e:
+                return e
+
+        items = list(items)
+        with ThreadPoolExecutor(max_workers=workers or self.pool_size) as pool:
+            yield from zip(items, pool.map(call, items))
+
+    def upload_many(self, paths: Iterable[str], workers: Optional[int] = None,
+                    ttl: Optional[int] = None) -> Dict[str, Union[str, Exception]]:
+        """
+        Upload files, files already stored are only hashed
+
+        Returns:
+            Dict: hash or exception of every path
+        """
+
+        paths = list(paths)
+        hashes: Dict[str, Union[str, Exception]] = {}
+        for path, result in self._map(self._hash_file, paths, workers):
+            hashes[path] = result
+
+        stored = self.exists_many(h for h in hashes.values() if isinstance(h, str))
+        missing = [path for path, h in hashes.items() if isinstance(h, str) and h not in stored]
+        for path, result in self._map(lambda p: self._send_file(p, ttl, hashes[p]), missing, workers):
+            hashes[path] = result
+        return hashes
+
+    def _send_file(self, path: str, ttl: Optional[int], expected_hash: Any) -> str:
+        # checked already by exists_many
+        with open(path, 'rb') as f:
+            return self._send(f, os.path.basename(path), ttl, expected_hash)
+
+    @staticmethod
+    def _hash_file(path: str) -> str:
+        with open(path, 'rb') as f:
+            return file_hash(f, os.path.basename(path))
+
+    def download_many(self, files: Dict[str, str], workers: Optional[int] = None) -> Dict[str, Union[int, Exception]]:
+        """
+        Download files given as hash: path
+
+        Returns:
+            Dict: written bytes or exception of every hash
+        """
+
+        return dict(self._map(lambda h: self.download_file(h, files[h]), files, workers))
+
+    def delete_many(self, hashes: Iterable[str], workers: Optional[int] = None) -> Dict[str, Union[bool, Exception]]:
+        return dict(self._map(self.delete, hashes, workers))
@@ -0,0 +1,331 @@
+import hmac
+import logging
+import threading
+import http.client
+from urllib.parse import urlsplit, urlencode
+
+from typing import Any, Dict, Iterable, Iterator, List, Mapping, Optional, Set, Type
+
+from .ring import HashRing
+from storage.catalog import ObjectRecord
+from storage.manager import StorageMaster
+from utils.background import PeriodicTask
+from utils.metrics import metrics
+from utils.multipart import MultipartFile
+from config import (API, CLUSTER_NODES, CLUSTER_SELF, CLUSTER_REPLICAS, CLUSTER_VIRTUAL_NODES,
+                    CLUSTER_SECRET, CLUSTER_DEFAULT_SECRET, CLUSTER_HEARTBEAT_INTERVAL, CLUSTER_TIMEOUT, READING_FILE_BUF_SIZE)
+
+
+REPLICA_HEADER = 'X-Filedaemon-Replica'
+TENANT_HEADER = 'X-Filedaemon-Tenant'
+EXPIRES_HEADER = 'X-Filedaemon-Expires'
+# membership changes told by another daemon, they aren't announced again
+ANNOUNCED_HEADER = 'X-Filedaemon-Announced'
+
+logger = logging.getLogger('file')
+
+
+class Cluster(object):
+    """
+    Spreads files over several daemons with a consistent hash ring.
+
+    A file is saved by the daemon that received it and then pushed to every
+    other owner, non-owners drop their copy once owners have it.
+    Requests between daemons carry REPLICA_HEADER and are never forwarded again.
+    """
+
+    def __init__(self, self_url: str, nodes: Iterable[str], replicas: int = CLUSTER_REPLICAS,
+                 secret: str = CLUSTER_SECRET, master: Type[StorageMaster] = StorageMaster,
+                 virtual_nodes: int = CLUSTER_VIRTUAL_NODES, timeout: float = CLUSTER_TIMEOUT,
+                 heartbeat_interval: float = CLUSTER_HEARTBEAT_INTERVAL):
+        self.self_url = self_url.rstrip('/')
+        self.members: Set[str] = set(n.rstrip('/') for n in nodes) | ({self.self_url} if self.self_url else set())
+        self.replicas = replicas
+        self.secret = secret
+        self.master = master
+        self.virtual_nodes = virtual_nodes
+        self.timeout = timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.alive: Set[str] = set(self.members)
+        self.ring = HashRing(self.alive, replicas, virtual_nodes)
+        self.task: Optional[PeriodicTask] = None
+        self._rebalance_lock = threading.Lock()
+        self._rebalance_pending = threading.Event()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.self_url) and len(self.members) > 1
+
+    def check_config(self) -> None:
+        """
+        Raises:
+            ValueError: If this daemon can't be a member of a cluster
+        """
+
+        if not self.self_url:
+            raise ValueError('Cluster mode needs CLUSTER_SELF')
+        if self.secret == CLUSTER_DEFAULT_SECRET:
+            raise ValueError('Cluster mode needs CLUSTER_SECRET, the default one is publicly known')
+
+    def start(self) -> None:
+        """
+        Raises:
+            ValueError: If cluster mode is on with the default secret
+        """
+
+        if self.task is not None or not self.enabled:
+            return
+        self.check_config()
+        self.task = PeriodicTask('cluster-heartbeat', self.heartbeat_interval, self.heartbeat, delay=0)
+        self.task.start()
+
+    # Requests between daemons
+
+    def authenticates(self, headers: Mapping[str, str]) -> bool:
+        """
+        Request carries the secret. The default secret is never accepted
+        """
+
+        token = headers.get(REPLICA_HEADER)
+        return (self.secret != CLUSTER_DEFAULT_SECRET and token is not None
+                and hmac.compare_digest(token, self.secret))
+
+    def is_internal(self, headers: Mapping[str, str]) -> bool:
+        """
+        Request sent by another daemon of the cluster, never true without cluster mode
+        """
+
+        return self.enabled and self.authenticates(headers)
+
+    def _request(self, node: str, method: str, path: str, query: Optional[Dict[str, str]] = None,
+                 body: Any = None, headers: Optional[Dict[str, str]] = None) -> http.client.HTTPResponse:
+        """
+        Send a request to another daemon, the caller must close the response
+        """
+
+        url = urlsplit(node)
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=self.timeout)
+        if query:
+            path += '?' + urlencode(query)
+        connection.request(method, path, body=body, headers={REPLICA_HEADER: self.secret, **(headers or {})})
+        return connection.getresponse()
+
+    def ping(self, node: str) -> bool:
+        try:
+            response = self._request(node, 'GET', '/')
+            response.close()
+            return response.status == 200
+        except OSError:
+            return False
+
+    def has(self, node: str, hash_string: str) -> bool:
+        try:
+            response = self._request(node, 'HEAD', f'{API}/download', {"hash": hash_string})
+            response.close()
+            return response.status == 200
+        except OSError:
+            return False
+
+    def push(self, node: str, record: ObjectRecord) -> bool:
+        """
+        Copy a local file to another daemon.
+        A daemon already having the file counts as success
+        """
+
+        try:
+            with self.master.open(record.file_name) as f:
+                body = MultipartFile(f, record.name)
+                response = self._request(node, 'POST', f'{API}/upload', body=body, headers={
+                    'Content-Type': body.content_type,
+                    'Content-Length': str(body.length),
+                    TENANT_HEADER: record.tenant,
+                    EXPIRES_HEADER: str(record.expires),
+                })
+                response.read()
+                response.close()
+        except OSError:
+            logger.exception('Failed to push %s to %s', record.file_name, node)
+            return False
+
+        metrics.inc('cluster_pushes', node=node, status=response.status)
+        # 400 means the file is already there
+        return response.status in (200, 400)
+
+    # Placement
+
+    def owners(self, hash_string: str) -> List[str]:
+        return self.ring.owners(hash_string)
+
+    def place(self, hash_string: str) -> bool:
+        """
+        Push a freshly saved file to its owners
+        and drop the local copy if this daemon isn't one of them
+
+        Returns:
+            bool: False if the file was already stored by every owner
+        """
+
+        record = self.master.catalog.get(hash_string)
+        if record is None:
+            return True
+
+        owners = self.owners(hash_string)
+        others = [node for node in owners if node != self.self_url]
+        already_there = [node for node in others if self.has(node, hash_string)]
+        pushed = [node for node in others if node in already_there or self.push(node, record)]
+
+        if self.self_url not in owners and pushed:
+            self.master.delete(record.file_name)
+            return len(already_there) < len(others)
+        return True
+
+    def fetch(self, hash_string: str) -> Optional[http.client.HTTPResponse]:
+        """
+        Open the file on the first live owner that has it
+        """
+
+        for node in self.owners(hash_string):
+            if node == self.self_url:
+                continue
+            try:
+                response = self._request(node, 'GET', f'{API}/download', {"hash": hash_string})
+            except OSError:
+                continue
+            if response.status == 200:
+                return response
+            response.close()
+        return None
+
+    @staticmethod
+    def stream(response: http.client.HTTPResponse) -> Iterator[bytes]:
+        """
+        Relay the body of a fetched file and close the response
+        """
+
+        try:
+            while True:
+                chunk = response.read(READING_FILE_BUF_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+        finally:
+            response.close()
+
+    def delete(self, hash_string: str) -> bool:
+        """
+        Delete the file on every other live daemon
+
+        Returns:
+            bool: True if any daemon had the file
+        """
+
+        deleted = False
+        for node in self.alive - {self.self_url}:
+            try:
+                response = self._request(node, 'DELETE', f'{API}/delete', {"hash": hash_string})
+                response.close()
+                deleted = deleted or response.status == 200
+            except OSError:
+                continue
+        return deleted
+
+    # Membership
+
+    def heartbeat(self) -> None:
+        alive = {self.self_url} | set(node for node in self.members - {self.self_url} if self.ping(node))
+        if alive != self.alive:
+            logger.warning('Cluster changed: %s', sorted(alive))
+            self.alive = alive
+            self.ring = HashRing(alive, self.replicas, self.virtual_nodes)
+            self.rebalance_in_background()
+        metrics.set('cluster_alive_nodes', len(self.alive))
+
+    def join(self, node: str) -> None:
+        """
+        Add a daemon, it's sent the secret from now on.
+        Only requests that carry the secret may add one
+
+        Raises:
+            ValueError: If this daemon can't be a member or node isn't an http URL
+        """
+
+        self.check_config()
+        url = urlsplit(node)
+        if url.scheme != 'http' or not url.hostname:
+            raise ValueError(f"'{node}' is not an http URL of a daemon")
+        self.members.add(node.rstrip('/'))
+        if self.task is None:
+            self.start()
+        else:
+            self.heartbeat()
+
+    def leave(self, node: str) -> None:
+        node = node.rstrip('/')
+        self.members.discard(node)
+        if node in self.alive:
+            self.alive = self.alive - {node}
+            self.ring = HashRing(self.alive, self.replicas, self.virtual_nodes)
+            self.rebalance_in_background()
+
+    def announce(self, **change: str) -> None:
+        """
+        Tell every other member that a daemon joined or left
+        """
+
+        for node in self.members - {self.self_url}:
+            try:
+                self._request(node, 'POST', f'{API}/cluster', change, headers={ANNOUNCED_HEADER: '1'}).close()
+            except OSError:
+                logger.warning('Failed to tell %s about %s', node, change)
+
+    def rebalance_in_background(self) -> None:
+        self._rebalance_pending.set()
+        threading.Thread(target=self.rebalance, name='cluster-rebalance', daemon=True).start()
+
+    def rebalance(self) -> Dict[str, int]:
+        """
+        Make sure every owner of every local file has it
+        and drop files this daemon doesn't own anymore
+        """
+
+        stats = {"pushed": 0, "dropped": 0, "failed": 0}
+        if not self._rebalance_lock.acquire(blocking=False):
+            # the running pass will start over
+            return stats
+
+        try:
+            while self._rebalance_pending.is_set():
+                self._rebalance_pending.clear()
+                for record in list(self.master.catalog.records.values()):
+                    if not record.name:
+                        # can't be stored under the same hash elsewhere
+                        continue
+                    owners = self.owners(record.hash)
+                    complete = True
+                    for node in owners:
+                        if node == self.self_url or self.has(node, record.hash):
+                            continue
+                        if self.push(node, record):
+                            stats["pushed"] += 1
+                        else:
+                            stats["failed"] += 1
+                            complete = False
+                    if complete and self.self_url not in owners:
+                        self.master.delete(record.file_name)
+                        stats["dropped"] += 1
+            for name, value in stats.items():
+                metrics.inc('cluster_rebalanced', value, result=name)
+            return stats
+        finally:
+            self._rebalance_lock.release()
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "self": self.self_url,
+            "members": sorted(self.members),
+            "alive": sorted(self.alive),
+            "replicas": self.replicas,
+        }
+
+
+cluster = Cluster(CLUSTER_SELF, CLUSTER_NODES)
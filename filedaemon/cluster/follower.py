@@ -0,0 +1,198 @@
+import io
+import os
+import json
+import time
+import logging
+import http.client
+from urllib.parse import urlsplit, urlencode
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import Any, Dict, List, Optional, Type
+
+from werkzeug.datastructures import FileStorage
+
+from storage.manager import StorageMaster, EmptyFileException, QuotaExceededException
+from .cluster import REPLICA_HEADER
+from utils.background import PeriodicTask
+from utils.metrics import metrics
+from config import (API, CLUSTER_SECRET, CLUSTER_DEFAULT_SECRET, CLUSTER_TIMEOUT, READING_FILE_BUF_SIZE, FOLLOWER_OF, FOLLOWER_POLL_INTERVAL,
+                    FOLLOWER_BATCH_SIZE, FOLLOWER_FETCH_WORKERS)
+
+
+logger = logging.getLogger('file')
+
+
+class Follower(object):
+    """
+    Warm standby of another daemon.
+
+    Tails the operation log of the primary and applies it in order,
+    files of consecutive saves are fetched in parallel.
+    The last applied sequence number is kept next to the files.
+    The primary only serves its log to daemons knowing its CLUSTER_SECRET
+    """
+
+    CHECKPOINT = '.follower.checkpoint'
+
+    def __init__(self, primary: str, master: Type[StorageMaster] = StorageMaster,
+                 interval: float = FOLLOWER_POLL_INTERVAL, batch_size: int = FOLLOWER_BATCH_SIZE,
+                 workers: int = FOLLOWER_FETCH_WORKERS, timeout: float = CLUSTER_TIMEOUT,
+                 secret: str = CLUSTER_SECRET):
+        self.primary = primary.rstrip('/')
+        self.secret = secret
+        self.master = master
+        self.interval = interval
+        self.batch_size = batch_size
+        self.workers = workers
+        self.timeout = timeout
+        self.applied = 0
+        # entries the primary trimmed before they were applied
+        self.gap = False
+        self.task: Optional[PeriodicTask] = None
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.primary)
+
+    @property
+    def checkpoint_path(self) -> str:
+        return os.path.join(self.master.STORAGE, self.CHECKPOINT)
+
+    def start(self) -> None:
+        """
+        Raises:
+            ValueError: If CLUSTER_SECRET isn't set, the primary refuses the default one
+        """
+
+        if self.task is not None or not self.enabled:
+            return
+        if self.secret == CLUSTER_DEFAULT_SECRET:
+            raise ValueError('Following a primary needs the CLUSTER_SECRET it was started with')
+        try:
+            with open(self.checkpoint_path, 'r') as f:
+                self.applied = int(f.read() or 0)
+        except FileNotFoundError:
+            self.applied = 0
+        self.task = PeriodicTask('follower', self.interval, self.poll, delay=0)
+        self.task.start()
+
+    def _get(self, path: str, query: Dict[str, Any]) -> http.client.HTTPResponse:
+        url = urlsplit(self.primary)
+        connection = http.client.HTTPConnection(url.hostname, url.port or 80, timeout=self.timeout)
+        connection.request('GET', f'{path}?{urlencode(query)}', headers={REPLICA_HEADER: self.secret})
+        return connection.getresponse()
+
+    def _checkpoint(self, seq: int) -> None:
+        self.applied = seq
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w') as f:
+            f.write(str(seq))
+        os.replace(temp_path, self.checkpoint_path)
+        metrics.set('replication_applied_seq', seq)
+
+    def fetch(self, entry: Dict[str, Any]) -> None:
+        """
+        Copy a saved file from the primary
+        """
+
+        if self.master.get(entry['hash']) is not None:
+            return
+        if not entry.get('name'):
+            logger.error('Cannot replicate %s, its filename is unknown', entry['hash'])
+            return
+
+        response = self._get(f'{API}/download', {"hash": entry['hash']})
+        try:
+            if response.status == 404:
+                # deleted since, the delete is further in the log
+                return
+            if response.status != 200:
+                raise OSError(f"Primary answered {response.status} for {entry['hash']}")
+
+            stream = io.BufferedReader(response, READING_FILE_BUF_SIZE)
+            try:
+                hash_string = self.master.save(FileStorage(stream, entry['name']), tenant=entry['tenant'],
+                                               expires=entry.get('expires', 0))
+            except (FileExistsError, EmptyFileException):
+                return
+            except QuotaExceededException as e:
+                # retrying would never get past it, the quotas of this daemon are smaller
+                metrics.inc('replication_skipped', reason='quota')
+                logger.error('Cannot replicate %s: %s', entry['hash'], e.message)
+                return
+        finally:
+            response.close()
+
+        if hash_string != entry['hash']:
+            metrics.inc('replication_mismatches')
+            logger.error('Replicated %s but got %s', entry['hash'], hash_string)
+
+    def apply(self, entries: List[Dict[str, Any]], pool: ThreadPoolExecutor) -> None:
+        """
+        Apply entries in order.
+        Deletes wait for all saves before them
+        """
+
+        saves: List[Dict[str, Any]] = []
+
+        def flush() -> None:
+            if saves:
+                # .result() raises if any fetch failed, the batch is retried on the next poll
+                for result in [pool.submit(self.fetch, entry) for entry in saves]:
+                    result.result()
+                self._checkpoint(saves[-1]['seq'])
+                saves.clear()
+
+        for entry in entries:
+            if entry['op'] == 'save':
+                saves.append(entry)
+                continue
+            flush()
+            found_file = self.master.get(entry['hash'])
+            if found_file is not None:
+                self.master.delete(found_file)
+            self._checkpoint(entry['seq'])
+        flush()
+
+    def poll(self) -> None:
+        with ThreadPoolExecutor(max_workers=self.workers) as pool:
+            while True:
+                response = self._get(f'{API}/oplog', {"since": self.applied, "limit": self.batch_size})
+                try:
+                    if response.status != 200:
+                        raise OSError(f"Primary answered {response.status} for its operation log")
+                    payload = json.loads(response.read())
+                finally:
+                    response.close()
+
+                entries = payload.get('entries', [])
+                last_seq = payload.get('last_seq', self.applied)
+                if entries and entries[0]['seq'] > self.applied + 1:
+                    # applying the rest would leave files of the trimmed entries behind
+                    if not self.gap:
+                        logger.error('Entries %d-%d were trimmed by the primary, seed this daemon from a snapshot',
+                                     self.applied + 1, entries[0]['seq'] - 1)
+                    self.gap = True
+                    metrics.set('replication_gap', 1)
+                    return
+                if entries:
+                    self.apply(entries, pool)
+
+                metrics.set('replication_lag_entries', max(0, last_seq - self.applied))
+                metrics.set('replication_lag_seconds', max(0.0, time.time() - entries[-1]['time']) if
+                            entries and self.applied < last_seq else 0.0)
+
+                if len(entries) < self.batch_size:
+                    return
+
+    def status(self) -> Dict[str, Any]:
+        return {
+            "primary": self.primary,
+            "applied_seq": self.applied,
+            "gap": self.gap,
+            "lag_entries": metrics.get('replication_lag_entries'),
+            "lag_seconds": metrics.get('replication_lag_seconds'),
+        }
+
+
+follower = Follower(FOLLOWER_OF)
@@ -0,0 +1,53 @@
+import bisect
+
+from typing import Iterable, List, Tuple
+
+from config import HASHING_METHOD
+
+
+def ring_position(key: str) -> int:
+    """
+    Position of a key on the ring.
+    Object hashes are uniformly distributed already, anything else is hashed first
+    """
+
+    try:
+        return int(key[:16], 16)
+    except ValueError:
+        return int(HASHING_METHOD(key.encode('utf-8')).hexdigest()[:16], 16)
+
+
+class HashRing(object):
+    """
+    Consistent hash ring.
+    Every node owns virtual_nodes points, so adding or removing a node
+    only moves keys between it and its neighbours
+    """
+
+    def __init__(self, nodes: Iterable[str], replicas: int = 1, virtual_nodes: int = 64):
+        self.nodes = sorted(set(nodes))
+        self.replicas = min(replicas, len(self.nodes))
+        points: List[Tuple[int, str]] = sorted(
+            (ring_position(HASHING_METHOD(f'{node}#{i}'.encode('utf-8')).hexdigest()), node)
+            for node in self.nodes for i in range(virtual_nodes)
+        )
+        self._positions = [position for position, _ in points]
+        self._owners = [node for _, node in points]
+
+    def owners(self, key: str) -> List[str]:
+        """
+        Nodes that should keep the key, the primary one goes first
+        """
+
+        owners: List[str] = []
+        if not self._owners:
+            return owners
+
+        start = bisect.bisect(self._positions, ring_position(key))
+        for i in range(len(self._owners)):
+            node = self._owners[(start + i) % len(self._owners)]
+            if node not in owners:
+                owners.append(node)
+                if len(owners) == self.replicas:
+                    break
+        return owners
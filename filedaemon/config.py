@@ -1,12 +1,35 @@
 import os
+import json
 import hashlib
 
+from typing import Any
+
+
+def setting(name: str, default: Any) -> Any:
+    """
+    Value of FILEDAEMON_<name> environment variable or default.
+    Lets several daemons run from one checkout, values are parsed as JSON when possible
+    """
+
+    value = os.environ.get('FILEDAEMON_' + name)
+    if value is None:
+        return default
+    try:
+        return json.loads(value)
+    except ValueError:
+        return value
+
+
 # Files related
 
 BASE_DIR = os.path.dirname(os.path.abspath(__file__))
-STORAGE_DIR = os.path.join(BASE_DIR, 'files') # Place where the users' files stored
+STORAGE_DIR = setting('STORAGE_DIR', os.path.join(BASE_DIR, 'files')) # Place where the users' files stored
 TEMP_DIR = os.path.join(STORAGE_DIR, 'temporary')
+QUARANTINE_DIR = os.path.join(STORAGE_DIR, 'quarantine')  # Files that failed integrity check
+PACKS_DIR = os.path.join(STORAGE_DIR, 'packs')  # Small files packed together
+COLD_STORAGE_DIRS = setting('COLD_STORAGE_DIRS', [])  # Slower storage tiers, fastest first
 LOG_DIR = os.path.join(BASE_DIR, 'logs')
+ACCESS_LOG_SAMPLE_RATE = setting('ACCESS_LOG_SAMPLE_RATE', 1.0)  # Share of successful requests in logs/access.log, errors are always logged
 
 # Hash and files related
 
@@ -14,6 +37,29 @@ HASHING_METHOD = hashlib.sha256
 HASH_LENGTH = len(HASHING_METHOD('hashed string'.encode('utf-8')).hexdigest())
 READING_FILE_BUF_SIZE = 65536  # 64kb
 
+PACK_THRESHOLD = 4096  # Files smaller than this are packed together, 0 disables packing
+PACK_FILE_SIZE = 256 * 2 ** 20  # 256mb
+PACK_COMPACT_RATIO = 0.5  # Packs with more deleted bytes than this are compacted
+PACK_COMPACT_INTERVAL = 60 * 60  # seconds
+
+IO_CACHE_POLICY = setting('IO_CACHE_POLICY', True)  # Keep large transfers from pushing small files out of the page cache
+IO_LARGE_FILE = 32 * 2 ** 20  # 32mb, files streamed around the page cache
+IO_READAHEAD = 16 * 2 ** 20  # 16mb, read ahead of large downloads
+IO_WRITE_WINDOW = 8 * 2 ** 20  # 8mb, large uploads drop what they wrote every window
+IO_DIRECT_WRITES = setting('IO_DIRECT_WRITES', False)  # Write large uploads with O_DIRECT instead
+
+DELTA_BLOCK_SIZE = 8192  # Blocks of signatures for delta uploads, clients can ask for others
+DELTA_MIN_BLOCK_SIZE = 512
+DELTA_MAX_BLOCK_SIZE = 2 ** 20  # 1mb
+
+BLOOM_CAPACITY = 10 ** 6  # Hashes the existence filter is sized for at least, 1m takes ~10mb
+BLOOM_ERROR_RATE = 0.01
+
+LOCK_STRIPES = 64  # Thread locks hashes are spread over, files of one stripe are changed one at a time
+
+INDEX_VALIDATE_BATCH = 1000  # Catalog records checked against the disk at once after a restart
+INDEX_VALIDATE_PAUSE = 0.05  # seconds between the batches
+
 
 # App related
 
@@ -25,3 +71,93 @@ MAX_CONTENT_LENGTH_VERBOSE = "2 GB"
 API_ROOT = 'api'
 API_VERSION = 'v1'
 API = f'/{API_ROOT}/{API_VERSION}'
+
+
+# Rate limiting related. Limits are per client, 0 disables a limit
+
+API_KEY_HEADER = 'X-Api-Key'  # Clients are told apart by this header or by their IP
+API_KEYS = set(setting('API_KEYS', []))  # Keys clients may send, clients with other keys are told apart by their IP
+EXPECTED_HASH_HEADER = 'X-Expected-Hash'  # Hash the client computed, duplicates are answered before the body is read
+RATE_LIMIT_REQUESTS = 100  # requests per second
+RATE_LIMIT_BURST = 200
+RATE_LIMIT_BYTES = 0  # bytes per second
+RATE_LIMIT_BYTES_BURST = 8 * 2 ** 20  # 8mb
+RATE_LIMIT_MAX_CLIENTS = 10000
+
+
+# Admission control related. Uploads and downloads have budgets of their own, 0 disables a limit
+
+ADMISSION_UPLOADS = 64  # uploads received at once
+ADMISSION_UPLOAD_BYTES = 2 ** 30  # 1gb, declared bytes of uploads received at once
+ADMISSION_TEMP_BYTES = 4 * 2 ** 30  # 4gb, bytes in TEMP_DIR
+ADMISSION_WRITE_LATENCY = 0.05  # seconds, recent average write of an upload chunk
+ADMISSION_DOWNLOADS = 256  # downloads sent at once
+ADMISSION_RETRY_AFTER = 1  # seconds clients are told to wait
+
+
+# Memory diagnostics related. Can be set with FILEDAEMON_<NAME> environment variables
+
+MEMORY_TRACING = setting('MEMORY_TRACING', False)  # Trace allocations with tracemalloc, slows every allocation down
+MEMORY_TRACE_FRAMES = setting('MEMORY_TRACE_FRAMES', 1)  # frames kept of every allocation, more cost more memory
+MEMORY_SAMPLE_RATE = setting('MEMORY_SAMPLE_RATE', 0.1)  # Share of uploads and downloads their peak allocation is measured for
+MEMORY_GAUGE_INTERVAL = setting('MEMORY_GAUGE_INTERVAL', 10)  # seconds between samples of RSS and open files
+
+
+# Quota related. Sizes are in bytes, 0 disables a quota
+
+DEFAULT_TENANT = 'anonymous'  # Tenant of clients without an API key
+QUOTA_TOTAL = 0
+QUOTA_TENANT = 0
+QUOTA_TENANTS = {}  # Overrides QUOTA_TENANT for tenant ids shown in /metrics
+QUOTA_RECONCILE_INTERVAL = 60 * 60  # seconds between walks over STORAGE_DIR
+
+
+# Expiry related
+
+EXPIRY_BUCKET = 60  # seconds, objects expiring within one bucket are found together
+EXPIRY_INTERVAL = 60  # seconds between looking for expired objects
+EXPIRY_BATCH_SIZE = 100  # objects deleted at once
+EXPIRY_DELETES_PER_SECOND = 50  # 0 means unlimited
+
+
+# Scrubbing related
+
+SCRUB_INTERVAL = 24 * 60 * 60  # seconds between passes over the storage, 0 disables scrubbing
+SCRUB_WORKERS = 2  # processes hashing files
+SCRUB_BYTES_PER_SECOND = 64 * 2 ** 20  # 64mb, read budget of the scrubber
+SCRUB_CHECKPOINT = os.path.join(STORAGE_DIR, '.scrub.checkpoint')
+
+FSCK_TEMP_AGE = 60 * 60  # seconds, older files of TEMP_DIR are orphans of uploads that never finished
+
+
+# Tiering related, only used when COLD_STORAGE_DIRS are set
+
+TIER_MOVE_INTERVAL = 15 * 60  # seconds between passes of the mover
+TIER_HALF_LIFE = 24 * 60 * 60  # seconds for a download to count half as much
+TIER_PROMOTE_SCORE = 3  # Decayed downloads that bring a file back to STORAGE_DIR
+TIER_DEMOTE_AFTER = 7 * 24 * 60 * 60  # seconds without downloads before a file goes one tier down
+TIER_FAST_CAPACITY = 0  # bytes of files kept in STORAGE_DIR, 0 means unlimited
+TIER_MOVE_BYTES_PER_SECOND = 64 * 2 ** 20  # 64mb, copy budget of the mover
+
+
+# Cluster related. Can be set with FILEDAEMON_<NAME> environment variables
+
+CLUSTER_NODES = setting('CLUSTER_NODES', [])  # Base URLs of every daemon, empty list disables cluster mode
+CLUSTER_SELF = setting('CLUSTER_SELF', '')  # Base URL of this daemon as it's listed in CLUSTER_NODES
+CLUSTER_REPLICAS = setting('CLUSTER_REPLICAS', 2)  # Copies of every file
+CLUSTER_VIRTUAL_NODES = setting('CLUSTER_VIRTUAL_NODES', 64)  # Points of every daemon on the ring
+CLUSTER_DEFAULT_SECRET = 'change-me'  # Publicly known, cluster mode refuses to start with it
+CLUSTER_SECRET = setting('CLUSTER_SECRET', CLUSTER_DEFAULT_SECRET)  # Shared by daemons to tell their requests apart
+CLUSTER_HEARTBEAT_INTERVAL = setting('CLUSTER_HEARTBEAT_INTERVAL', 5)  # seconds
+CLUSTER_TIMEOUT = setting('CLUSTER_TIMEOUT', 10)  # seconds
+
+
+# Replication related. Can be set with FILEDAEMON_<NAME> environment variables
+
+OPLOG_FSYNC = setting('OPLOG_FSYNC', True)  # Sync the operation log and pack files on every write
+OPLOG_KEEP_ENTRIES = setting('OPLOG_KEEP_ENTRIES', 10 ** 6)  # Followers further behind must be seeded from a snapshot, 0 keeps every entry
+OPLOG_TRIM_INTERVAL = 60 * 60  # seconds between trims of the operation log
+FOLLOWER_OF = setting('FOLLOWER_OF', '')  # Base URL of the primary, makes this daemon a read-only follower
+FOLLOWER_POLL_INTERVAL = setting('FOLLOWER_POLL_INTERVAL', 1)  # seconds
+FOLLOWER_BATCH_SIZE = setting('FOLLOWER_BATCH_SIZE', 500)  # operations read at once
+FOLLOWER_FETCH_WORKERS = setting('FOLLOWER_FETCH_WORKERS', 8)  # files fetched in parallel
@@ -0,0 +1,333 @@
+import gc
+import os
+import json
+import heapq
+import itertools
+import threading
+
+from typing import Dict, Iterable, Iterator, List, Optional, Set, Tuple
+from attr import dataclass
+
+from utils.indexfile import is_index, read_index, unescape, write_index, verify_index
+from config import DEFAULT_TENANT, EXPIRY_BUCKET
+
+
+def is_shard(name: str) -> bool:
+    """
+    Shard directories are named after the first two characters of a hash
+    """
+
+    return len(name) == 2 and not name.startswith('.')
+
+
+def iter_stored_files(storage: str) -> Iterator[os.DirEntry]:
+    """
+    Yield every object file in every shard of storage
+    """
+
+    with os.scandir(storage) as shards:
+        for shard in shards:
+            if not is_shard(shard.name) or not shard.is_dir(follow_symlinks=False):
+                continue
+            with os.scandir(shard.path) as files:
+                for entry in files:
+                    # dot files are being written
+                    if entry.is_file(follow_symlinks=False) and not entry.name.startswith('.'):
+                        yield entry
+
+
+@dataclass(slots=True)
+class ObjectRecord(object):
+    """
+    What the catalog knows about a stored object
+    """
+
+    hash: str
+    extension: str
+    size: int
+    tenant: str = DEFAULT_TENANT
+    # secure filename the hash was computed with,
+    # objects restored from disk don't have it
+    name: str = ''
+    # unix time the object expires at, 0 means never
+    expires: float = 0
+
+    @property
+    def file_name(self) -> str:
+        return self.hash + self.extension
+
+    def dump(self) -> Dict:
+        return {"hash": self.hash, "extension": self.extension, "size": self.size,
+                "tenant": self.tenant, "name": self.name, "expires": self.expires}
+
+
+class Catalog(object):
+    """
+    Persistent record of every stored object with constant-time usage counters.
+
+    Changes are appended to a journal as they happen, and from time to time
+    the journal is compacted into a snapshot, so loading the catalog never
+    has to walk the storage directory. The snapshot is a checksummed index file
+    that is loaded without checking it, see verify().
+
+    Objects with a time to live are indexed by expiry_bucket seconds long buckets,
+    so expired objects are found without looking at the rest.
+    """
+
+    JOURNAL = '.catalog.journal'
+    SNAPSHOT = '.catalog.snapshot'
+
+    def __init__(self, root: str, expiry_bucket: int = EXPIRY_BUCKET):
+        self.root = root
+        self.journal_path = os.path.join(root, self.JOURNAL)
+        self.snapshot_path = os.path.join(root, self.SNAPSHOT)
+        self.expiry_bucket = expiry_bucket
+        self.records: Dict[str, ObjectRecord] = {}
+        self.usage: Dict[str, int] = {}
+        self.total: int = 0
+        # bucket -> hashes expiring in it, and a heap of buckets
+        self.expiring: Dict[int, Set[str]] = {}
+        self._expiry_heap: List[int] = []
+        self.loaded: bool = False
+        self._journal = None
+        self._lock = threading.RLock()
+
+    def __contains__(self, hash_string: str) -> bool:
+        return hash_string in self.records
+
+    def __len__(self) -> int:
+        return len(self.records)
+
+    def get(self, hash_string: str) -> Optional[ObjectRecord]:
+        return self.records.get(hash_string)
+
+    def _account(self, record: ObjectRecord, sign: int) -> None:
+        self.total += sign * record.size
+        self.usage[record.tenant] = self.usage.get(record.tenant, 0) + sign * record.size
+        if not self.usage[record.tenant]:
+            del self.usage[record.tenant]
+
+    def _schedule(self, record: ObjectRecord) -> None:
+        bucket = int(record.expires // self.expiry_bucket)
+        if bucket not in self.expiring:
+            self.expiring[bucket] = set()
+            heapq.heappush(self._expiry_heap, bucket)
+        self.expiring[bucket].add(record.hash)
+
+    def _put(self, record: ObjectRecord) -> None:
+        self._pop(record.hash)
+        self.records[record.hash] = record
+        self._account(record, 1)
+        if record.expires:
+            self._schedule(record)
+
+    def _pop(self, hash_string: str) -> Optional[ObjectRecord]:
+        record = self.records.pop(hash_string, None)
+        if record is not None:
+            self._account(record, -1)
+            if record.expires:
+                bucket = int(record.expires // self.expiry_bucket)
+                hashes = self.expiring.get(bucket)
+                if hashes is not None:
+                    hashes.discard(hash_string)
+                    # left in the heap until it comes to the top
+                    if not hashes:
+                        del self.expiring[bucket]
+        return record
+
+    def expired(self, now: float, limit: int) -> List[ObjectRecord]:
+        """
+        Up to limit objects expired by now, the earliest buckets first.
+        They stay in the catalog until they're removed
+        """
+
+        with self._lock:
+            due: List[int] = []
+            while self._expiry_heap and self._expiry_heap[0] * self.expiry_bucket <= now:
+                bucket = heapq.heappop(self._expiry_heap)
+                # emptied buckets are dropped here, recreated ones could be pushed twice
+                if bucket in self.expiring and (not due or due[-1] != bucket):
+                    due.append(bucket)
+            for bucket in due:
+                heapq.heappush(self._expiry_heap, bucket)
+
+            found: List[ObjectRecord] = []
+            for bucket in due:
+                for hash_string in self.expiring[bucket]:
+                    record = self.records[hash_string]
+                    if record.expires <= now:
+                        found.append(record)
+                        if len(found) == limit:
+                            return found
+            return found
+
+    def _write(self, entry: Dict) -> None:
+        if self._journal is None:
+            self._journal = open(self.journal_path, 'a', encoding='utf-8')
+        self._journal.write(json.dumps(entry) + '\n')
+        self._journal.flush()
+
+    def load(self) -> bool:
+        """
+        Restore the catalog from its snapshot and journal
+
+        Returns:
+            bool: False if there was nothing to restore
+        """
+
+        with self._lock:
+            self.records, self.usage, self.total = {}, {}, 0
+            self.expiring, self._expiry_heap = {}, []
+            found = False
+            for path in (self.snapshot_path, self.journal_path):
+                if not os.path.exists(path):
+                    continue
+                found = True
+                if path == self.snapshot_path and self._load_snapshot():
+                    continue
+                # journal, or a snapshot written before it was an index file
+                with open(path, 'r', encoding='utf-8') as lines:
+                    for line in lines:
+                        try:
+                            entry = json.loads(line)
+                        except ValueError:
+                            # torn write at the end of the journal
+                            continue
+                        if entry.pop('op', '+') == '+':
+                            self._put(ObjectRecord(**entry))
+                        else:
+                            self._pop(entry['hash'])
+            self.loaded = True
+            return found
+
+    def _load_snapshot(self) -> bool:
+        try:
+            index = read_index(self.snapshot_path)
+        except ValueError:
+            # torn header, verify() fails and the catalog is reconciled with the disk
+            return True
+        if index is None:
+            return False
+
+        header, rows = index
+        records = self.records
+        tenants: Dict[str, str] = {}
+        # nothing to collect while millions of records are created
+        collecting = gc.isenabled()
+        gc.disable()
+        try:
+            for row in rows.split('\n'):
+                if not row:
+                    continue
+                hash_string, extension, size, tenant, name, expires = row.split('\t')
+                if '\\' in row:
+                    extension, tenant, name = unescape(extension), unescape(tenant), unescape(name)
+                record = records[hash_string] = ObjectRecord(hash_string, extension, int(size),
+                                                             tenants.setdefault(tenant, tenant), name,
+                                                             float(expires) if expires != '0' else 0)
+                if record.expires:
+                    self._schedule(record)
+            # checked with the rows by verify()
+            self.usage, self.total = dict(header["usage"]), header["total"]
+        except (ValueError, KeyError):
+            # corrupted, verify() fails and the catalog is reconciled with the disk
+            self.records, self.usage, self.total = {}, {}, 0
+            self.expiring, self._expiry_heap = {}, []
+        finally:
+            if collecting:
+                gc.enable()
+        return True
+
+    def verify(self) -> bool:
+        """
+        Check the snapshot against its checksum and the counters against the records.
+        Counters are fixed if they're off
+
+        Returns:
+            bool: False if the snapshot is corrupted
+        """
+
+        if is_index(self.snapshot_path) and not verify_index(self.snapshot_path):
+            return False
+
+        with self._lock:
+            usage: Dict[str, int] = {}
+            for record in self.records.values():
+                usage[record.tenant] = usage.get(record.tenant, 0) + record.size
+            self.usage, self.total = usage, sum(usage.values())
+        return True
+
+    def add(self, record: ObjectRecord) -> None:
+        with self._lock:
+            self._put(record)
+            self._write({"op": "+", **record.dump()})
+
+    def remove(self, hash_string: str) -> Optional[ObjectRecord]:
+        with self._lock:
+            record = self._pop(hash_string)
+            if record is not None:
+                self._write({"op": "-", "hash": hash_string})
+            return record
+
+    def compact(self) -> None:
+        """
+        Write every record to a new snapshot and truncate the journal
+        """
+
+        with self._lock:
+            write_index(self.snapshot_path, {"usage": self.usage, "total": self.total},
+                        ((r.hash, r.extension, r.size, r.tenant, r.name, r.expires) for r in self.records.values()))
+
+            if self._journal is not None:
+                self._journal.close()
+                self._journal = None
+            open(self.journal_path, 'w').close()
+
+    def reconcile(self, packed: Iterable[Tuple[str, str, int]] = (), tiers: Iterable[str] = ()) -> Dict[str, int]:
+        """
+        Walk every shard and bring the catalog in line with the disk.
+        Objects saved or deleted while walking are left as they are
+
+        Args:
+            packed: (hash, extension, size) of files that live outside of shards
+            tiers: other storage directories with shards of their own
+
+        Returns:
+            Dict[str, int]: how many records were added, removed and resized
+        """
+
+        with self._lock:
+            known: Set[str] = set(self.records)
+
+        found: List[Tuple[str, str, int]] = []
+        stored = itertools.chain.from_iterable(iter_stored_files(root) for root in [self.root, *tiers])
+        for entry in stored:
+            try:
+                size = entry.stat(follow_symlinks=False).st_size
+            except FileNotFoundError:
+                continue
+            found.append((*os.path.splitext(entry.name), size))
+        found.extend(packed)
+
+        stats = {"added": 0, "removed": 0, "resized": 0}
+
+        with self._lock:
+            on_disk = set()
+            for hash_string, extension, size in found:
+                on_disk.add(hash_string)
+                record = self.records.get(hash_string)
+                if record is None:
+                    if hash_string not in known:
+                        self._put(ObjectRecord(hash_string, extension, size))
+                        stats["added"] += 1
+                elif record.size != size:
+                    self._put(ObjectRecord(hash_string, extension, size, record.tenant, record.name, record.expires))
+                    stats["resized"] += 1
+
+            for hash_string in known - on_disk:
+                if self._pop(hash_string) is not None:
+                    stats["removed"] += 1
+
+            self.compact()
+
+        return stats
@@ -0,0 +1,84 @@
+import time
+import logging
+
+from typing import Any, Dict, Optional, Set, Type
+
+from .manager import StorageMaster
+from utils.background import PeriodicTask
+from utils.metrics import metrics
+from utils.ratelimit import TokenBucket
+from config import EXPIRY_INTERVAL, EXPIRY_BATCH_SIZE, EXPIRY_DELETES_PER_SECOND
+
+
+logger = logging.getLogger('file')
+
+
+class Expirer(object):
+    """
+    Deletes objects whose time to live is over.
+
+    Expired objects are taken from the catalog in batches
+    and deleted no faster than deletes_per_second.
+    Expiry times are kept in the catalog, so they survive restarts.
+    """
+
+    def __init__(self, master: Type[StorageMaster] = StorageMaster, batch_size: int = EXPIRY_BATCH_SIZE,
+                 deletes_per_second: float = EXPIRY_DELETES_PER_SECOND):
+        self.master = master
+        self.batch_size = batch_size
+        self.budget = TokenBucket(deletes_per_second, batch_size) if deletes_per_second else None
+        self.task: Optional[PeriodicTask] = None
+        self.status: Dict[str, Any] = {"expired": 0, "last_run": None}
+
+    def start(self) -> None:
+        if self.task is not None:
+            return
+        # objects expired while the daemon was down are deleted right away
+        self.task = PeriodicTask('expirer', EXPIRY_INTERVAL, self.run, delay=0)
+        self.task.start()
+
+    def _throttle(self) -> None:
+        if self.budget is not None:
+            delay = self.budget.consume(1)
+            if delay:
+                time.sleep(delay)
+
+    def run(self) -> int:
+        """
+        Delete every object expired by now
+
+        Returns:
+            int: number of deleted objects
+        """
+
+        now = time.time()
+        deleted = 0
+        failed: Set[str] = set()
+
+        while True:
+            batch = [record for record in self.master.catalog.expired(now, self.batch_size + len(failed))
+                     if record.hash not in failed]
+            if not batch:
+                break
+
+            for record in batch:
+                self._throttle()
+                try:
+                    found_file = self.master.get(record.hash)
+                    if found_file is not None:
+                        self.master.delete(found_file)
+                    else:
+                        # gone from the disk already
+                        self.master.forget(record.hash)
+                except OSError:
+                    logger.exception('Failed to delete expired %s', record.file_name)
+                    failed.add(record.hash)
+                    continue
+                deleted += 1
+
+        metrics.inc('objects_expired', deleted)
+        self.status.update(expired=self.status["expired"] + deleted, last_run=now)
+        return deleted
+
+
+expirer = Expirer()
@@ -0,0 +1,270 @@
+import os
+import sys
+import json
+import time
+import shutil
+
+from concurrent.futures import ProcessPoolExecutor
+from typing import Any, Dict, Iterator, List, Optional, TextIO, Tuple, Type
+
+from .catalog import is_shard
+from .manager import StorageMaster
+from utils.encryption import verify_hash
+from utils.progress import Progress
+from config import FSCK_TEMP_AGE
+
+
+Finding = Dict[str, Any]
+
+
+def scan_shard(shard: str, tiers: List[str], packed: Dict[str, str],
+               inventory: bool) -> Tuple[int, int, List[Finding], List[Dict[str, Any]]]:
+    """
+    Check every entry of a shard in every tier against its name.
+    Runs in worker processes and never changes anything
+
+    Args:
+        shard: name of the shard
+        tiers: storage directories, fastest first
+        packed: hash -> extension of packed files of the shard
+        inventory: also return a record of every stored file
+
+    Returns:
+        Tuple: files and bytes seen, problems found and records of the files
+    """
+
+    count, total = 0, 0
+    findings: List[Finding] = []
+    files: List[Dict[str, Any]] = []
+    copies: Dict[str, List[Dict[str, Any]]] = dict(
+        (hash_string, [{"path": None, "extension": extension, "tier": None}])
+        for hash_string, extension in packed.items())
+
+    for tier_number, tier in enumerate(tiers):
+        directory = os.path.join(tier, shard)
+        empty = True
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    empty = False
+                    # dot files are being written
+                    if entry.name.startswith('.'):
+                        continue
+                    if not entry.is_file(follow_symlinks=False):
+                        findings.append({"problem": "unexpected", "path": entry.path})
+                        continue
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    count += 1
+                    total += stat.st_size
+
+                    hash_string, extension = os.path.splitext(entry.name)
+                    if not verify_hash(hash_string):
+                        findings.append({"problem": "bad_name", "path": entry.path})
+                        continue
+                    if not hash_string.startswith(shard):
+                        findings.append({"problem": "misplaced", "path": entry.path, "hash": hash_string})
+                        continue
+                    if not stat.st_size:
+                        # storage never keeps empty files, it's a placeholder left by a crash
+                        findings.append({"problem": "empty", "path": entry.path, "hash": hash_string})
+                        continue
+
+                    copies.setdefault(hash_string, []).append(
+                        {"path": entry.path, "extension": extension, "tier": tier_number})
+                    if inventory:
+                        files.append({"hash": hash_string, "extension": extension, "tier": tier_number,
+                                      "size": stat.st_size, "mtime": stat.st_mtime})
+        except FileNotFoundError:
+            continue
+        if empty:
+            findings.append({"problem": "empty_shard", "path": directory})
+
+    for hash_string, found in copies.items():
+        if len(found) > 1:
+            findings.append({"problem": "duplicate", "hash": hash_string, "copies": found})
+
+    return count, total, findings, files
+
+
+class StorageCheck(object):
+    """
+    Offline inventory and consistency check of the storage.
+
+    Shards are walked by a pool of worker processes with os.scandir,
+    results are written as JSON lines as soon as a shard is done.
+    Problems can be repaired, which is meant for a stopped daemon,
+    though every change of a stored file is still made holding the lock of its hash
+    """
+
+    def __init__(self, master: Type[StorageMaster] = StorageMaster, workers: Optional[int] = None,
+                 output: TextIO = sys.stdout, progress: Optional[Progress] = None, temp_age: float = FSCK_TEMP_AGE):
+        self.master = master
+        self.workers = workers
+        self.output = output
+        self.progress = progress
+        self.temp_age = temp_age
+
+    def shards(self) -> List[str]:
+        shards = set()
+        for tier in self.master.tiers():
+            try:
+                with os.scandir(tier) as entries:
+                    shards.update(entry.name for entry in entries
+                                  if is_shard(entry.name) and entry.is_dir(follow_symlinks=False))
+            except FileNotFoundError:
+                continue
+        return sorted(shards)
+
+    def _write(self, line: Dict[str, Any]) -> None:
+        self.output.write(json.dumps(line) + '\n')
+
+    def _scan(self, inventory: bool) -> Iterator[Tuple[List[Finding], List[Dict[str, Any]]]]:
+        packed: Dict[str, Dict[str, str]] = {}
+        for hash_string, entry in self.master.packs.items():
+            packed.setdefault(hash_string[:2], {})[hash_string] = entry.extension
+        shards = self.shards()
+        tiers = self.master.tiers()
+
+        with ProcessPoolExecutor(max_workers=self.workers) as pool:
+            jobs = [pool.submit(scan_shard, shard, tiers, packed.get(shard, {}), inventory) for shard in shards]
+            for job in jobs:
+                count, total, findings, files = job.result()
+                if self.progress is not None:
+                    self.progress.update(count, total)
+                yield findings, files
+
+    def inventory(self) -> int:
+        """
+        Write a record of every stored file, packed ones included
+
+        Returns:
+            int: files listed
+        """
+
+        listed = 0
+        for _, files in self._scan(inventory=True):
+            for record in files:
+                self._write(record)
+            listed += len(files)
+        for hash_string, entry in self.master.packs.items():
+            self._write({"hash": hash_string, "extension": entry.extension, "tier": "packs", "size": entry.size})
+            listed += 1
+        self.output.flush()
+        return listed
+
+    def orphans(self) -> List[Finding]:
+        """
+        Temp files older than temp_age, uploads that never finished
+        """
+
+        found: List[Finding] = []
+        deadline = time.time() - self.temp_age
+        try:
+            with os.scandir(self.master.TEMP) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_file(follow_symlinks=False) and entry.stat().st_mtime < deadline:
+                            found.append({"problem": "orphan_temp", "path": entry.path})
+                    except FileNotFoundError:
+                        continue
+        except FileNotFoundError:
+            pass
+        return found
+
+    def fsck(self, repair: bool = False) -> Dict[str, int]:
+        """
+        Write every problem found, and how it was repaired when repair is set.
+        The catalog is reconciled with the disk after repairs
+
+        Returns:
+            Dict[str, int]: problems found of every kind, and how many were left unrepaired
+        """
+
+        stats: Dict[str, int] = {"unrepaired": 0}
+        repaired = 0
+
+        def report(findings: List[Finding]) -> None:
+            nonlocal repaired
+            for finding in findings:
+                stats[finding["problem"]] = stats.get(finding["problem"], 0) + 1
+                if repair:
+                    finding["repaired"] = self.repair(finding)
+                    repaired += finding["repaired"] is not None
+                if finding.get("repaired") is None:
+                    stats["unrepaired"] += 1
+                self._write(finding)
+
+        report(self.orphans())
+        for findings, _ in self._scan(inventory=False):
+            report(findings)
+        self.output.flush()
+
+        if repaired:
+            self.master.reconcile()
+        return stats
+
+    def repair(self, finding: Finding) -> Optional[str]:
+        """
+        Returns:
+            Optional[str]: what was done, None if the problem was left as it is
+        """
+
+        problem = finding["problem"]
+        try:
+            if problem == 'orphan_temp':
+                os.remove(finding["path"])
+                return 'removed'
+            if problem == 'empty_shard':
+                os.rmdir(finding["path"])
+                return 'removed'
+            if problem in ('bad_name', 'unexpected'):
+                os.makedirs(self.master.QUARANTINE, exist_ok=True)
+                shutil.move(finding["path"], os.path.join(self.master.QUARANTINE, os.path.basename(finding["path"])))
+                return 'quarantined'
+            with self.master.locks.hold(finding["hash"]):
+                if problem == 'empty':
+                    os.remove(finding["path"])
+                    return 'removed'
+                if problem == 'misplaced':
+                    return self._move_to_shard(finding["path"])
+                if problem == 'duplicate':
+                    return self._drop_copies(finding["hash"], finding["copies"])
+        except FileNotFoundError:
+            return 'gone'
+        except OSError:
+            # e.g. a shard that got a file meanwhile
+            return None
+        return None
+
+    def _move_to_shard(self, path: str) -> str:
+        file_name = os.path.basename(path)
+        tier = os.path.dirname(os.path.dirname(path))
+        target = os.path.join(tier, file_name[:2], file_name)
+        os.makedirs(os.path.dirname(target), exist_ok=True)
+        try:
+            self.master._link(path, target)
+        except FileExistsError:
+            os.remove(path)
+            return 'removed'
+        os.remove(path)
+        return 'moved'
+
+    def _drop_copies(self, hash_string: str, copies: List[Dict[str, Any]]) -> Optional[str]:
+        """
+        Keep the copy with the extension the catalog knows the file by,
+        the fastest one if there are several. Packed copies are never dropped
+        """
+
+        record = self.master.catalog.get(hash_string)
+        if record is None:
+            return None
+        kept = next((copy for copy in copies if copy["extension"] == record.extension), None)
+        if kept is None:
+            return None
+        for copy in copies:
+            if copy is not kept and copy["path"] is not None:
+                os.remove(copy["path"])
+        return 'removed'
@@ -1,14 +1,35 @@
+import gc
+import io
 import os
-from functools import partial, wraps
-
-
+import time
+import logging
 import shutil
+import tempfile
+import threading
+
 from werkzeug.datastructures import FileStorage
 from werkzeug.utils import secure_filename
 
-from config import STORAGE_DIR, TEMP_DIR, HASHING_METHOD, READING_FILE_BUF_SIZE
+from .catalog import Catalog, ObjectRecord
+from .oplog import OperationLog
+from .packs import PackStore
+from utils.background import PeriodicTask
+from utils.bloom import CountingBloomFilter
+from utils.iopolicy import CachingWriter, io_samples
+from utils.latency import write_latency
+from utils.locks import HashLocks
+from utils.metrics import metrics
+from config import (STORAGE_DIR, TEMP_DIR, QUARANTINE_DIR, PACKS_DIR, COLD_STORAGE_DIRS, HASHING_METHOD, READING_FILE_BUF_SIZE,
+                    DEFAULT_TENANT, QUOTA_TOTAL, QUOTA_TENANT, QUOTA_TENANTS, QUOTA_RECONCILE_INTERVAL,
+                    PACK_THRESHOLD, PACK_COMPACT_INTERVAL, OPLOG_TRIM_INTERVAL, BLOOM_CAPACITY, BLOOM_ERROR_RATE,
+                    INDEX_VALIDATE_BATCH, INDEX_VALIDATE_PAUSE, LOCK_STRIPES)
 
-from typing import Tuple, Callable, Any, List
+from typing import Tuple, List, Iterator, Optional, BinaryIO
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
 
 
 class EmptyFileException(Exception):
@@ -21,34 +42,277 @@ class EmptyFileException(Exception):
         super().__init__()
 
 
-def check_directory_exists(f: Callable, dirs: List[str]) -> Callable:
+class HashMismatchException(Exception):
+    """
+    Raised if a stored file doesn't match the hash the client expected
     """
-    Decorator that checks every directory in passed dirs and create any
-    that doesn't exist
 
-    f: Callable - funciton to be decotared
-    dirs: List[str] - list of directories to be checked
+    def __init__(self, expected: str):
+        self.message = f"File doesn't match the expected hash {expected}"
+        super().__init__(self.message)
+
+
+class QuotaExceededException(Exception):
+    """
+    Raised if storing a file would exceed the global or the tenant's quota
     """
 
-    @wraps(f)
-    def wrapper(*args: Any, **kw: Any) -> Any:
-        for d in dirs:
-            if not os.path.exists(d):
-                os.mkdir(d)
-        return f(*args, **kw)
-    return wrapper
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(message)
 
 
 class StorageMaster(object):
     """
     Class to operate file-related process
     Stores, receives and deletes files in directory
-    defined in cls.STORAGE
+    defined in cls.STORAGE, or in one of slower cls.COLD_STORAGE
+    directories they were moved to.
+
+    The catalog, the operation log, packs and the existence filter are kept
+    in memory, so a storage is changed by a single process, see claim().
+    Everything that changes a stored file is done holding the lock of its hash,
+    which excludes other threads and offline tools working on the storage.
+    Directories are created by load(), the rest only tries and handles failure
+    instead of checking first.
     """
 
     STORAGE: str = STORAGE_DIR
+    COLD_STORAGE: List[str] = COLD_STORAGE_DIRS
     TEMP: str = TEMP_DIR
-    check_directory_decorator: Callable = partial(check_directory_exists, dirs=[STORAGE, TEMP])
+    QUARANTINE: str = QUARANTINE_DIR
+    catalog: Catalog = Catalog(STORAGE)
+    oplog: OperationLog = OperationLog(STORAGE)
+    packs: PackStore = PackStore(PACKS_DIR)
+    locks: HashLocks = HashLocks(os.path.join(STORAGE, '.locks'), LOCK_STRIPES)
+    reconciler: Optional[PeriodicTask] = None
+    compactor: Optional[PeriodicTask] = None
+    trimmer: Optional[PeriodicTask] = None
+    # process that claimed the storage and the descriptor of its lock
+    owner_pid: Optional[int] = None
+    _owner_fd: Optional[int] = None
+
+    # Filter over every stored hash, trusted with negative answers
+    # only once the catalog is known to list every stored file
+    known: CountingBloomFilter = CountingBloomFilter(1)
+    known_complete: bool = False
+    _known_lock: threading.Lock = threading.Lock()
+    _known_changes: Optional[List[Tuple[bool, str]]] = None
+
+    @classmethod
+    def load(cls, read_only: bool = False) -> bool:
+        """
+        Create the storage directories, restore the catalog and the operation log.
+        With read_only nothing is created or repaired, for tools looking at the storage of a running daemon
+
+        Returns:
+            bool: False if there was no catalog to restore
+        """
+
+        if not read_only:
+            for directory in [cls.TEMP, *cls.tiers()]:
+                os.makedirs(directory, exist_ok=True)
+        cls.oplog.load(read_only)
+        cls.packs.load(read_only)
+        return cls.catalog.load()
+
+    @classmethod
+    def claim(cls) -> None:
+        """
+        Take the storage for this process, until it exits
+
+        Raises:
+            RuntimeError: If another process has it
+        """
+
+        if cls.owner_pid == os.getpid() or fcntl is None:
+            return
+        os.makedirs(cls.STORAGE, exist_ok=True)
+        fd = os.open(os.path.join(cls.STORAGE, '.owner.lock'), os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            os.close(fd)
+            raise RuntimeError(f'{cls.STORAGE} is used by another process, '
+                               'a storage is changed by one process only') from None
+        cls._owner_fd, cls.owner_pid = fd, os.getpid()
+
+    @classmethod
+    def _check_owner(cls) -> None:
+        """
+        Forked children inherit the claim but not the state of the storage
+        """
+
+        if cls.owner_pid is not None and cls.owner_pid != os.getpid():
+            raise RuntimeError(f'{cls.STORAGE} was claimed by process {cls.owner_pid}, '
+                               'it can\'t be changed by a forked worker')
+
+    @classmethod
+    def setup(cls) -> None:
+        """
+        Restore the storage and start periodic reconciliation of the catalog.
+        Safe to call more than once
+        """
+
+        if cls.reconciler is not None:
+            return
+
+        cls.claim()
+        # A store without a catalog is reconciled right away,
+        # a restored one is checked in the background while serving
+        restored = cls.load()
+        # records of the catalog live as long as the daemon, keep the collector from walking them
+        gc.freeze()
+        cls.reconciler = PeriodicTask('catalog-reconciler', QUOTA_RECONCILE_INTERVAL, cls.reconcile,
+                                      delay=None if restored else 0)
+        cls.reconciler.start()
+        if restored:
+            threading.Thread(target=cls.warm_up, name='catalog-warm-up', daemon=True).start()
+        cls.compactor = PeriodicTask('pack-compactor', PACK_COMPACT_INTERVAL, cls.packs.compact)
+        cls.compactor.start()
+        cls.trimmer = PeriodicTask('oplog-trimmer', OPLOG_TRIM_INTERVAL, cls.oplog.trim, delay=0)
+        cls.trimmer.start()
+        metrics.register('storage', cls.usage_samples)
+        metrics.register('oplog', lambda: [('oplog_last_seq', {}, cls.oplog.last_seq),
+                                           ('oplog_first_seq', {}, cls.oplog.first_seq)])
+        metrics.register('io', io_samples)
+
+    @classmethod
+    def reconcile(cls) -> dict:
+        stats = cls.catalog.reconcile(((h, e.extension, e.size) for h, e in cls.packs.items()), cls.COLD_STORAGE)
+        cls.rebuild_known(complete=True)
+        return stats
+
+    @classmethod
+    def warm_up(cls) -> None:
+        """
+        Build the existence filter and validate the restored catalog
+        """
+
+        cls.rebuild_known(complete=True)
+        cls.validate()
+
+    @classmethod
+    def validate(cls, batch_size: int = INDEX_VALIDATE_BATCH, pause: float = INDEX_VALIDATE_PAUSE) -> int:
+        """
+        Check the catalog snapshot against its checksum and then every record against the disk,
+        batch_size records at a time. A corrupted snapshot is replaced by a walk over the storage
+
+        Returns:
+            int: records of files missing on the disk that were dropped
+        """
+
+        if not cls.catalog.verify():
+            metrics.inc('catalog_snapshot_corrupted')
+            logging.getLogger('file').error('Catalog snapshot is corrupted, reconciling with the disk')
+            cls.reconcile()
+            return 0
+
+        missing = 0
+        hashes = list(cls.catalog.records)
+        for start in range(0, len(hashes), batch_size):
+            for hash_string in hashes[start:start + batch_size]:
+                record = cls.catalog.get(hash_string)
+                if record is None or hash_string in cls.packs:
+                    continue
+                if os.path.exists(cls.path(record.file_name)):
+                    continue
+                # it could be moving between tiers, or saved again meanwhile
+                with cls.locks.hold(hash_string):
+                    record = cls.catalog.get(hash_string)
+                    if record is None or hash_string in cls.packs or os.path.exists(cls.path(record.file_name)):
+                        continue
+                    cls.forget(hash_string)
+                missing += 1
+            time.sleep(pause)
+
+        metrics.inc('catalog_records_missing', missing)
+        return missing
+
+    @classmethod
+    def rebuild_known(cls, complete: bool) -> None:
+        """
+        Build the existence filter from the catalog.
+        Saves and deletes made while building are replayed on the new filter
+        """
+
+        with cls._known_lock:
+            cls._known_changes = []
+        hashes = list(cls.catalog.records)
+        known = CountingBloomFilter.build(hashes, max(BLOOM_CAPACITY, 2 * len(hashes)), BLOOM_ERROR_RATE)
+        with cls._known_lock:
+            # changes made before the catalog was listed are in hashes already,
+            # and a key that isn't in the filter must never be removed from it
+            present = set(hashes) if cls._known_changes else None
+            for added, hash_string in cls._known_changes:
+                if added and hash_string not in present:
+                    known.add(hash_string)
+                    present.add(hash_string)
+                elif not added and hash_string in present:
+                    known.remove(hash_string)
+                    present.discard(hash_string)
+            cls.known, cls._known_changes = known, None
+            cls.known_complete = cls.known_complete or complete
+
+    @classmethod
+    def _remember(cls, hash_string: str, added: bool) -> None:
+        """
+        Keep the existence filter in line with the catalog.
+        Only hashes the catalog had a record of are removed
+        """
+
+        with cls._known_lock:
+            (cls.known.add if added else cls.known.remove)(hash_string)
+            if cls._known_changes is not None:
+                cls._known_changes.append((added, hash_string))
+
+    @classmethod
+    def exists(cls, hash_string: str) -> bool:
+        """
+        Whether a file is stored.
+        Most of missing hashes are answered by the filter without touching the disk
+        """
+
+        if cls.known_complete and hash_string not in cls.known:
+            metrics.inc('exists_filtered')
+            return False
+        return cls.get(hash_string) is not None
+
+    @classmethod
+    def usage_samples(cls) -> Iterator[Tuple[str, dict, float]]:
+        yield 'storage_bytes', {}, cls.catalog.total
+        yield 'storage_objects', {}, len(cls.catalog)
+        yield 'storage_packed_objects', {}, len(cls.packs)
+        for tenant, used in list(cls.catalog.usage.items()):
+            yield 'storage_tenant_bytes', {"tenant": tenant}, used
+
+    @classmethod
+    def check_quota(cls, tenant: str, size: int) -> None:
+        """
+        Raises QuotaExceededException if size more bytes
+        don't fit into the global or the tenant's quota
+        """
+
+        if QUOTA_TOTAL and cls.catalog.total + size > QUOTA_TOTAL:
+            raise QuotaExceededException("Storage is full")
+
+        quota = QUOTA_TENANTS.get(tenant, QUOTA_TENANT)
+        if quota and cls.catalog.usage.get(tenant, 0) + size > quota:
+            raise QuotaExceededException("Storage quota exceeded")
+
+    @classmethod
+    def quota_left(cls, tenant: str) -> Optional[int]:
+        """
+        Bytes the tenant can still store, None if neither quota is set
+        """
+
+        left = []
+        if QUOTA_TOTAL:
+            left.append(QUOTA_TOTAL - cls.catalog.total)
+        quota = QUOTA_TENANTS.get(tenant, QUOTA_TENANT)
+        if quota:
+            left.append(quota - cls.catalog.usage.get(tenant, 0))
+        return max(min(left), 0) if left else None
 
     @staticmethod
     def check_file_is_not_empty(f: FileStorage) -> None:
@@ -56,44 +320,59 @@ class StorageMaster(object):
         Raises EmptyFileException if file is empty
         """
 
+        # Streams that can't seek back, like files fetched
+        # from another daemon, come with a buffered reader
+        if hasattr(f.stream, 'peek'):
+            if not f.stream.peek(1):
+                raise EmptyFileException()
+            return
+
         if f.stream.read(1) == b'':
             raise EmptyFileException()
         f.stream.seek(0)
 
     @classmethod
-    def _save_file_on_disk(cls, f: FileStorage) -> str:
+    def _save_file_on_disk(cls, f: FileStorage) -> Tuple[str, str]:
         """
-        Save file to temp directory and compute its hash at the same stream
+        Save file to temp directory and compute its hash at the same stream.
+        Every upload gets a temp file of its own, even uploads of the same name
 
         Args:
             f: FileStorage - file to be stored
         Returns:
-            str - computed hash
+            Tuple[str, str] - computed hash and path of the temp file
         """
 
         f.filename = secure_filename(f.filename)
         hash_instance = HASHING_METHOD()
         hash_instance.update(f.filename.encode('utf-8'))
-        temp_path = os.path.join(cls.TEMP, f.filename)
-        with open(temp_path, "wb", buffering=READING_FILE_BUF_SIZE, closefd=True) as out_file:
-
-            while True:
-                data = f.stream.read(READING_FILE_BUF_SIZE)
-                if not data:
-                    break
-                hash_instance.update(data)
-                out_file.write(data)
-
-        return hash_instance.hexdigest()
+        fd, temp_path = tempfile.mkstemp(suffix=os.path.splitext(f.filename)[1], dir=cls.TEMP)
+        try:
+            with CachingWriter(fd) as out_file:
+
+                while True:
+                    data = f.stream.read(READING_FILE_BUF_SIZE)
+                    if not data:
+                        break
+                    hash_instance.update(data)
+                    started = time.monotonic()
+                    out_file.write(data)
+                    # a full disk queue shows up here first, admission control watches it
+                    write_latency.add(time.monotonic() - started)
+        except BaseException:
+            os.remove(temp_path)
+            raise
+
+        return hash_instance.hexdigest(), temp_path
 
     @classmethod
-    def _move_file_from_temp(cls, temp_path: str, hash_string: str) -> None:
-        """Rename file given in temp_path and
-        move it to its permanent storage defined in hash_string
+    def _move_file_from_temp(cls, temp_path: str, file_name: str) -> None:
+        """Link file given in temp_path into its permanent storage
+        and remove it from temp directory. Called holding the lock of the hash
 
         Args:
             temp_path (type): full path to file saved in temp directory
-            hash_string (type): computed hash of the file
+            file_name (type): hash and extension of the file
 
         Returns:
             None
@@ -102,79 +381,282 @@ class StorageMaster(object):
             FileExistsError: If file with such name is already exists
 
         """
-        directory = os.path.join(cls.STORAGE, hash_string[:2])
-
-        if not os.path.exists(directory):
-            os.mkdir(directory)
-
-        file_extension = os.path.splitext(temp_path)[1]
-        hashed_path = os.path.join(directory, hash_string + file_extension)
 
+        hashed_path = os.path.join(cls.STORAGE, file_name[:2], file_name)
         try:
-            if not os.path.exists(hashed_path):
-                shutil.move(temp_path, hashed_path)
-            else:
+            # slower tiers are only looked at when there are any
+            if cls.COLD_STORAGE and os.path.exists(cls.path(file_name)):
                 raise FileExistsError()
+            for attempt in (1, 2):
+                try:
+                    cls._link(temp_path, hashed_path)
+                    return
+                except FileNotFoundError:
+                    # first file of the shard, or the shard was just removed by a delete
+                    if attempt == 2:
+                        raise
+                    os.makedirs(os.path.dirname(hashed_path), exist_ok=True)
         finally:
-            if os.path.exists(temp_path):
+            try:
                 os.remove(temp_path)
+            except FileNotFoundError:
+                pass
 
+    @staticmethod
+    def _link(source: str, target: str) -> None:
+        """
+        Make source available as target unless target exists, in one syscall
+
+        Raises:
+            FileExistsError: If target exists
+        """
+
+        try:
+            os.link(source, target)
+        except (FileExistsError, FileNotFoundError):
+            raise
+        except OSError:
+            # no hard links on this file system, claim the name first
+            os.close(os.open(target, os.O_WRONLY | os.O_CREAT | os.O_EXCL, 0o644))
+            os.replace(source, target)
 
     @classmethod
-    @check_directory_decorator
-    def save(cls, f: FileStorage) -> str:
+    def save(cls, f: FileStorage, tenant: str = DEFAULT_TENANT, expected_hash: Optional[str] = None,
+             expires: float = 0) -> str:
         """
         Save user's file and returns its hash
 
         Args:
             f (FileStorage): User's file
+            tenant (str): Owner of the file whose quota it's counted against
+            expected_hash (str): Hash the client computed, if any
+            expires (float): Unix time the file is deleted at, 0 means never
 
         Returns:
             str: computed hash
 
         Raises:
-            EmptyFileException, FileExistsError, PermissionError
+            EmptyFileException, FileExistsError, PermissionError,
+            QuotaExceededException, HashMismatchException
         """
 
         cls.check_file_is_not_empty(f)
-        hash_string = cls._save_file_on_disk(f)
-        temp_path = os.path.join(cls.TEMP, f.filename)
-        cls._move_file_from_temp(temp_path, hash_string)
+        hash_string, temp_path = cls._save_file_on_disk(f)
+
+        if expected_hash is not None and hash_string != expected_hash:
+            os.remove(temp_path)
+            raise HashMismatchException(expected_hash)
+
+        # Content-Length is checked before the upload,
+        # but chunked bodies are only known now
+        size = os.path.getsize(temp_path)
+        try:
+            cls.check_quota(tenant, size)
+        except QuotaExceededException:
+            os.remove(temp_path)
+            raise
+
+        cls.commit(temp_path, ObjectRecord(hash_string, os.path.splitext(f.filename)[1], size,
+                                           tenant, f.filename, expires))
 
         return hash_string
 
     @classmethod
-    @check_directory_decorator
+    def commit(cls, temp_path: str, record: ObjectRecord) -> None:
+        """
+        Move a fully written and hashed temp file to the storage
+        and record it in the catalog and the operation log
+
+        Raises:
+            FileExistsError: If file with such name is already exists
+        """
+
+        cls._check_owner()
+        with cls.locks.hold(record.hash):
+            if record.size < PACK_THRESHOLD:
+                try:
+                    if cls.get(record.hash) is not None:
+                        raise FileExistsError()
+                    with open(temp_path, 'rb') as f:
+                        cls.packs.put(record.hash, record.extension, f.read())
+                finally:
+                    os.remove(temp_path)
+            else:
+                cls._move_file_from_temp(temp_path, record.file_name)
+            cls.catalog.add(record)
+            cls._remember(record.hash, True)
+            cls.oplog.append('save', **record.dump())
+
+    @classmethod
     def get(cls, hash_string: str) -> str:
         """
         Get subdirectory and full filename if one is found
         """
 
-        seek_directory = os.path.join(cls.STORAGE, hash_string[:2])
+        packed = cls.packs.entries.get(hash_string)
+        if packed is not None:
+            return hash_string + packed.extension
 
-        if os.path.exists(seek_directory):
-            for full_filename in os.listdir(seek_directory):
+        for tier in cls.tiers():
+            try:
+                file_names = os.listdir(os.path.join(tier, hash_string[:2]))
+            except FileNotFoundError:
+                continue
+            for full_filename in file_names:
                 filename, extension = os.path.splitext(full_filename)
                 if filename == hash_string:
                     return full_filename
         return None
 
     @classmethod
-    @check_directory_decorator
+    def tiers(cls) -> List[str]:
+        """
+        Storage directories from the fastest to the slowest
+        """
+
+        return [cls.STORAGE] + list(cls.COLD_STORAGE)
+
+    @classmethod
+    def path(cls, file_name: str) -> str:
+        """
+        Full path of a stored file in the first tier that has it,
+        or where a new file goes if none does.
+        Packed files have none, see open()
+        """
+
+        if cls.COLD_STORAGE:
+            for tier in cls.tiers():
+                path = os.path.join(tier, file_name[:2], file_name)
+                if os.path.exists(path):
+                    return path
+        return os.path.join(cls.STORAGE, file_name[:2], file_name)
+
+    @classmethod
+    def tier_of(cls, path: str) -> int:
+        return next((i for i, tier in enumerate(cls.tiers())
+                     if os.path.dirname(os.path.dirname(path)) == tier), 0)
+
+    @classmethod
+    def relocate(cls, file_name: str, tier: int) -> bool:
+        """
+        Move a stored file to another tier.
+        It's copied first, so tiers can be different devices
+
+        Returns:
+            bool: False if the file is gone or it's in the tier already
+        """
+
+        source = cls.path(file_name)
+        directory = os.path.join(cls.tiers()[tier], file_name[:2])
+        target = os.path.join(directory, file_name)
+        if source == target or not os.path.exists(source):
+            return False
+
+        os.makedirs(directory, exist_ok=True)
+        # dot files are never looked up
+        moving = os.path.join(directory, '.' + file_name + '.moving')
+        try:
+            with open(source, 'rb') as in_file, open(moving, 'wb') as out_file:
+                shutil.copyfileobj(in_file, out_file, READING_FILE_BUF_SIZE)
+                out_file.flush()
+                os.fsync(out_file.fileno())
+
+            with cls.locks.hold(os.path.splitext(file_name)[0]):
+                if not os.path.exists(source):
+                    # deleted while copying
+                    return False
+                os.replace(moving, target)
+                os.remove(source)
+        finally:
+            if os.path.exists(moving):
+                os.remove(moving)
+
+        try:
+            os.rmdir(os.path.dirname(source))
+        except OSError:
+            # shard is not empty
+            pass
+        return True
+
+    @classmethod
+    def open(cls, file_name: str) -> BinaryIO:
+        """
+        Open a stored file for reading whichever tier it's in
+
+        Raises:
+            FileNotFoundError: If file is not stored
+        """
+
+        hash_string = os.path.splitext(file_name)[0]
+        if hash_string in cls.packs:
+            data = cls.packs.read(hash_string)
+            if data is not None:
+                return io.BytesIO(data)
+        return open(cls.path(file_name), 'rb')
+
+    @classmethod
+    def forget(cls, hash_string: str) -> None:
+        """
+        Drop the record of a file that is gone from the disk
+        """
+
+        if cls.catalog.remove(hash_string) is not None:
+            cls._remember(hash_string, False)
+            cls.oplog.append('delete', hash=hash_string)
+
+    @classmethod
+    def quarantine(cls, file_name: str) -> str:
+        """
+        Move a stored file out of the storage so it's never served again
+
+        Returns:
+            str: new path of the file
+        """
+
+        os.makedirs(cls.QUARANTINE, exist_ok=True)
+        quarantined_path = os.path.join(cls.QUARANTINE, file_name)
+        hash_string = os.path.splitext(file_name)[0]
+        with cls.locks.hold(hash_string):
+            if hash_string in cls.packs:
+                with cls.open(file_name) as f, open(quarantined_path, 'wb') as out_file:
+                    out_file.write(f.read())
+                cls.packs.delete(hash_string)
+            else:
+                shutil.move(cls.path(file_name), quarantined_path)
+            if cls.catalog.remove(hash_string) is not None:
+                cls._remember(hash_string, False)
+            cls.oplog.append('delete', hash=hash_string)
+        return quarantined_path
+
+    @classmethod
     def delete(cls, file_name: str) -> None:
         """
         Deletes file if one is found.
         If it's the last file in the directory it wiil be cleared too
         """
 
-        if not os.path.isabs(file_name):
-            file_path = os.path.join(cls.STORAGE, file_name[:2], file_name)
-        else:
-            file_path = file_name
+        cls._check_owner()
+        hash_string = os.path.splitext(os.path.basename(file_name))[0]
+        with cls.locks.hold(hash_string):
+            if cls.packs.delete(hash_string) is not None:
+                if cls.catalog.remove(hash_string) is not None:
+                    cls._remember(hash_string, False)
+                cls.oplog.append('delete', hash=hash_string)
+                return
+
+            file_path = file_name if os.path.isabs(file_name) else cls.path(file_name)
+            try:
+                os.remove(file_path)
+            except FileNotFoundError:
+                # deleted by someone else
+                return
+
+            if cls.catalog.remove(hash_string) is not None:
+                cls._remember(hash_string, False)
+            cls.oplog.append('delete', hash=hash_string)
 
-        # double check
-        if os.path.exists(file_path):
-            os.remove(file_path)
-            directory = os.path.dirname(file_path)
-            if not os.listdir(directory):
-                os.rmdir(directory)
+        try:
+            os.rmdir(os.path.dirname(file_path))
+        except OSError:
+            # shard is not empty
+            pass
@@ -0,0 +1,180 @@
+import os
+import json
+import time
+import threading
+from array import array
+
+from typing import Any, BinaryIO, Dict, List, Optional
+
+from config import OPLOG_FSYNC, OPLOG_KEEP_ENTRIES
+
+
+class OperationLog(object):
+    """
+    Durable log of every save and delete, numbered from 1.
+    Followers read it from the sequence number they applied last.
+    Only the last keep entries are kept, see trim()
+
+    Offsets of entries are kept in memory once it's read the first time,
+    so reading from any sequence number is a single seek
+    """
+
+    CHUNK_SIZE = 4 * 2 ** 20  # 4mb
+
+    FILE = '.oplog'
+
+    def __init__(self, root: str, fsync: bool = OPLOG_FSYNC, keep: int = OPLOG_KEEP_ENTRIES):
+        self.path = os.path.join(root, self.FILE)
+        self.fsync = fsync
+        self.keep = keep
+        # sequence number of the first entry in the file
+        self.first_seq = 1
+        self.last_seq = 0
+        self.loaded = False
+        self._offsets: Optional[array] = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _load(self, read_only: bool = False) -> None:
+        """
+        Count entries, offsets are found on the first read.
+        A torn write at the end is truncated unless read_only is set,
+        the log may belong to a running daemon writing it then
+        """
+
+        self._offsets = None
+        self.first_seq = 1
+        count, offset, end = 0, 0, 0
+        if os.path.exists(self.path):
+            with open(self.path, 'rb') as f:
+                first = f.readline()
+                if first.endswith(b'\n'):
+                    self.first_seq = json.loads(first)["seq"]
+                f.seek(0)
+                for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                    lines = chunk.count(b'\n')
+                    if lines:
+                        count += lines
+                        end = offset + chunk.rfind(b'\n') + 1
+                    offset += len(chunk)
+            # drop a torn write at the end
+            if end != offset and not read_only:
+                with open(self.path, 'r+b') as f:
+                    f.truncate(end)
+        self.last_seq = self.first_seq - 1 + count
+        self.loaded = True
+
+    def _index(self) -> array:
+        if self._offsets is None:
+            offsets = array('Q')
+            offset = 0
+            if self._file is not None:
+                self._file.flush()
+            if os.path.exists(self.path):
+                with open(self.path, 'rb') as f:
+                    for line in f:
+                        offsets.append(offset)
+                        offset += len(line)
+            self._offsets = offsets
+        return self._offsets
+
+    def load(self, read_only: bool = False) -> None:
+        with self._lock:
+            self._load(read_only)
+
+    def append(self, op: str, **fields: Any) -> int:
+        """
+        Write an operation and return its sequence number
+        """
+
+        with self._lock:
+            if not self.loaded:
+                self._load()
+            if self._file is None:
+                self._file = open(self.path, 'ab')
+
+            seq = self.last_seq + 1
+            line = json.dumps({"seq": seq, "op": op, "time": time.time(), **fields}).encode('utf-8') + b'\n'
+            offset = self._file.tell()
+            self._file.write(line)
+            self._file.flush()
+            if self.fsync:
+                os.fsync(self._file.fileno())
+
+            if self._offsets is not None:
+                self._offsets.append(offset)
+            self.last_seq = seq
+            return seq
+
+    def read(self, since: int = 0, limit: int = 1000) -> List[Dict[str, Any]]:
+        """
+        Entries following the since sequence number.
+        Entries trimmed away are skipped, the first one returned tells it
+        """
+
+        with self._lock:
+            if not self.loaded:
+                self._load()
+            if since >= self.last_seq:
+                return []
+            since = max(since, self.first_seq - 1)
+            offset = self._index()[since - self.first_seq + 1]
+            count = min(limit, self.last_seq - since)
+            # opened with the lock, trim() may replace the file the offset is of
+            f = open(self.path, 'rb')
+
+        entries = []
+        with f:
+            f.seek(offset)
+            for _ in range(count):
+                entries.append(json.loads(f.readline()))
+        return entries
+
+    def trim(self) -> int:
+        """
+        Drop all but the last keep entries. Entries are copied
+        to a new file while saves go on, only the tail is copied holding the lock
+
+        Returns:
+            int: entries dropped
+        """
+
+        with self._lock:
+            if not self.loaded:
+                self._load()
+            dropped = self.last_seq - self.first_seq + 1 - self.keep
+            if not self.keep or dropped <= 0:
+                return 0
+            if self._file is not None:
+                self._file.flush()
+            start = self._index()[dropped]
+            end = os.path.getsize(self.path)
+
+        temp_path = self.path + '.tmp'
+        with open(self.path, 'rb') as source, open(temp_path, 'wb') as target:
+            source.seek(start)
+            self._copy(source, target, end - start)
+
+            with self._lock:
+                if self._file is not None:
+                    self._file.flush()
+                self._copy(source, target, None)
+                target.flush()
+                if self.fsync:
+                    os.fsync(target.fileno())
+                os.replace(temp_path, self.path)
+                if self._file is not None:
+                    self._file.close()
+                    self._file = None
+                self.first_seq += dropped
+                self._offsets = None
+        return dropped
+
+    def _copy(self, source: BinaryIO, target: BinaryIO, size: Optional[int]) -> None:
+        while size is None or size > 0:
+            chunk = source.read(self.CHUNK_SIZE if size is None else min(size, self.CHUNK_SIZE))
+            if not chunk:
+                return
+            target.write(chunk)
+            if size is not None:
+                size -= len(chunk)
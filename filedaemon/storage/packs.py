@@ -0,0 +1,267 @@
+import os
+import json
+import threading
+
+from typing import Dict, Iterator, List, Optional, Tuple
+from attr import dataclass
+
+from config import OPLOG_FSYNC, PACK_FILE_SIZE, PACK_COMPACT_RATIO
+
+
+@dataclass(slots=True)
+class PackEntry(object):
+    """
+    Where a packed file lives
+    """
+
+    pack: int
+    offset: int
+    size: int
+    extension: str
+
+
+class PackStore(object):
+    """
+    Small files appended to large append-only pack files.
+
+    Saves one inode, one disk block and one directory entry per file.
+    The offset index is an append-only journal loaded in memory,
+    so looking a file up never touches the disk and reading it is a single pread.
+    Space of deleted files is reclaimed by compact().
+
+    With fsync the pack is synced before its index entry is written and the index after,
+    otherwise entries pointing past the end of their pack are dropped on load.
+
+    Appends, deletes and compaction take turns holding the write lock, the state lock
+    is only held to look an entry up or swap one, so reads never wait for disk writes.
+    Descriptors of packs dropped by compaction are closed by the next one,
+    a read that looked its entry up before the drop still gets its data
+    """
+
+    INDEX = 'packs.idx'
+
+    def __init__(self, root: str, pack_size: int = PACK_FILE_SIZE, compact_ratio: float = PACK_COMPACT_RATIO,
+                 fsync: bool = OPLOG_FSYNC):
+        self.root = root
+        self.pack_size = pack_size
+        self.compact_ratio = compact_ratio
+        self.fsync = fsync
+        self.index_path = os.path.join(root, self.INDEX)
+        self.entries: Dict[str, PackEntry] = {}
+        self.dead: Dict[int, int] = {}  # bytes of deleted files per pack
+        self.current = 1
+        self.loaded = False
+        self._fds: Dict[int, int] = {}
+        self._retired: List[int] = []
+        self._index = None
+        self._lock = threading.RLock()
+        self._write_lock = threading.RLock()
+
+    def __contains__(self, hash_string: str) -> bool:
+        return hash_string in self.entries
+
+    def __len__(self) -> int:
+        return len(self.entries)
+
+    def pack_path(self, pack: int) -> str:
+        return os.path.join(self.root, f'pack-{pack:06d}.dat')
+
+    def _fd(self, pack: int) -> int:
+        fd = self._fds.get(pack)
+        if fd is None:
+            fd = self._fds[pack] = os.open(self.pack_path(pack), os.O_RDWR | os.O_CREAT | os.O_APPEND, 0o644)
+        return fd
+
+    def _retire(self, pack: int) -> None:
+        fd = self._fds.pop(pack, None)
+        if fd is not None:
+            self._retired.append(fd)
+
+    def _write_index(self, entry: Dict) -> None:
+        if self._index is None:
+            self._index = open(self.index_path, 'a', encoding='utf-8')
+        self._index.write(json.dumps(entry) + '\n')
+        self._index.flush()
+        if self.fsync:
+            os.fsync(self._index.fileno())
+
+    def _apply(self, entry: Dict) -> None:
+        if entry['op'] == '+':
+            self._drop(entry['hash'])
+            self.entries[entry['hash']] = PackEntry(entry['pack'], entry['offset'], entry['size'], entry['extension'])
+            self.current = max(self.current, entry['pack'])
+        else:
+            self._drop(entry['hash'])
+
+    def _drop(self, hash_string: str) -> Optional[PackEntry]:
+        entry = self.entries.pop(hash_string, None)
+        if entry is not None:
+            self.dead[entry.pack] = self.dead.get(entry.pack, 0) + entry.size
+        return entry
+
+    def load(self, read_only: bool = False) -> None:
+        """
+        Restore the index, read_only doesn't create the directory of packs
+        """
+
+        with self._write_lock, self._lock:
+            if not read_only:
+                os.makedirs(self.root, exist_ok=True)
+            self.entries, self.dead, self.current = {}, {}, 1
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'r', encoding='utf-8') as lines:
+                    for line in lines:
+                        try:
+                            self._apply(json.loads(line))
+                        except ValueError:
+                            continue
+
+            sizes: Dict[int, int] = {}
+            for name in (os.listdir(self.root) if os.path.isdir(self.root) else ()):
+                if name.startswith('pack-') and name.endswith('.dat'):
+                    pack = int(name[5:-4])
+                    self.current = max(self.current, pack)
+                    sizes[pack] = os.path.getsize(os.path.join(self.root, name))
+
+            # the index got to the disk and the data of the pack didn't
+            for hash_string, entry in list(self.entries.items()):
+                if entry.offset + entry.size > sizes.get(entry.pack, 0):
+                    del self.entries[hash_string]
+
+            # whatever isn't live in a pack is dead
+            live: Dict[int, int] = {}
+            for entry in self.entries.values():
+                live[entry.pack] = live.get(entry.pack, 0) + entry.size
+            self.dead = {}
+            for pack, size in sizes.items():
+                if size - live.get(pack, 0):
+                    self.dead[pack] = size - live.get(pack, 0)
+            self.loaded = True
+
+    def _ensure_loaded(self) -> None:
+        if not self.loaded:
+            self.load()
+
+    def put(self, hash_string: str, extension: str, data: bytes) -> PackEntry:
+        """
+        Append a file to the current pack
+
+        Raises:
+            FileExistsError: If the file is already packed
+        """
+
+        with self._write_lock:
+            self._ensure_loaded()
+            if hash_string in self.entries:
+                raise FileExistsError()
+            entry = self._append(hash_string, extension, data)
+            with self._lock:
+                self.entries[hash_string] = entry
+            return entry
+
+    def _append(self, hash_string: str, extension: str, data: bytes) -> PackEntry:
+        """
+        Write data and its index entry holding the write lock, the caller makes it visible
+        """
+
+        with self._lock:
+            fd = self._fd(self.current)
+        offset = os.fstat(fd).st_size
+        if offset and offset + len(data) > self.pack_size:
+            with self._lock:
+                self.current += 1
+                fd = self._fd(self.current)
+            offset = 0
+
+        written = 0
+        while written < len(data):
+            written += os.write(fd, data[written:])
+        if self.fsync:
+            os.fsync(fd)
+        entry = PackEntry(self.current, offset, len(data), extension)
+        self._write_index({"op": "+", "hash": hash_string, "pack": entry.pack, "offset": offset,
+                           "size": entry.size, "extension": extension})
+        return entry
+
+    def read(self, hash_string: str) -> Optional[bytes]:
+        self._ensure_loaded()
+        with self._lock:
+            entry = self.entries.get(hash_string)
+            if entry is None:
+                return None
+            fd = self._fd(entry.pack)
+        return os.pread(fd, entry.size, entry.offset)
+
+    def delete(self, hash_string: str) -> Optional[PackEntry]:
+        with self._write_lock:
+            self._ensure_loaded()
+            with self._lock:
+                entry = self._drop(hash_string)
+            if entry is not None:
+                self._write_index({"op": "-", "hash": hash_string})
+            return entry
+
+    def items(self) -> Iterator[Tuple[str, PackEntry]]:
+        self._ensure_loaded()
+        with self._lock:
+            return iter(list(self.entries.items()))
+
+    def compact(self) -> Dict[str, int]:
+        """
+        Copy live files out of packs that are mostly deleted, drop those packs
+        and rewrite the index without deleted entries
+        """
+
+        stats = {"packs": 0, "moved": 0, "reclaimed": 0}
+        with self._write_lock:
+            self._ensure_loaded()
+            # reads looked up before the previous compaction are long done
+            for fd in self._retired:
+                os.close(fd)
+            self._retired = []
+
+            for pack, dead in sorted(self.dead.items()):
+                path = self.pack_path(pack)
+                if pack == self.current or not os.path.exists(path):
+                    continue
+                size = os.path.getsize(path)
+                if not size or dead / size < self.compact_ratio:
+                    continue
+
+                with self._lock:
+                    moving = [(h, e) for h, e in self.entries.items() if e.pack == pack]
+                    fd = self._fd(pack)
+                # files stay readable from the old pack until their copy is swapped in
+                for hash_string, entry in moving:
+                    copy = self._append(hash_string, entry.extension, os.pread(fd, entry.size, entry.offset))
+                    with self._lock:
+                        self.entries[hash_string] = copy
+                    stats["moved"] += 1
+
+                with self._lock:
+                    self._retire(pack)
+                    del self.dead[pack]
+                os.remove(path)
+                stats["packs"] += 1
+                stats["reclaimed"] += dead
+
+            # rewrite the index with live entries only
+            with self._lock:
+                live = list(self.entries.items())
+                fds = list(self._fds.values())
+            temp_path = self.index_path + '.tmp'
+            with open(temp_path, 'w', encoding='utf-8') as index:
+                for hash_string, entry in live:
+                    index.write(json.dumps({"op": "+", "hash": hash_string, "pack": entry.pack,
+                                            "offset": entry.offset, "size": entry.size,
+                                            "extension": entry.extension}) + '\n')
+                index.flush()
+                os.fsync(index.fileno())
+            # every pack the index mentions is synced before it's replaced
+            for fd in fds:
+                os.fsync(fd)
+            if self._index is not None:
+                self._index.close()
+                self._index = None
+            os.replace(temp_path, self.index_path)
+        return stats
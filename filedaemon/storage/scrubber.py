@@ -0,0 +1,208 @@
+import os
+import json
+import mmap
+import time
+import logging
+import threading
+
+from typing import TYPE_CHECKING, Any, Dict, List, Optional, Tuple, Type
+
+from .catalog import is_shard
+from .manager import StorageMaster
+from utils.background import PeriodicTask
+from utils.metrics import metrics
+from utils.ratelimit import TokenBucket
+from config import (HASHING_METHOD, SCRUB_INTERVAL, SCRUB_WORKERS,
+                    SCRUB_BYTES_PER_SECOND, SCRUB_CHECKPOINT)
+
+if TYPE_CHECKING:
+    from concurrent.futures import ProcessPoolExecutor
+
+
+def hash_stored_file(path: str, name: str) -> str:
+    """
+    Compute the hash of a stored file the same way StorageMaster does.
+    Runs in worker processes
+    """
+
+    hash_instance = HASHING_METHOD()
+    hash_instance.update(name.encode('utf-8'))
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+                hash_instance.update(mapped)
+    return hash_instance.hexdigest()
+
+
+class Scrubber(object):
+    """
+    Re-hashes every stored file against its name and quarantines mismatches.
+
+    Shards are scrubbed in order and every finished shard is checkpointed,
+    so a restarted daemon resumes the pass where it stopped.
+    """
+
+    def __init__(self, master: Type[StorageMaster] = StorageMaster, checkpoint_path: str = SCRUB_CHECKPOINT,
+                 workers: int = SCRUB_WORKERS, bytes_per_second: float = SCRUB_BYTES_PER_SECOND):
+        self.master = master
+        self.checkpoint_path = checkpoint_path
+        self.workers = workers
+        self.budget = TokenBucket(bytes_per_second, bytes_per_second) if bytes_per_second else None
+        self.task: Optional[PeriodicTask] = None
+        self.status: Dict[str, Any] = {
+            "running": False,
+            "pass": 0,
+            "shard": None,
+            "checked": 0,
+            "bytes": 0,
+            "mismatches": 0,
+            "unverifiable": 0,
+            "quarantined": [],
+            "last_pass_finished": None,
+        }
+        self._lock = threading.Lock()
+
+    def load_checkpoint(self) -> Dict[str, Any]:
+        try:
+            with open(self.checkpoint_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (FileNotFoundError, ValueError):
+            return {"pass": 0, "shard": None}
+
+    def save_checkpoint(self, pass_number: int, shard: Optional[str]) -> None:
+        temp_path = self.checkpoint_path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump({"pass": pass_number, "shard": shard, "finished": self.status["last_pass_finished"]}, f)
+        os.replace(temp_path, self.checkpoint_path)
+
+    def start(self) -> None:
+        """
+        Scrub every SCRUB_INTERVAL seconds.
+        An interrupted pass is resumed right away
+        """
+
+        if self.task is not None:
+            return
+        checkpoint = self.load_checkpoint()
+        self.status["last_pass_finished"] = checkpoint.get("finished")
+        delay = 0 if checkpoint.get("shard") else SCRUB_INTERVAL
+        self.task = PeriodicTask('scrubber', SCRUB_INTERVAL, self.run, delay=delay)
+        self.task.start()
+
+    def _throttle(self, size: int) -> None:
+        if self.budget is not None and size:
+            delay = self.budget.consume(size)
+            if delay:
+                time.sleep(delay)
+
+    def scrub_shard(self, pool: 'ProcessPoolExecutor', shard: str) -> None:
+        jobs: List[Tuple[str, int, Any]] = []
+
+        entries: List[os.DirEntry] = []
+        for tier in self.master.tiers():
+            try:
+                entries.extend(entry for entry in os.scandir(os.path.join(tier, shard)) if not entry.name.startswith('.'))
+            except FileNotFoundError:
+                continue
+
+        for entry in entries:
+            hash_string = os.path.splitext(entry.name)[0]
+            record = self.master.catalog.get(hash_string)
+            if record is None or not record.name:
+                self.status["unverifiable"] += 1
+                metrics.inc('scrub_unverifiable')
+                continue
+            try:
+                size = entry.stat().st_size
+            except FileNotFoundError:
+                continue
+            self._throttle(size)
+            jobs.append((entry.name, size, pool.submit(hash_stored_file, entry.path, record.name)))
+
+        for file_name, size, job in jobs:
+            try:
+                computed = job.result()
+            except FileNotFoundError:
+                # deleted while we were hashing
+                continue
+            self._verify(file_name, size, computed)
+
+    def scrub_packs(self) -> None:
+        """
+        Packed files are small, they're hashed right here
+        """
+
+        for hash_string, entry in self.master.packs.items():
+            record = self.master.catalog.get(hash_string)
+            if record is None or not record.name:
+                self.status["unverifiable"] += 1
+                metrics.inc('scrub_unverifiable')
+                continue
+            self._throttle(entry.size)
+            data = self.master.packs.read(hash_string)
+            if data is None:
+                continue
+            hash_instance = HASHING_METHOD(record.name.encode('utf-8'))
+            hash_instance.update(data)
+            self._verify(hash_string + entry.extension, entry.size, hash_instance.hexdigest())
+
+    def _verify(self, file_name: str, size: int, computed: str) -> None:
+        self.status["checked"] += 1
+        self.status["bytes"] += size
+        metrics.inc('scrub_objects_checked')
+        metrics.inc('scrub_bytes', size)
+
+        if computed != os.path.splitext(file_name)[0]:
+            self.status["mismatches"] += 1
+            metrics.inc('scrub_mismatches')
+            try:
+                path = self.master.quarantine(file_name)
+            except FileNotFoundError:
+                return
+            self.status["quarantined"] = (self.status["quarantined"] + [file_name])[-100:]
+            logging.getLogger('file').error('Hash mismatch, %s was quarantined to %s', file_name, path)
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Scrub every shard not scrubbed in the current pass yet and then every pack
+        """
+
+        if not self._lock.acquire(blocking=False):
+            return self.status
+
+        try:
+            checkpoint = self.load_checkpoint()
+            pass_number, done = checkpoint.get("pass", 0), checkpoint.get("shard")
+            if not done:
+                self.status.update(checked=0, bytes=0, mismatches=0, unverifiable=0)
+            self.status["running"] = True
+            self.status["pass"] = pass_number
+
+            shards = sorted(set(entry.name for tier in self.master.tiers() for entry in os.scandir(tier)
+                                if is_shard(entry.name) and entry.is_dir()))
+
+            # process pools take a while to import and scrubbing starts long after the daemon
+            import multiprocessing
+            from concurrent.futures import ProcessPoolExecutor
+
+            context = multiprocessing.get_context('spawn')
+            with ProcessPoolExecutor(max_workers=self.workers, mp_context=context) as pool:
+                for shard in shards:
+                    if done is not None and shard <= done:
+                        continue
+                    self.status["shard"] = shard
+                    self.scrub_shard(pool, shard)
+                    self.save_checkpoint(pass_number, shard)
+
+            self.status["shard"] = 'packs'
+            self.scrub_packs()
+
+            self.status.update(shard=None, last_pass_finished=time.time())
+            self.save_checkpoint(pass_number + 1, None)
+            return self.status
+        finally:
+            self.status["running"] = False
+            self._lock.release()
+
+
+scrubber = Scrubber()
@@ -0,0 +1,219 @@
+import io
+import os
+import json
+import time
+import uuid
+import shutil
+import tarfile
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from typing import BinaryIO, Dict, List, Optional, Tuple, Type
+
+from .catalog import ObjectRecord
+from .manager import StorageMaster
+from utils.progress import Progress
+from config import HASHING_METHOD, READING_FILE_BUF_SIZE
+
+
+INDEX = 'index.jsonl'
+OBJECTS = 'objects'
+FORMAT = 1
+TAR_BUF_SIZE = 16 * READING_FILE_BUF_SIZE  # 1mb
+
+
+def _link_objects(master: Type[StorageMaster], snapshot_dir: str) -> List[Tuple[ObjectRecord, Optional[str]]]:
+    """
+    Hard link every catalogued file into snapshot_dir.
+    Links keep files deleted while exporting, that's what makes the snapshot point-in-time.
+    Packed files have no path and are read when they're exported
+    """
+
+    linked = []
+    for record in list(master.catalog.records.values()):
+        if record.hash in master.packs:
+            linked.append((record, None))
+            continue
+        source = master.path(record.file_name)
+        link = os.path.join(snapshot_dir, record.file_name[:2], record.file_name)
+        os.makedirs(os.path.dirname(link), exist_ok=True)
+        try:
+            os.link(source, link)
+        except FileNotFoundError:
+            # deleted before the snapshot
+            continue
+        except OSError:
+            # file system without hard links, read the file in place
+            if not os.path.exists(source):
+                continue
+            link = source
+        linked.append((record, link))
+    return linked
+
+
+def export_snapshot(destination: BinaryIO, master: Type[StorageMaster] = StorageMaster,
+                    progress: Optional[Progress] = None) -> Dict:
+    """
+    Stream a point-in-time snapshot of the storage into a tar archive.
+    The archive starts with an index of every file, files of temp directory are never included
+
+    Returns:
+        Dict: header of the index
+    """
+
+    snapshot_dir = os.path.join(master.STORAGE, '.snapshots', uuid.uuid4().hex)
+    try:
+        linked = _link_objects(master, snapshot_dir)
+        header = {
+            "format": FORMAT,
+            "created": time.time(),
+            "oplog_seq": master.oplog.last_seq,
+            "objects": len(linked),
+            "bytes": sum(record.size for record, _ in linked),
+        }
+        if progress is not None:
+            progress.total = len(linked)
+
+        index = '\n'.join([json.dumps(header)] + [json.dumps(record.dump()) for record, _ in linked]) + '\n'
+        index = index.encode('utf-8')
+
+        with tarfile.open(fileobj=destination, mode='w|', bufsize=TAR_BUF_SIZE) as archive:
+            info = tarfile.TarInfo(INDEX)
+            info.size, info.mtime = len(index), int(header["created"])
+            archive.addfile(info, io.BytesIO(index))
+
+            for record, path in linked:
+                arcname = f'{OBJECTS}/{record.file_name[:2]}/{record.file_name}'
+                if path is None:
+                    data = master.packs.read(record.hash)
+                    if data is None:
+                        # packed file deleted while exporting
+                        continue
+                    info = tarfile.TarInfo(arcname)
+                    info.size, info.mtime = len(data), int(header["created"])
+                    archive.addfile(info, io.BytesIO(data))
+                else:
+                    info = archive.gettarinfo(path, arcname=arcname)
+                    info.uid = info.gid = 0
+                    info.uname = info.gname = ''
+                    with open(path, 'rb') as f:
+                        archive.addfile(info, f)
+                if progress is not None:
+                    progress.update(1, info.size)
+
+        return header
+    finally:
+        shutil.rmtree(snapshot_dir, ignore_errors=True)
+
+
+def _ingest(master: Type[StorageMaster], archive_path: str, offset: int, size: int, record: ObjectRecord,
+            trust_unnamed: bool) -> str:
+    """
+    Copy a file out of the archive while hashing it and commit it to the storage.
+    Files restored from disk don't know the name they were hashed with and can't be verified,
+    they're quarantined unless trust_unnamed is set
+
+    Returns:
+        str: 'imported', 'skipped', 'corrupted' or 'unverified'
+    """
+
+    temp_path = os.path.join(master.TEMP, f'import-{record.file_name}')
+    hash_instance = HASHING_METHOD()
+    hash_instance.update(record.name.encode('utf-8'))
+
+    with open(archive_path, 'rb') as archive, open(temp_path, 'wb') as out_file:
+        archive.seek(offset)
+        left = size
+        while left:
+            data = archive.read(min(left, READING_FILE_BUF_SIZE))
+            if not data:
+                break
+            hash_instance.update(data)
+            out_file.write(data)
+            left -= len(data)
+
+    if left or (record.name and hash_instance.hexdigest() != record.hash):
+        os.remove(temp_path)
+        return 'corrupted'
+
+    if not record.name and not trust_unnamed:
+        os.makedirs(master.QUARANTINE, exist_ok=True)
+        os.replace(temp_path, os.path.join(master.QUARANTINE, record.file_name))
+        return 'unverified'
+
+    try:
+        master.commit(temp_path, ObjectRecord(record.hash, record.extension, size,
+                                              record.tenant, record.name, record.expires))
+    except FileExistsError:
+        return 'skipped'
+    return 'imported' if record.name else 'unverified'
+
+
+def import_snapshot(archive_path: str, master: Type[StorageMaster] = StorageMaster, workers: int = 4,
+                    progress: Optional[Progress] = None, trust_unnamed: bool = False) -> Dict[str, int]:
+    """
+    Ingest an archive made by export_snapshot.
+    Files already in the storage are skipped without being read,
+    others are copied and verified by a pool of threads.
+    Files without the name they were hashed with are quarantined,
+    or imported unverified with trust_unnamed
+
+    Returns:
+        Dict[str, int]: number of imported, skipped, corrupted and unverified files
+    """
+
+    stats = {"imported": 0, "skipped": 0, "corrupted": 0, "unverified": 0}
+    lock = threading.Lock()
+    # bounds files read ahead of the workers
+    slots = threading.BoundedSemaphore(workers * 4)
+
+    def done(result: str, size: int) -> None:
+        with lock:
+            stats[result] += 1
+        if progress is not None:
+            progress.update(1, size)
+
+    def ingest(offset: int, size: int, record: ObjectRecord) -> None:
+        try:
+            done(_ingest(master, archive_path, offset, size, record, trust_unnamed), size)
+        finally:
+            slots.release()
+
+    with tarfile.open(archive_path, 'r:') as archive, ThreadPoolExecutor(max_workers=workers) as pool:
+        member = archive.next()
+        if member is None or member.name != INDEX:
+            raise ValueError(f'{archive_path} is not a snapshot, it has no {INDEX}')
+
+        lines = archive.extractfile(member).read().decode('utf-8').splitlines()
+        header = json.loads(lines[0])
+        if header.get("format") != FORMAT:
+            raise ValueError(f'Unsupported snapshot format {header.get("format")}')
+        records: Dict[str, ObjectRecord] = {}
+        for line in lines[1:]:
+            record = ObjectRecord(**json.loads(line))
+            records[record.file_name] = record
+        if progress is not None:
+            progress.total = len(records)
+
+        futures = []
+        while True:
+            member = archive.next()
+            # don't keep millions of headers around
+            archive.members.clear()
+            if member is None:
+                break
+
+            record = records.get(os.path.basename(member.name))
+            if not member.isfile() or record is None:
+                continue
+            if record.hash in master.catalog or master.get(record.hash) is not None:
+                done('skipped', 0)
+                continue
+
+            slots.acquire()
+            futures.append(pool.submit(ingest, member.offset_data, member.size, record))
+
+        for future in futures:
+            future.result()
+
+    return stats
@@ -0,0 +1,237 @@
+import os
+import json
+import time
+import logging
+import threading
+
+from typing import Any, Dict, Iterator, List, Optional, Tuple, Type
+
+from .catalog import iter_stored_files
+from .manager import StorageMaster
+from utils.background import PeriodicTask
+from utils.metrics import metrics
+from utils.ratelimit import TokenBucket
+from config import (TIER_MOVE_INTERVAL, TIER_HALF_LIFE, TIER_PROMOTE_SCORE, TIER_DEMOTE_AFTER,
+                    TIER_FAST_CAPACITY, TIER_MOVE_BYTES_PER_SECOND)
+
+
+logger = logging.getLogger('file')
+
+
+class AccessTracker(object):
+    """
+    Downloads of every file, older downloads count exponentially less
+    """
+
+    def __init__(self, half_life: float = TIER_HALF_LIFE):
+        self.half_life = half_life
+        # hash -> (score, time of the last download)
+        self.scores: Dict[str, Tuple[float, float]] = {}
+        self._lock = threading.Lock()
+
+    def _decayed(self, score: float, since: float, now: float) -> float:
+        return score * 0.5 ** (max(now - since, 0) / self.half_life)
+
+    def hit(self, hash_string: str, now: Optional[float] = None) -> None:
+        now = time.time() if now is None else now
+        with self._lock:
+            score, last = self.scores.get(hash_string, (0.0, now))
+            self.scores[hash_string] = (self._decayed(score, last, now) + 1, now)
+
+    def score(self, hash_string: str, now: Optional[float] = None) -> float:
+        score, last = self.scores.get(hash_string, (0.0, 0.0))
+        return self._decayed(score, last, time.time() if now is None else now)
+
+    def last_access(self, hash_string: str) -> Optional[float]:
+        return self.scores.get(hash_string, (0.0, None))[1]
+
+    def prune(self, older_than: float) -> None:
+        """
+        Forget files not downloaded since older_than
+        """
+
+        with self._lock:
+            for hash_string in [h for h, (_, last) in self.scores.items() if last < older_than]:
+                del self.scores[hash_string]
+
+    def load(self, path: str) -> None:
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                scores = json.load(f)
+        except (FileNotFoundError, ValueError):
+            return
+        with self._lock:
+            self.scores = dict((h, tuple(value)) for h, value in scores.items())
+
+    def save(self, path: str) -> None:
+        with self._lock:
+            scores = dict(self.scores)
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w', encoding='utf-8') as f:
+            json.dump(scores, f)
+        os.replace(temp_path, path)
+
+
+class TierMover(object):
+    """
+    Keeps downloaded files in STORAGE_DIR and the rest in slower tiers.
+
+    Files downloaded often enough are promoted to the fastest tier,
+    files not downloaded for a while are demoted one tier down.
+    Every pass also counts how files are placed, that's what the fast tier is sized by.
+    """
+
+    ACCESS_LOG = '.tiers.access'
+
+    def __init__(self, master: Type[StorageMaster] = StorageMaster, tracker: Optional[AccessTracker] = None,
+                 promote_score: float = TIER_PROMOTE_SCORE, demote_after: float = TIER_DEMOTE_AFTER,
+                 fast_capacity: int = TIER_FAST_CAPACITY, bytes_per_second: float = TIER_MOVE_BYTES_PER_SECOND):
+        self.master = master
+        self.tracker = tracker or AccessTracker()
+        self.promote_score = promote_score
+        self.demote_after = demote_after
+        self.fast_capacity = fast_capacity
+        self.budget = TokenBucket(bytes_per_second, bytes_per_second) if bytes_per_second else None
+        self.task: Optional[PeriodicTask] = None
+        self.placement: List[Dict[str, Any]] = []
+        self.status: Dict[str, Any] = {"running": False, "promoted": 0, "demoted": 0, "last_pass_finished": None}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.master.COLD_STORAGE)
+
+    @property
+    def access_log_path(self) -> str:
+        return os.path.join(self.master.STORAGE, self.ACCESS_LOG)
+
+    def start(self) -> None:
+        if self.task is not None or not self.enabled:
+            return
+        self.tracker.load(self.access_log_path)
+        self.task = PeriodicTask('tier-mover', TIER_MOVE_INTERVAL, self.run)
+        self.task.start()
+        metrics.register('tiers', self.placement_samples)
+
+    def hit(self, hash_string: str) -> None:
+        if self.enabled:
+            self.tracker.hit(hash_string)
+
+    def placement_samples(self) -> Iterator[Tuple[str, dict, float]]:
+        for tier in self.placement:
+            yield 'storage_tier_objects', {"tier": tier["tier"]}, tier["objects"]
+            yield 'storage_tier_bytes', {"tier": tier["tier"]}, tier["bytes"]
+            yield 'storage_tier_hot_bytes', {"tier": tier["tier"]}, tier["hot_bytes"]
+        yield 'storage_working_set_bytes', {}, self.working_set()
+
+    def working_set(self) -> int:
+        """
+        Bytes of files downloaded within TIER_DEMOTE_AFTER,
+        what the fast tier needs to keep every one of them
+        """
+
+        since = time.time() - self.demote_after
+        total = 0
+        for hash_string, (_, last) in list(self.tracker.scores.items()):
+            record = self.master.catalog.get(hash_string)
+            if record is not None and last >= since:
+                total += record.size
+        return total
+
+    def _move(self, file_name: str, size: int, tier: int) -> bool:
+        if self.budget is not None:
+            delay = self.budget.consume(size)
+            if delay:
+                time.sleep(delay)
+        try:
+            moved = self.master.relocate(file_name, tier)
+        except OSError:
+            logger.exception('Failed to move %s to tier %d', file_name, tier)
+            return False
+        if moved:
+            metrics.inc('tier_moved_bytes', size)
+        return moved
+
+    def run(self) -> Dict[str, Any]:
+        """
+        Walk every tier once, then promote and demote files
+        """
+
+        if not self._lock.acquire(blocking=False):
+            return self.status
+
+        try:
+            self.status["running"] = True
+            now = time.time()
+            tiers = self.master.tiers()
+
+            # (file name, size, score, last access) of files in every tier
+            placed: List[List[Tuple[str, int, float, float]]] = []
+            for root in tiers:
+                files = []
+                for entry in iter_stored_files(root):
+                    try:
+                        stat = entry.stat(follow_symlinks=False)
+                    except FileNotFoundError:
+                        continue
+                    hash_string = os.path.splitext(entry.name)[0]
+                    # files are never demoted sooner than demote_after since they came to the tier
+                    last = max(self.tracker.last_access(hash_string) or 0, stat.st_mtime)
+                    files.append((entry.name, stat.st_size, self.tracker.score(hash_string, now), last))
+                placed.append(files)
+
+            fast_bytes = sum(size for _, size, _, _ in placed[0])
+            promoted = demoted = 0
+            # file name -> tier it was moved to
+            moved: Dict[str, int] = {}
+
+            # the hottest files first while they fit
+            hot = sorted((item for files in placed[1:] for item in files if item[2] >= self.promote_score),
+                         key=lambda item: -item[2])
+            for file_name, size, _, _ in hot:
+                if self.fast_capacity and fast_bytes + size > self.fast_capacity:
+                    break
+                if self._move(file_name, size, 0):
+                    moved[file_name] = 0
+                    fast_bytes += size
+                    promoted += 1
+
+            for tier, files in enumerate(placed[:-1]):
+                # the coldest files first
+                for file_name, size, score, last in sorted(files, key=lambda item: (item[2], item[3])):
+                    too_old = now - last > self.demote_after and score < self.promote_score
+                    too_many = tier == 0 and self.fast_capacity and fast_bytes > self.fast_capacity
+                    if file_name in moved or (not too_old and not too_many):
+                        continue
+                    if self._move(file_name, size, tier + 1):
+                        moved[file_name] = tier + 1
+                        demoted += 1
+                        if tier == 0:
+                            fast_bytes -= size
+
+            # placement after the moves
+            final: List[List[Tuple[str, int, float, float]]] = [[] for _ in tiers]
+            for tier, files in enumerate(placed):
+                for item in files:
+                    final[moved.get(item[0], tier)].append(item)
+            self.placement = [{
+                "tier": i,
+                "root": root,
+                "objects": len(files),
+                "bytes": sum(size for _, size, _, _ in files),
+                "hot_objects": sum(1 for _, _, score, _ in files if score >= self.promote_score),
+                "hot_bytes": sum(size for _, size, score, _ in files if score >= self.promote_score),
+            } for i, (root, files) in enumerate(zip(tiers, final))]
+
+            metrics.inc('tier_promotions', promoted)
+            metrics.inc('tier_demotions', demoted)
+            self.tracker.prune(now - 2 * self.demote_after)
+            self.tracker.save(self.access_log_path)
+            self.status.update(promoted=promoted, demoted=demoted, last_pass_finished=time.time())
+            return self.status
+        finally:
+            self.status["running"] = False
+            self._lock.release()
+
+
+tiering = TierMover()
@@ -6,6 +6,7 @@ import os
 from typing import List, Optional, BinaryIO, Tuple, Callable
 
 from config import HASH_LENGTH, STORAGE_DIR, TEMP_DIR
+from storage.manager import StorageMaster
 
 
 real_urls = ('/', '/upload', '/download', '/delete')
@@ -69,6 +70,10 @@ def get_uncloseable_bytes() -> Tuple[BinaryIO, Callable]:
 
 def remove_test_file():
     # try:
+    found_file = StorageMaster.get(testing_hash)
+    if found_file:
+        StorageMaster.delete(found_file)
+
     file_path = os.path.join(STORAGE_DIR, '4d', f'{testing_hash}.txt')
     file_dir_path = os.path.dirname(file_path)
     if os.path.exists(file_path):
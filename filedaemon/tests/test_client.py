@@ -0,0 +1,114 @@
+import io
+import os
+import threading
+import http.client
+
+import pytest
+
+from werkzeug.serving import make_server, WSGIRequestHandler
+
+from app import create_app
+from filedaemon.client.client import FileDaemonClient, FileDaemonError, file_hash
+from utils.metrics import metrics
+from tests.environment import remove_test_file, test_bytes, test_file_name, testing_hash
+
+
+class KeepAliveHandler(WSGIRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+
+@pytest.fixture(scope='module')
+def daemon():
+    server = make_server('127.0.0.1', 0, create_app(), threaded=True, request_handler=KeepAliveHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    with FileDaemonClient(f'http://127.0.0.1:{server.server_port}', pool_size=4) as client:
+        yield client
+    server.shutdown()
+
+
+def test_file_hash():
+    fileobj = io.BytesIO(test_bytes)
+    assert file_hash(fileobj, test_file_name) == testing_hash
+    assert fileobj.tell() == 0
+
+
+def test_base_url_scheme():
+    with FileDaemonClient('https://files.example') as client:
+        with client.pool.connection() as connection:
+            assert isinstance(connection, http.client.HTTPSConnection)
+            assert connection.port == 443
+    with pytest.raises(ValueError):
+        FileDaemonClient('ftp://files.example')
+
+
+def test_upload_download_delete(daemon):
+    remove_test_file()
+
+    assert not daemon.exists(testing_hash)
+    assert daemon.upload(io.BytesIO(test_bytes), test_file_name) == testing_hash
+    assert daemon.exists(testing_hash)
+    # stored already, only hashed and the body isn't sent
+    skipped = metrics.get('uploads_skipped_duplicate')
+    assert daemon.upload(io.BytesIO(test_bytes), test_file_name) == testing_hash
+    assert metrics.get('uploads_skipped_duplicate') == skipped
+
+    assert daemon.read(testing_hash) == test_bytes
+
+    assert daemon.delete(testing_hash)
+    assert not daemon.delete(testing_hash)
+    with pytest.raises(FileDaemonError) as e:
+        daemon.read(testing_hash)
+    assert e.value.status == 404
+
+
+def test_bulk_transfers(daemon, tmp_path):
+    contents = {f'bulk-{i}.bin': os.urandom(1000 * i) for i in range(1, 21)}
+    for name, content in contents.items():
+        (tmp_path / name).write_bytes(content)
+    paths = [str(tmp_path / name) for name in contents]
+
+    hashes = daemon.upload_many(paths, workers=4)
+    assert all(isinstance(h, str) for h in hashes.values())
+    assert daemon.exists_many(hashes.values()) == set(hashes.values())
+
+    # uploaded again, every file is found by its hash
+    assert daemon.upload_many(paths) == hashes
+
+    out = tmp_path / 'out'
+    out.mkdir()
+    written = daemon.download_many({h: str(out / os.path.basename(p)) for p, h in hashes.items()})
+    assert sorted(written.values()) == sorted(len(c) for c in contents.values())
+    for name, content in contents.items():
+        assert (out / name).read_bytes() == content
+
+    assert all(daemon.delete_many(hashes.values()).values())
+    assert daemon.exists_many(hashes.values()) == set()
+
+    missing = daemon.download_many({hashes[paths[0]]: str(out / 'missing')})
+    assert isinstance(missing[hashes[paths[0]]], FileDaemonError)
+    assert not (out / 'missing').exists()
+
+
+def test_delta_upload(daemon, tmp_path):
+    base = os.urandom(200 * 1024)
+    base_hash = daemon.upload(io.BytesIO(base), 'artifact-1.bin')
+    copied = metrics.get('delta_bytes_copied')
+
+    new_version = tmp_path / 'artifact-2.bin'
+    new_version.write_bytes(base[:100000] + b'patched' + base[100000:] + b'appended')
+    with open(new_version, 'rb') as f:
+        new_hash = daemon.upload_delta(f, new_version.name, base_hash)
+        f.seek(0)
+        assert new_hash == file_hash(f, new_version.name)
+    assert daemon.read(new_hash) == new_version.read_bytes()
+    assert metrics.get('delta_bytes_copied') - copied > len(base) * 0.9
+
+    # stored already, nothing is sent
+    assert daemon.upload_delta(io.BytesIO(new_version.read_bytes()), new_version.name, base_hash) == new_hash
+
+    with pytest.raises(FileDaemonError) as e:
+        daemon.upload_delta(io.BytesIO(b'whatever'), 'other.bin', 'ab' * 32)
+    assert e.value.status == 404
+
+    assert daemon.delete(new_hash) and daemon.delete(base_hash)
@@ -0,0 +1,194 @@
+import io
+import os
+import sys
+import json
+import time
+import socket
+import subprocess
+import urllib.request
+import urllib.error
+
+import pytest
+
+from typing import Callable, Dict, List
+
+from cluster.cluster import Cluster, REPLICA_HEADER
+from cluster.ring import HashRing
+from config import BASE_DIR, CLUSTER_DEFAULT_SECRET
+from utils.encryption import encrypt_string
+from utils.multipart import MultipartFile
+
+
+API = '/api/v1'
+SECRET = 'test-secret'
+
+
+def free_port() -> int:
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(condition: Callable[[], bool], timeout: float = 20) -> None:
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            raise TimeoutError()
+        time.sleep(0.2)
+
+
+def call(method: str, url: str, body: bytes = None, headers: Dict[str, str] = None):
+    request = urllib.request.Request(url, data=body, method=method, headers=headers or {})
+    try:
+        with urllib.request.urlopen(request, timeout=10) as response:
+            return response.status, response.read()
+    except urllib.error.HTTPError as e:
+        return e.code, e.read()
+    except OSError:
+        return None, b''
+
+
+def upload(node: str, content: bytes, filename: str) -> str:
+    body = MultipartFile(io.BytesIO(content), filename, size=len(content))
+    status, payload = call('POST', node + API + '/upload', body.read(), {'Content-Type': body.content_type})
+    assert status == 200, payload
+    return json.loads(payload)['hash']
+
+
+def cluster_status(node: str) -> Dict:
+    status, payload = call('GET', node + API + '/cluster')
+    return json.loads(payload)['cluster'] if status == 200 else {}
+
+
+def stored_on(nodes: List[str], hash_string: str) -> List[str]:
+    """
+    Daemons having the file themselves
+    """
+
+    return sorted(node for node in nodes if call('HEAD', f'{node}{API}/download?hash={hash_string}',
+                                                 headers={REPLICA_HEADER: SECRET})[0] == 200)
+
+
+def start_daemon(node: str, storage: str, **settings: str) -> subprocess.Popen:
+    """
+    Run `python filedaemon` listening on node URL with settings
+    passed as FILEDAEMON_<NAME> environment variables
+    """
+
+    env = dict(os.environ, FILEDAEMON_STORAGE_DIR=storage, FILEDAEMON_CLUSTER_SECRET=SECRET,
+               **dict((f'FILEDAEMON_{name}', value) for name, value in settings.items()))
+    return subprocess.Popen([sys.executable, BASE_DIR, '-p', node.rsplit(':', 1)[1]], env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+
+@pytest.fixture
+def daemons(tmp_path):
+    nodes = [f'http://127.0.0.1:{free_port()}' for _ in range(3)]
+    storages: Dict[str, str] = {}
+    processes: Dict[str, subprocess.Popen] = {}
+
+    for node in nodes:
+        storages[node] = str(tmp_path / node.rsplit(':', 1)[1])
+        processes[node] = start_daemon(node, storages[node], CLUSTER_NODES=json.dumps(nodes),
+                                       CLUSTER_SELF=node, CLUSTER_HEARTBEAT_INTERVAL='0.5')
+
+    try:
+        for node in nodes:
+            wait_for(lambda: len(cluster_status(node).get('alive', [])) == len(nodes))
+        yield nodes, storages, processes
+    finally:
+        for process in processes.values():
+            process.kill()
+            process.wait()
+
+
+def test_ring_placement():
+    nodes = ['http://a', 'http://b', 'http://c']
+    ring = HashRing(nodes, replicas=2)
+    keys = [encrypt_string(str(i)) for i in range(1000)]
+
+    for key in keys:
+        owners = ring.owners(key)
+        assert len(owners) == 2 and len(set(owners)) == 2
+
+    # Only keys of the new node move
+    bigger = HashRing(nodes + ['http://d'], replicas=1)
+    smaller = HashRing(nodes, replicas=1)
+    moved = [key for key in keys if bigger.owners(key) != smaller.owners(key)]
+    assert all(bigger.owners(key) == ['http://d'] for key in moved)
+    assert 100 < len(moved) < 400
+
+    # Not hexadecimal keys still have owners
+    assert len(ring.owners('x' * 64)) == 2
+
+
+def test_internal_requests():
+    standalone = Cluster('', [], secret=SECRET)
+    assert not standalone.is_internal({REPLICA_HEADER: SECRET})
+
+    clustered = Cluster('http://a', ['http://a', 'http://b'], secret=SECRET)
+    assert clustered.is_internal({REPLICA_HEADER: SECRET})
+    assert not clustered.is_internal({REPLICA_HEADER: 'guess'})
+    assert not clustered.is_internal({})
+
+    # the default secret is known to everyone
+    default = Cluster('http://a', ['http://a', 'http://b'], secret=CLUSTER_DEFAULT_SECRET)
+    assert not default.is_internal({REPLICA_HEADER: CLUSTER_DEFAULT_SECRET})
+    with pytest.raises(ValueError):
+        default.start()
+    assert default.task is None
+
+
+def test_cluster_replication(daemons):
+    nodes, storages, processes = daemons
+    ring = HashRing(nodes, replicas=2)
+
+    hashes = [upload(nodes[0], f'content {i}'.encode(), f'file-{i}.txt') for i in range(6)]
+    for hash_string in hashes:
+        assert stored_on(nodes, hash_string) == sorted(ring.owners(hash_string))
+        for node in nodes:
+            assert call('GET', f'{node}{API}/download?hash={hash_string}')[0] == 200
+
+    # Every replica is already there
+    body = MultipartFile(io.BytesIO(b'content 0'), 'file-0.txt', size=9)
+    assert call('POST', nodes[2] + API + '/upload', body.read(), {'Content-Type': body.content_type})[0] == 400
+
+    status, _ = call('DELETE', f'{nodes[1]}{API}/delete?hash={hashes[0]}')
+    assert status == 200
+    assert stored_on(nodes, hashes[0]) == []
+
+    # A dead daemon's files are copied to the new owners
+    dead = nodes[2]
+    processes[dead].kill()
+    alive = HashRing(nodes[:2], replicas=2)
+    wait_for(lambda: all(stored_on(nodes[:2], h) == sorted(alive.owners(h)) for h in hashes[1:]))
+    for hash_string in hashes[1:]:
+        assert call('GET', f'{nodes[0]}{API}/download?hash={hash_string}')[0] == 200
+
+
+def test_follower(tmp_path):
+    primary, standby = (f'http://127.0.0.1:{free_port()}' for _ in range(2))
+    processes = [
+        start_daemon(primary, str(tmp_path / 'primary')),
+        start_daemon(standby, str(tmp_path / 'standby'), FOLLOWER_OF=primary, FOLLOWER_POLL_INTERVAL='0.2'),
+    ]
+    try:
+        for node in (primary, standby):
+            wait_for(lambda: call('GET', node + '/')[0] == 200)
+
+        hashes = [upload(primary, f'content {i}'.encode(), f'file-{i}.txt') for i in range(20)]
+        wait_for(lambda: all(call('GET', f'{standby}{API}/download?hash={h}')[0] == 200 for h in hashes))
+
+        assert call('DELETE', f'{primary}{API}/delete?hash={hashes[0]}')[0] == 200
+        wait_for(lambda: call('GET', f'{standby}{API}/download?hash={hashes[0]}')[0] == 404)
+
+        # Followers are read-only
+        assert call('DELETE', f'{standby}{API}/delete?hash={hashes[1]}')[0] == 405
+
+        follower = json.loads(call('GET', f'{standby}{API}/cluster')[1])['follower']
+        assert follower['applied_seq'] == 21
+        assert follower['lag_entries'] == 0
+    finally:
+        for process in processes:
+            process.kill()
+            process.wait()
@@ -1,15 +1,32 @@
+import io
+import os
+import time
+import logging
 import pytest
 import json
+import tracemalloc
 
 from typing import List, Callable, Optional, Union
 
 import flask as fl
+from werkzeug.datastructures import FileStorage
+from werkzeug.test import EnvironBuilder
 
 from app import create_app, Route
-from config import HASH_LENGTH
+from api.accesslog import AccessLog
+from api.admission import AdmissionControl
+from api.throttling import ClientThrottle
+from cluster.cluster import cluster, REPLICA_HEADER, TENANT_HEADER, EXPIRES_HEADER
+from config import HASH_LENGTH, API_KEY_HEADER, EXPECTED_HASH_HEADER, CLUSTER_DEFAULT_SECRET
+from storage.manager import StorageMaster, QuotaExceededException
+from utils.encryption import encrypt_string
+from utils.delta import encode_copy
+from utils.latency import DecayingAverage
+from utils.memory import profiler
+from utils.metrics import metrics
 from tests.environment import (generate_random_url, get_invalid_hashes,
                                get_test_bytes_object, get_uncloseable_bytes,
-                               remove_test_file, test_file_name)
+                               remove_test_file, test_bytes, test_file_name)
 
 
 @pytest.fixture(scope='module')
@@ -236,3 +253,326 @@ def test_delete_existing_hash(client):
     finally:
         close_IO()
         remove_test_file()
+
+
+def test_hash_parameter_locations(client):
+    fake_hash = "x" * HASH_LENGTH
+
+    assert_equals(client.get(f'{Route.delete}/{fake_hash}'), 404)
+    assert_equals(client.get(Route.download, query_string={"hash": fake_hash}), 404)
+    assert_equals(client.get(Route.download, json={"hash": fake_hash}), 404)
+    assert_equals(client.get(Route.download, json=["not", "a", "dict"]), 400)
+
+
+def test_exists(client):
+    remove_test_file()
+    fake_hash = "x" * HASH_LENGTH
+    try:
+        uploaded_hash = assert_equals(client.post(Route.upload, data={'file': (get_test_bytes_object(), test_file_name)}), 200)["hash"]
+
+        assert_equals(client.get(f'{Route.exists}/{uploaded_hash}'), 200)
+        assert client.head(f'{Route.exists}/{uploaded_hash}').status_code == 200
+        assert client.head(Route.exists, query_string={"hash": fake_hash}).status_code == 404
+        assert_equals(client.get(f'{Route.exists}/invalid'), 403)
+        assert_equals(client.get(Route.exists), 400)
+
+        response = assert_equals(client.post(Route.exists, json={"hashes": [uploaded_hash, fake_hash, "invalid"]}), 200)
+        assert response["found"] == [uploaded_hash]
+        assert response["missing"] == [fake_hash, "invalid"]
+
+        response = assert_equals(client.post(Route.exists, data={"hashes": f'{fake_hash},{uploaded_hash}'}), 200)
+        assert response["found"] == [uploaded_hash]
+        assert_equals(client.post(Route.exists, json={"hashes": "x" * 10}), 200)
+        assert_equals(client.post(Route.exists, json={"hashes": [1, 2]}), 400)
+
+        client.get(Route.delete, data={"hash": uploaded_hash})
+        assert_equals(client.get(f'{Route.exists}/{uploaded_hash}'), 404)
+    finally:
+        remove_test_file()
+
+
+def test_upload_with_expected_hash(client):
+    remove_test_file()
+    fake_hash = "x" * HASH_LENGTH
+    try:
+        data = {'file': (get_test_bytes_object(), test_file_name)}
+        response = client.post(Route.upload, data=data, headers={EXPECTED_HASH_HEADER: fake_hash})
+        assert_equals(response, 400)
+        assert not os.listdir(StorageMaster.TEMP)
+
+        data = {'file': (get_test_bytes_object(), test_file_name)}
+        uploaded_hash = assert_equals(client.post(Route.upload, data=data), 200)["hash"]
+
+        # Duplicate is answered without reading the body
+        skipped = metrics.get('uploads_skipped_duplicate')
+        environ = EnvironBuilder(Route.upload, method='POST', headers={EXPECTED_HASH_HEADER: uploaded_hash},
+                                 data={'file': (io.BytesIO(test_bytes * 100), test_file_name),
+                                       'ttl': '3600'}).get_environ()
+        body = environ['wsgi.input'] = io.BytesIO(environ['wsgi.input'].read())
+        response = client.open(environ)
+        assert assert_equals(response, 400)["hash"] == uploaded_hash
+        assert metrics.get('uploads_skipped_duplicate') == skipped + 1
+        # not a byte of the body was read
+        assert body.tell() == 0
+
+        assert_equals(client.post(Route.upload, data={}, headers={EXPECTED_HASH_HEADER: "invalid"}), 403)
+    finally:
+        remove_test_file()
+
+
+def test_upload_with_ttl(client):
+    remove_test_file()
+    try:
+        data = {'file': (get_test_bytes_object(), test_file_name), 'ttl': '-1'}
+        assert_equals(client.post(Route.upload, data=data), 400)
+
+        data = {'file': (get_test_bytes_object(), test_file_name), 'ttl': '3600'}
+        response = assert_equals(client.post(Route.upload, data=data), 200)
+        assert response["expires"] > time.time() + 3500
+        assert StorageMaster.catalog.get(response["hash"]).expires == response["expires"]
+    finally:
+        remove_test_file()
+
+
+def test_default_secret_is_not_trusted(client):
+    remove_test_file()
+    try:
+        data = {'file': (get_test_bytes_object(), test_file_name)}
+        response = client.post(Route.upload, data=data, headers={
+            REPLICA_HEADER: CLUSTER_DEFAULT_SECRET, TENANT_HEADER: 'key:victim', EXPIRES_HEADER: '1'})
+        record = StorageMaster.catalog.get(assert_equals(response, 200)["hash"])
+        assert record.tenant != 'key:victim' and record.expires == 0
+        assert 'key:victim' not in StorageMaster.catalog.usage
+    finally:
+        remove_test_file()
+
+
+def test_cluster_join_needs_secret(client, monkeypatch):
+    sent = []
+    monkeypatch.setattr(cluster, '_request', lambda node, *args, **kw: sent.append(node))
+    members = set(cluster.members)
+    listener = 'http://127.0.0.1:1'
+
+    assert_equals(client.post(Route.cluster, data={"join": listener}), 403)
+    assert_equals(client.post(Route.cluster, data={"join": listener},
+                              headers={REPLICA_HEADER: CLUSTER_DEFAULT_SECRET}), 403)
+
+    # with the secret, a standalone daemon still can't join anything
+    monkeypatch.setattr(cluster, 'secret', 'test-secret')
+    assert_equals(client.post(Route.cluster, data={"join": listener}, headers={REPLICA_HEADER: 'test-secret'}), 400)
+
+    assert cluster.members == members and not sent
+
+
+def test_oplog_needs_secret(client):
+    assert_equals(client.get(Route.oplog), 403)
+    assert_equals(client.get(Route.oplog, headers={REPLICA_HEADER: CLUSTER_DEFAULT_SECRET}), 403)
+
+
+def test_access_log(client):
+    records = []
+
+    class Collect(logging.Handler):
+        def emit(self, record):
+            records.append(record.access)
+
+    logger = logging.getLogger('access')
+    handler, level = Collect(), logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    try:
+        fake_hash = "x" * HASH_LENGTH
+        # records are written once the response is closed
+        client.get(Route.download, query_string={"hash": fake_hash}).close()
+        client.get('/').close()
+    finally:
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+    assert records[0]["status"] == 404
+    assert records[0]["hash"] == fake_hash
+    assert records[0]["route"] == Route.download
+    assert records[0]["bytes_out"] > 0 and records[0]["duration_ms"] >= 0
+    assert records[1]["path"] == '/' and records[1]["status"] == 200
+
+
+def test_rate_limit(client, monkeypatch):
+    monkeypatch.setattr('api.throttling.API_KEYS', {'tenant'})
+    access_log = client.application.wsgi_app
+    assert isinstance(access_log, AccessLog)
+    throttle = access_log.wsgi_app
+    records = []
+
+    class Collect(logging.Handler):
+        def emit(self, record):
+            records.append(record.access)
+
+    logger = logging.getLogger('access')
+    handler, level = Collect(), logger.level
+    logger.addHandler(handler)
+    logger.setLevel(logging.INFO)
+    access_log.wsgi_app = ClientThrottle(throttle.wsgi_app, requests_per_second=0.01, burst=2)
+    rejected = metrics.get('client_requests_rejected', client='ip:127.0.0.1')
+
+    try:
+        with client.get('/') as response:
+            assert_equals(response, 200)
+        with client.get('/', headers={API_KEY_HEADER: 'tenant'}) as response:
+            assert_equals(response, 200)
+        with client.get('/') as response:
+            assert_equals(response, 200)
+
+        with client.get('/') as response:
+            assert_equals(response, 429)
+            assert int(response.headers['Retry-After']) > 0
+        # unknown keys don't get a budget of their own
+        with client.get('/', headers={API_KEY_HEADER: 'random'}) as response:
+            assert_equals(response, 429)
+
+        # Other clients are not affected
+        with client.get('/', headers={API_KEY_HEADER: 'tenant'}) as response:
+            assert_equals(response, 200)
+    finally:
+        access_log.wsgi_app = throttle
+        logger.removeHandler(handler)
+        logger.setLevel(level)
+
+    # rejected requests are logged too
+    assert [record["status"] for record in records] == [200, 200, 200, 429, 429, 200]
+
+    counters = assert_equals(client.get(Route.metrics), 200)["metrics"]
+    assert {"labels": {"client": "ip:127.0.0.1"}, "value": rejected + 2} in counters["client_requests_rejected"]
+
+
+def test_admission_control(client, monkeypatch):
+    remove_test_file()
+    admission = client.application.wsgi_app.wsgi_app.wsgi_app
+    assert isinstance(admission, AdmissionControl)
+
+    # responses of the test client give the budget back once they're closed
+    uploads, upload_bytes = admission.uploads, admission.upload_bytes
+    data = {'file': (get_test_bytes_object(), test_file_name)}
+    response = client.post(Route.upload, data=data)
+    hash_string = assert_equals(response, 200)["hash"]
+    response.close()
+    assert (admission.uploads, admission.upload_bytes) == (uploads, upload_bytes)
+
+    try:
+        # ingest is saturated, downloads have a budget of their own
+        monkeypatch.setattr(admission, 'max_uploads', 1)
+        monkeypatch.setattr(admission, 'uploads', 1)
+        downloads = admission.downloads
+        response = client.post(Route.upload, data={'file': (get_test_bytes_object(), 'other.txt')})
+        assert_equals(response, 503)
+        assert int(response.headers['Retry-After']) >= 1
+        # every method that uploads a file is admitted
+        assert_equals(client.put(Route.upload, data={'file': (get_test_bytes_object(), 'other.txt')}), 503)
+        assert_equals(client.put(Route.delta, query_string={"base": hash_string, "name": 'other.txt'},
+                                 data=b'', content_type='application/octet-stream'), 503)
+
+        response = client.get(Route.download, query_string={"hash": hash_string})
+        assert response.status_code == 200
+        response.close()
+        assert admission.downloads == downloads
+        monkeypatch.setattr(admission, 'uploads', 0)
+
+        # slow disk
+        latency = DecayingAverage()
+        latency.add(admission.max_write_latency * 40)
+        monkeypatch.setattr(admission, 'latency', latency)
+        response = client.post(Route.upload, data={'file': (get_test_bytes_object(), 'other.txt')})
+        assert_equals(response, 503)
+        assert int(response.headers['Retry-After']) >= 4
+        assert metrics.get('admission_rejected', reason='write_latency') >= 1
+
+        monkeypatch.setattr(admission, 'max_downloads', downloads + 1)
+        monkeypatch.setattr(admission, 'downloads', downloads + 1)
+        assert_equals(client.get(Route.download, query_string={"hash": hash_string}), 503)
+    finally:
+        remove_test_file()
+
+
+def test_memory_profiling(client, monkeypatch):
+    remove_test_file()
+    assert_equals(client.get(Route.memory), 403)
+    monkeypatch.setattr(cluster, 'secret', 'test-secret')
+    headers = {REPLICA_HEADER: 'test-secret'}
+
+    memory = assert_equals(client.get(Route.memory, headers=headers), 200)
+    assert memory["memory"]["rss_bytes"] > 0 and memory["memory"]["open_fds"] > 0
+    assert_equals(client.get(Route.memory, query_string={"group": "stack"}, headers=headers), 400)
+
+    monkeypatch.setattr(profiler, 'sample_rate', 1)
+    samples = metrics.get('request_alloc_samples', route=Route.upload)
+    tracemalloc.start()
+    try:
+        # measured once the response is closed
+        response = client.post(Route.upload, data={'file': (get_test_bytes_object(), test_file_name)})
+        assert_equals(response, 200)
+        response.close()
+        assert metrics.get('request_alloc_samples', route=Route.upload) == samples + 1
+        assert metrics.get('request_alloc_peak_bytes_max', route=Route.upload) > 0
+
+        memory = assert_equals(client.get(Route.memory, query_string={"limit": 5}, headers=headers), 200)
+        assert memory["memory"]["tracing"] and memory["memory"]["traced_bytes"] > 0
+        assert 0 < len(memory["top"]) <= 5
+        memory = assert_equals(client.get(Route.memory, query_string={"limit": -5}, headers=headers), 200)
+        assert len(memory["top"]) == 1
+        assert all(site["size"] > 0 and site["site"] for site in memory["top"])
+    finally:
+        tracemalloc.stop()
+        remove_test_file()
+
+
+def test_malformed_delta(client):
+    remove_test_file()
+    data = {'file': (get_test_bytes_object(), test_file_name)}
+    base = assert_equals(client.post(Route.upload, data=data), 200)["hash"]
+
+    try:
+        assert_equals(client.post(Route.delta, query_string={"base": base}, data=b'L'), 400)
+        response = client.post(Route.delta, query_string={"base": base, "name": "new.txt"}, data=encode_copy(0, 1000),
+                               content_type='application/octet-stream')
+        assert_equals(response, 400)
+        assert not os.listdir(StorageMaster.TEMP)
+
+        signature = assert_equals(client.get(Route.signature, query_string={"hash": base}), 200)
+        assert signature["size"] == len(test_bytes) and len(signature["blocks"]) == 1
+        assert_equals(client.get(Route.signature, query_string={"hash": base, "block_size": 1}), 400)
+    finally:
+        remove_test_file()
+
+
+def test_upload_over_quota(client, monkeypatch):
+    remove_test_file()
+
+    monkeypatch.setattr('storage.manager.QUOTA_TENANTS', {'key:' + encrypt_string('tenant')[:16]: 1})
+    monkeypatch.setattr('api.throttling.API_KEYS', {'tenant'})
+    try:
+        data = {'file': (get_test_bytes_object(), test_file_name)}
+        response = client.post(Route.upload, data=data, headers={API_KEY_HEADER: 'tenant'})
+        assert_equals(response, 413)
+
+        # Uploads without Content-Length are checked against their real size
+        monkeypatch.setattr('storage.manager.QUOTA_TOTAL', StorageMaster.catalog.total + 1)
+        with pytest.raises(QuotaExceededException):
+            StorageMaster.save(FileStorage(get_test_bytes_object(), test_file_name))
+        assert not os.listdir(StorageMaster.TEMP)
+
+        # A few bytes of delta can't make a file over the quota
+        monkeypatch.setattr('storage.manager.QUOTA_TOTAL', StorageMaster.catalog.total + 2000)
+        data = {'file': (get_test_bytes_object(), test_file_name)}
+        base = assert_equals(client.post(Route.upload, data=data), 200)["hash"]
+        response = client.post(Route.delta, query_string={"base": base, "name": "big.txt"},
+                               data=encode_copy(0, len(test_bytes)) * 100, content_type='application/octet-stream')
+        assert_equals(response, 413)
+        assert not os.listdir(StorageMaster.TEMP)
+
+        # nor over the size limit without a quota
+        monkeypatch.setattr('storage.manager.QUOTA_TOTAL', 0)
+        monkeypatch.setattr('api.api.MAX_CONTENT_LENGTH', 1000)
+        response = client.post(Route.delta, query_string={"base": base, "name": "big.txt"},
+                               data=encode_copy(0, len(test_bytes)) * 100, content_type='application/octet-stream')
+        assert_equals(response, 413)
+    finally:
+        remove_test_file()
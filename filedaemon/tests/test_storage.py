@@ -1,11 +1,29 @@
+import io
 import os
+import json
+import contextlib
+import time
+import threading
 import pytest
 
+from werkzeug.datastructures import FileStorage
+
 # from tests.environment import (generate_random_url, get_invalid_hashes,
 #                                get_test_bytes_object, get_uncloseable_bytes,
 #                                remove_test_file, test_file_name)
 
+from storage.catalog import Catalog, ObjectRecord
 from storage.manager import StorageMaster, EmptyFileException
+from storage.oplog import OperationLog
+from storage.packs import PackStore
+from storage.scrubber import Scrubber
+from storage.snapshot import export_snapshot, import_snapshot
+from storage.tiers import AccessTracker, TierMover
+from storage.expiry import Expirer
+from storage.fsck import StorageCheck
+from utils.bloom import CountingBloomFilter
+from utils.progress import Progress
+from config import DEFAULT_TENANT
 
 @pytest.fixture(scope="session")
 def storage_mock(tmpdir_factory):
@@ -25,3 +43,567 @@ def manager(storage_mock):
 # def test_storage_manager_save(manager):
 #
 #     assert manager.get('123')[0]
+
+
+def test_catalog_survives_restart(tmp_path):
+    catalog = Catalog(str(tmp_path))
+    catalog.load()
+    catalog.add(ObjectRecord('a' * 64, '.txt', 10, 'key:first'))
+    catalog.add(ObjectRecord('b' * 64, '', 5))
+    catalog.add(ObjectRecord('c' * 64, '.bin', 7, 'key:first'))
+    catalog.remove('c' * 64)
+
+    assert catalog.total == 15
+    assert catalog.usage == {'key:first': 10, DEFAULT_TENANT: 5}
+
+    restored = Catalog(str(tmp_path))
+    assert restored.load()
+    assert restored.total == 15
+    assert restored.usage == catalog.usage
+
+    restored.compact()
+    compacted = Catalog(str(tmp_path))
+    compacted.load()
+    assert compacted.records == catalog.records
+
+
+def test_catalog_snapshot_checksum(tmp_path):
+    catalog = Catalog(str(tmp_path))
+    catalog.load()
+    catalog.add(ObjectRecord('a' * 64, '.txt', 10, 'key:first', 'a.txt', expires=100.5))
+    catalog.add(ObjectRecord('b' * 64, '', 5))
+    # tenants are API keys, anything can be in them
+    catalog.add(ObjectRecord('d' * 64, '.txt', 1, 'key:tab\there\nnew \\t line'))
+    catalog.compact()
+
+    restored = Catalog(str(tmp_path))
+    assert restored.load()
+    assert restored.records == catalog.records
+    assert restored.records['d' * 64].tenant == 'key:tab\there\nnew \\t line'
+    assert restored.usage == catalog.usage and restored.total == 16
+    assert [r.hash for r in restored.expired(101, 10)] == ['a' * 64]
+    assert restored.verify()
+
+    with open(restored.snapshot_path, 'r+b') as f:
+        f.seek(20)
+        f.write(b'X')
+    assert not Catalog(str(tmp_path)).verify()
+
+    # snapshots of JSON lines are still loaded
+    with open(restored.snapshot_path, 'w') as f:
+        f.write(json.dumps(ObjectRecord('c' * 64, '', 7).dump()) + '\n')
+    legacy = Catalog(str(tmp_path))
+    assert legacy.load() and legacy.total == 7 and legacy.verify()
+
+
+def test_catalog_reconcile(tmp_path):
+    shard = tmp_path / 'aa'
+    shard.mkdir()
+    (shard / ('aa' + 'x' * 62 + '.txt')).write_bytes(b'12345')
+    (tmp_path / 'temporary').mkdir()
+    (tmp_path / 'temporary' / 'upload.txt').write_bytes(b'not stored yet')
+
+    catalog = Catalog(str(tmp_path))
+    assert not catalog.load()
+    catalog.add(ObjectRecord('b' * 64, '', 5))
+
+    assert catalog.reconcile() == {"added": 1, "removed": 1, "resized": 0}
+    assert catalog.total == 5
+    assert list(catalog.records) == ['aa' + 'x' * 62]
+
+
+@pytest.fixture
+def isolated_master(tmp_path):
+    """
+    StorageMaster operating on its own temporary storage
+    """
+
+    (tmp_path / 'temporary').mkdir()
+
+    class IsolatedMaster(StorageMaster):
+        STORAGE = str(tmp_path)
+        TEMP = str(tmp_path / 'temporary')
+        QUARANTINE = str(tmp_path / 'quarantine')
+        catalog = Catalog(str(tmp_path))
+        oplog = OperationLog(str(tmp_path), fsync=False)
+        packs = PackStore(str(tmp_path / 'packs'))
+        known = CountingBloomFilter(1000)
+        owner_pid = None
+
+    IsolatedMaster.catalog.load()
+    return IsolatedMaster
+
+
+def test_scrubber_quarantines_corrupted_files(isolated_master, tmp_path):
+    intact = isolated_master.save(FileStorage(io.BytesIO(b'intact content' * 1000), 'intact.txt'))
+    corrupted = isolated_master.save(FileStorage(io.BytesIO(b'rotten content' * 1000), 'corrupted.txt'))
+    packed = isolated_master.save(FileStorage(io.BytesIO(b'small rotten content'), 'packed.txt'))
+
+    with open(os.path.join(isolated_master.STORAGE, corrupted[:2], corrupted + '.txt'), 'r+b') as f:
+        f.write(b'R')
+    entry = isolated_master.packs.entries[packed]
+    with open(isolated_master.packs.pack_path(entry.pack), 'r+b') as f:
+        f.seek(entry.offset)
+        f.write(b'S')
+
+    scrubber = Scrubber(isolated_master, str(tmp_path / '.checkpoint'), workers=1, bytes_per_second=0)
+    status = scrubber.run()
+
+    assert status["checked"] == 3
+    assert status["mismatches"] == 2
+    assert sorted(status["quarantined"]) == sorted([corrupted + '.txt', packed + '.txt'])
+    assert os.path.exists(os.path.join(isolated_master.QUARANTINE, corrupted + '.txt'))
+    assert os.path.exists(os.path.join(isolated_master.QUARANTINE, packed + '.txt'))
+    assert isolated_master.get(corrupted) is None
+    assert isolated_master.get(packed) is None
+    assert isolated_master.get(intact) == intact + '.txt'
+    assert scrubber.load_checkpoint() == {"pass": 1, "shard": None, "finished": status["last_pass_finished"]}
+
+
+def test_scrubber_resumes_from_checkpoint(isolated_master, tmp_path):
+    first = isolated_master.save(FileStorage(io.BytesIO(b'first' * 1000), 'first.txt'))
+    second = isolated_master.save(FileStorage(io.BytesIO(b'second' * 1000), 'second.txt'))
+    done = min(first, second)[:2]
+
+    scrubber = Scrubber(isolated_master, str(tmp_path / '.checkpoint'), workers=1, bytes_per_second=0)
+    scrubber.save_checkpoint(0, done)
+
+    # Shards up to the checkpointed one are not scrubbed again
+    assert scrubber.run()["checked"] == len([h for h in (first, second) if h[:2] > done])
+
+
+def test_operation_log_read_while_trimmed(tmp_path):
+    oplog = OperationLog(str(tmp_path), fsync=False, keep=5)
+    for i in range(10):
+        oplog.append('save', hash=str(i))
+    lock = oplog._lock
+
+    class TrimAfterRelease(object):
+        trimmed = False
+
+        def __enter__(self):
+            lock.acquire()
+
+        def __exit__(self, *exc_info):
+            lock.release()
+            if not self.trimmed:
+                self.trimmed = True
+                oplog.trim()
+
+    oplog._lock = TrimAfterRelease()
+    # read from the file the offsets were of
+    assert [entry['seq'] for entry in oplog.read(6, limit=3)] == [7, 8, 9]
+
+
+def test_operation_log(tmp_path):
+    oplog = OperationLog(str(tmp_path), fsync=False)
+    for i in range(10):
+        assert oplog.append('save', hash=str(i)) == i + 1
+    oplog.append('delete', hash='3')
+
+    assert [entry['hash'] for entry in oplog.read(8)] == ['8', '9', '3']
+    assert [entry['seq'] for entry in oplog.read(0, limit=2)] == [1, 2]
+    assert oplog.read(11) == []
+
+    # A torn write is dropped on restart
+    with open(oplog.path, 'ab') as f:
+        f.write(b'{"seq": 12, "op"')
+    # unless it's read by a tool while the daemon may be appending it
+    size = os.path.getsize(oplog.path)
+    reader = OperationLog(str(tmp_path))
+    reader.load(read_only=True)
+    assert reader.last_seq == 11 and os.path.getsize(oplog.path) == size
+    restored = OperationLog(str(tmp_path))
+    restored.load()
+    assert restored.last_seq == 11
+    assert restored.append('save', hash='new') == 12
+    assert restored.read(11)[0]['hash'] == 'new'
+
+    # Only the last entries are kept, sequence numbers go on
+    restored.keep = 5
+    assert restored.trim() == 7
+    assert restored.first_seq == 8 and restored.last_seq == 12
+    assert [entry['seq'] for entry in restored.read(0)] == [8, 9, 10, 11, 12]
+    assert restored.append('save', hash='after') == 13
+    assert [entry['hash'] for entry in restored.read(11)] == ['new', 'after']
+    trimmed = OperationLog(str(tmp_path))
+    trimmed.load()
+    assert (trimmed.first_seq, trimmed.last_seq) == (8, 13)
+    assert trimmed.read(9)[0]['seq'] == 10
+
+
+@pytest.fixture
+def another_master(tmp_path):
+    """
+    Second isolated StorageMaster to copy files to
+    """
+
+    root = tmp_path / 'another'
+    (root / 'temporary').mkdir(parents=True)
+
+    class AnotherMaster(StorageMaster):
+        STORAGE = str(root)
+        TEMP = str(root / 'temporary')
+        QUARANTINE = str(root / 'quarantine')
+        catalog = Catalog(str(root))
+        oplog = OperationLog(str(root), fsync=False)
+        packs = PackStore(str(root / 'packs'))
+        known = CountingBloomFilter(1000)
+        owner_pid = None
+
+    AnotherMaster.catalog.load()
+    return AnotherMaster
+
+
+def test_snapshot_export_and_import(isolated_master, another_master, tmp_path):
+    # both small packed files and large ones
+    hashes = [isolated_master.save(FileStorage(io.BytesIO(f'content {i}'.encode() * (i % 2 * 1000 + 1)),
+                                               f'file-{i}.txt'))
+              for i in range(10)]
+    # Half-written uploads are never exported
+    (tmp_path / 'temporary' / 'partial.txt').write_bytes(b'partial')
+    another_master.save(FileStorage(io.BytesIO(b'content 0'), 'file-0.txt'))
+
+    archive = tmp_path / 'snapshot.tar'
+    with open(archive, 'wb') as f:
+        header = export_snapshot(f, isolated_master, Progress('exported', stream=None))
+    assert header["objects"] == 10
+    assert len(isolated_master.packs) == 5
+    assert not os.listdir(os.path.join(isolated_master.STORAGE, '.snapshots'))
+
+    progress = Progress('imported', stream=None)
+    stats = import_snapshot(str(archive), another_master, workers=2, progress=progress)
+    assert stats == {"imported": 9, "skipped": 1, "corrupted": 0, "unverified": 0}
+    assert progress.count == 10
+
+    for hash_string in hashes:
+        assert another_master.get(hash_string) == hash_string + '.txt'
+    assert len(another_master.packs) == 5
+    assert another_master.catalog.total == isolated_master.catalog.total
+    assert not os.listdir(another_master.TEMP)
+
+
+def test_snapshot_import_of_unnamed_files(isolated_master, another_master, tmp_path):
+    hash_string = isolated_master.save(FileStorage(io.BytesIO(b'restored' * 1000), 'restored.txt'))
+    # restored from disk, the name it was hashed with is unknown
+    isolated_master.catalog.get(hash_string).name = ''
+
+    archive = tmp_path / 'snapshot.tar'
+    with open(archive, 'wb') as f:
+        export_snapshot(f, isolated_master)
+
+    stats = import_snapshot(str(archive), another_master)
+    assert stats == {"imported": 0, "skipped": 0, "corrupted": 0, "unverified": 1}
+    assert another_master.get(hash_string) is None
+    assert os.path.exists(os.path.join(another_master.QUARANTINE, hash_string + '.txt'))
+
+    stats = import_snapshot(str(archive), another_master, trust_unnamed=True)
+    assert stats == {"imported": 0, "skipped": 0, "corrupted": 0, "unverified": 1}
+    assert another_master.get(hash_string) == hash_string + '.txt'
+
+
+def test_pack_store(tmp_path):
+    packs = PackStore(str(tmp_path), pack_size=100, compact_ratio=0.5)
+    packs.load()
+
+    for i in range(10):
+        packs.put(str(i), '.txt', bytes([i]) * 30)
+    with pytest.raises(FileExistsError):
+        packs.put('0', '.txt', b'again')
+
+    # 3 files fit into a pack
+    assert packs.entries['9'].pack == 4
+    assert packs.read('4') == bytes([4]) * 30
+
+    for i in range(5):
+        packs.delete(str(i))
+    assert packs.read('0') is None
+
+    restored = PackStore(str(tmp_path), pack_size=100, compact_ratio=0.5)
+    restored.load()
+    assert restored.dead == {1: 90, 2: 60}
+
+    stats = restored.compact()
+    assert stats == {"packs": 2, "moved": 1, "reclaimed": 150}
+    assert not os.path.exists(restored.pack_path(1))
+    for i in range(5, 10):
+        assert restored.read(str(i)) == bytes([i]) * 30
+
+    compacted = PackStore(str(tmp_path), pack_size=100)
+    compacted.load()
+    assert sorted(compacted.entries) == [str(i) for i in range(5, 10)]
+    assert compacted.read('5') == bytes([5]) * 30
+
+    # data of the last file never got to the disk, its index entry is dropped
+    last = compacted.entries['9']
+    with open(compacted.pack_path(last.pack), 'r+b') as f:
+        f.truncate(last.offset + 10)
+    torn = PackStore(str(tmp_path), pack_size=100)
+    torn.load()
+    assert '9' not in torn and torn.read('8') == bytes([8]) * 30
+    assert torn.dead.get(last.pack, 0) >= 10
+
+    # reads don't wait for appends or compaction holding the write lock
+    held, release, read = threading.Event(), threading.Event(), []
+
+    def write():
+        with torn._write_lock:
+            held.set()
+            release.wait(10)
+
+    writer = threading.Thread(target=write)
+    writer.start()
+    held.wait(10)
+    reader = threading.Thread(target=lambda: read.append(torn.read('8')))
+    reader.start()
+    reader.join(5)
+    release.set()
+    writer.join()
+    assert read == [bytes([8]) * 30]
+
+    missing = PackStore(str(tmp_path / 'missing'))
+    missing.load(read_only=True)
+    assert not missing.entries and not os.path.exists(missing.root)
+
+
+def test_existence_filter(isolated_master):
+    saved = isolated_master.save(FileStorage(io.BytesIO(b'a' * 10), 'small.txt'))
+    isolated_master.rebuild_known(complete=True)
+
+    assert isolated_master.known_complete
+    assert saved in isolated_master.known
+    assert isolated_master.exists(saved)
+    assert not isolated_master.exists('x' * 64)
+
+    isolated_master.delete(isolated_master.get(saved))
+    assert saved not in isolated_master.known
+    assert not isolated_master.exists(saved)
+
+
+def test_existence_filter_removes_only_members(isolated_master):
+    stored = isolated_master.save(FileStorage(io.BytesIO(b'stored' * 1000), 'stored.txt'))
+    isolated_master.rebuild_known(complete=True)
+    # filter this small has false positives for most keys
+    isolated_master.known = CountingBloomFilter.build([stored], 1)
+
+    # a file the catalog has no record of, quarantined and deleted
+    stray = next(h for h in (format(i, 'x') * 64 for i in range(1, 16))
+                 if h in isolated_master.known and h[:2] != stored[:2])
+    os.makedirs(os.path.join(isolated_master.STORAGE, stray[:2]), exist_ok=True)
+    open(os.path.join(isolated_master.STORAGE, stray[:2], stray + '.txt'), 'wb').close()
+    assert stray in isolated_master.known
+    isolated_master.quarantine(stray + '.txt')
+    isolated_master.delete(stray + '.txt')
+    isolated_master.forget(stray)
+
+    assert stored in isolated_master.known
+    assert isolated_master.exists(stored)
+
+
+def test_tier_mover(isolated_master, tmp_path):
+    isolated_master.COLD_STORAGE = [str(tmp_path / 'cold')]
+    isolated_master.load()
+    large = isolated_master.save(FileStorage(io.BytesIO(b'a' * 8192), 'large.txt'))
+    other = isolated_master.save(FileStorage(io.BytesIO(b'b' * 8192), 'other.txt'))
+
+    # nothing was downloaded for too long
+    mover = TierMover(isolated_master, AccessTracker(half_life=60), promote_score=1.5, demote_after=-1)
+    assert mover.run()["demoted"] == 2
+    assert [tier["objects"] for tier in mover.placement] == [0, 2]
+
+    cold_path = isolated_master.path(isolated_master.get(large))
+    assert cold_path.startswith(str(tmp_path / 'cold'))
+    with isolated_master.open(isolated_master.get(large)) as f:
+        assert f.read() == b'a' * 8192
+    assert isolated_master.reconcile() == {"added": 0, "removed": 0, "resized": 0}
+
+    # downloaded often enough to come back
+    mover.tracker.hit(large)
+    mover.tracker.hit(large)
+    mover.demote_after = 3600
+    assert mover.run()["promoted"] == 1
+    assert [tier["objects"] for tier in mover.placement] == [1, 1]
+    assert [tier["hot_objects"] for tier in mover.placement] == [1, 0]
+    assert not isolated_master.path(isolated_master.get(large)).startswith(str(tmp_path / 'cold'))
+    assert mover.working_set() == 8192
+
+    isolated_master.delete(isolated_master.get(other))
+    assert isolated_master.get(other) is None
+    assert os.path.exists(mover.access_log_path)
+
+
+def test_expiry_buckets(tmp_path):
+    catalog = Catalog(str(tmp_path), expiry_bucket=10)
+    catalog.load()
+    for i in range(10):
+        catalog.add(ObjectRecord(str(i) * 64, '', 1, expires=100 + i * 5))
+    catalog.add(ObjectRecord('a' * 64, '', 1))
+
+    assert catalog.expired(99, 100) == []
+    assert [r.hash[0] for r in sorted(catalog.expired(112, 100), key=lambda r: r.expires)] == ['0', '1', '2']
+    assert len(catalog.expired(1000, 4)) == 4
+
+    catalog.remove('0' * 64)
+    catalog.remove('1' * 64)
+    assert len(catalog.expired(112, 100)) == 1
+
+    # expiry survives a restart
+    restored = Catalog(str(tmp_path), expiry_bucket=10)
+    restored.load()
+    assert len(restored.expired(1000, 100)) == 8
+
+
+def test_expirer(isolated_master):
+    now = time.time()
+    expired = isolated_master.save(FileStorage(io.BytesIO(b'a' * 10), 'small.txt'), expires=now - 1)
+    large = isolated_master.save(FileStorage(io.BytesIO(b'a' * 8192), 'large.txt'), expires=now - 1)
+    kept = isolated_master.save(FileStorage(io.BytesIO(b'b' * 10), 'kept.txt'), expires=now + 3600)
+    forever = isolated_master.save(FileStorage(io.BytesIO(b'c' * 10), 'forever.txt'))
+
+    assert Expirer(isolated_master, batch_size=1, deletes_per_second=1000).run() == 2
+    assert isolated_master.get(expired) is None and isolated_master.get(large) is None
+    assert isolated_master.get(kept) is not None and isolated_master.get(forever) is not None
+    assert [e['op'] for e in isolated_master.oplog.read(0, 100)][-2:] == ['delete', 'delete']
+
+
+def test_validate_restored_catalog(isolated_master):
+    large = isolated_master.save(FileStorage(io.BytesIO(b'a' * 8192), 'large.txt'))
+    small = isolated_master.save(FileStorage(io.BytesIO(b'a' * 10), 'small.txt'))
+    gone = isolated_master.save(FileStorage(io.BytesIO(b'b' * 8192), 'gone.txt'))
+    isolated_master.catalog.compact()
+    os.remove(isolated_master.path(isolated_master.get(gone)))
+
+    isolated_master.load()
+    assert isolated_master.validate(batch_size=1, pause=0) == 1
+    assert set(isolated_master.catalog.records) == {large, small}
+
+
+def test_validate_keeps_files_saved_meanwhile(isolated_master, monkeypatch):
+    content = b'b' * 8192
+    gone = isolated_master.save(FileStorage(io.BytesIO(content), 'gone.txt'))
+    os.remove(isolated_master.path(isolated_master.get(gone)))
+    hold = isolated_master.locks.hold
+
+    @contextlib.contextmanager
+    def save_after_release(hash_string):
+        with hold(hash_string):
+            yield
+        # uploaded again right after validate() looked for it
+        if hash_string == gone:
+            monkeypatch.setattr(isolated_master.locks, 'hold', hold)
+            try:
+                isolated_master.save(FileStorage(io.BytesIO(content), 'gone.txt'))
+            except FileExistsError:
+                pass
+
+    monkeypatch.setattr(isolated_master.locks, 'hold', save_after_release)
+    isolated_master.validate(batch_size=1, pause=0)
+    assert isolated_master.catalog.get(gone) is not None
+    assert isolated_master.exists(gone)
+
+
+def test_concurrent_saves_of_one_file(isolated_master):
+    content = b'same content' * 1000
+    results = []
+
+    def save():
+        try:
+            results.append(isolated_master.save(FileStorage(io.BytesIO(content), 'same.txt')))
+        except FileExistsError:
+            results.append(None)
+
+    threads = [threading.Thread(target=save) for _ in range(8)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    stored = [h for h in results if h is not None]
+    assert len(stored) == 1 and results.count(None) == 7
+    assert len(isolated_master.catalog) == 1
+    assert not os.listdir(isolated_master.TEMP)
+
+    isolated_master.delete(stored[0] + '.txt')
+    # a second delete finds nothing and the shard is gone
+    isolated_master.delete(stored[0] + '.txt')
+    assert isolated_master.get(stored[0]) is None
+    assert not os.path.exists(os.path.join(isolated_master.STORAGE, stored[0][:2]))
+
+
+def test_fsck_and_inventory(isolated_master):
+    stored = isolated_master.save(FileStorage(io.BytesIO(b'stored content' * 1000), 'stored.txt'))
+    packed = isolated_master.save(FileStorage(io.BytesIO(b'packed content'), 'packed.txt'))
+    storage = isolated_master.STORAGE
+
+    def put(*path, content=b'data'):
+        path = os.path.join(storage, *path)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as f:
+            f.write(content)
+        return path
+
+    other = ('e' if stored[0] != 'e' else 'd') * 64
+    misplaced = put(stored[:2], other + '.bin')
+    bad_name = put(stored[:2], 'not-a-hash.txt')
+    # placeholder left by a crashed save
+    empty = put(other[:2], other, content=b'')
+    duplicate = put(stored[:2], stored + '.jpg')
+    orphan = put('temporary', 'upload.txt')
+    os.utime(orphan, (0, 0))
+    empty_shard = next(name for name in ('ab', 'cd') if name != stored[:2])
+    os.makedirs(os.path.join(storage, empty_shard))
+
+    out = io.StringIO()
+    stats = StorageCheck(isolated_master, workers=2, output=out).fsck()
+    findings = [json.loads(line) for line in out.getvalue().splitlines()]
+    by_problem = dict((f["problem"], f) for f in findings)
+
+    assert stats["unrepaired"] == len(findings) == 6
+    assert by_problem["misplaced"]["path"] == misplaced
+    assert by_problem["bad_name"]["path"] == bad_name
+    assert by_problem["empty"]["path"] == empty
+    assert by_problem["orphan_temp"]["path"] == orphan
+    assert by_problem["duplicate"]["hash"] == stored
+    assert sorted(c["extension"] for c in by_problem["duplicate"]["copies"]) == ['.jpg', '.txt']
+    assert by_problem["empty_shard"]["path"] == os.path.join(storage, empty_shard)
+
+    out = io.StringIO()
+    stats = StorageCheck(isolated_master, workers=2, output=out).fsck(repair=True)
+    assert stats["unrepaired"] == 0
+    assert all(json.loads(line)["repaired"] for line in out.getvalue().splitlines())
+    assert not os.path.exists(duplicate) and not os.path.exists(orphan) and not os.path.exists(empty)
+    assert os.path.exists(os.path.join(storage, other[:2], other + '.bin'))
+    assert os.path.exists(os.path.join(isolated_master.QUARANTINE, 'not-a-hash.txt'))
+    assert isolated_master.get(stored) == stored + '.txt'
+    # moved into its shard, and now in the catalog
+    assert other in isolated_master.catalog
+
+    out = io.StringIO()
+    assert StorageCheck(isolated_master, workers=2, output=out).fsck() == {"unrepaired": 0}
+
+    out = io.StringIO()
+    assert StorageCheck(isolated_master, workers=2, output=out).inventory() == 3
+    listed = dict((record["hash"], record) for record in map(json.loads, out.getvalue().splitlines()))
+    assert listed[stored]["extension"] == '.txt' and listed[stored]["tier"] == 0
+    assert listed[packed]["tier"] == 'packs'
+
+
+def test_storage_is_claimed_by_one_process(isolated_master):
+    class SecondMaster(isolated_master):
+        owner_pid = None
+
+    isolated_master.claim()
+    isolated_master.claim()
+    with pytest.raises(RuntimeError):
+        SecondMaster.claim()
+
+    # a forked worker must not change the storage of its parent
+    pid = os.fork()
+    if pid == 0:
+        try:
+            isolated_master.save(FileStorage(io.BytesIO(b'forked' * 1000), 'forked.txt'))
+        except RuntimeError:
+            os._exit(0)
+        os._exit(1)
+    assert os.waitpid(pid, 0)[1] == 0
+    assert len(isolated_master.catalog) == 0
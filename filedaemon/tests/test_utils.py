@@ -1,3 +1,10 @@
+import io
+import os
+import json
+import time
+import queue
+import multiprocessing
+import logging
 import pytest
 
 # from tests.environment import (generate_random_url, get_invalid_hashes,
@@ -8,6 +15,13 @@ from storage.manager import StorageMaster, EmptyFileException
 
 
 from utils.encryption import encrypt_string, verify_hash
+from utils.iopolicy import CachingSpool, CachingWriter, StreamingReader
+from utils.asynclog import BatchingFileHandler, JsonFormatter
+from utils.bloom import CountingBloomFilter
+from utils.delta import DeltaError, DeltaTooLargeError, DeltaStream, compute_delta, encode_copy, signature
+from utils.locks import HashLocks
+from utils.metrics import Metrics, metrics
+from utils.ratelimit import TokenBucket
 from config import HASHING_METHOD, HASH_LENGTH
 from tests.environment import generate_pseudo_word
 
@@ -36,3 +50,179 @@ def test_valid_hashes_is_valid():
 
     for word in words:
         assert verify_hash(encrypt_string(word))
+
+
+def test_token_bucket():
+    now = [0.0]
+    bucket = TokenBucket(rate=10, capacity=20, clock=lambda: now[0])
+
+    assert bucket.try_consume(20)
+    assert not bucket.try_consume(1)
+    assert bucket.retry_after(5) == pytest.approx(0.5)
+
+    now[0] += 1
+    assert bucket.try_consume(10)
+
+    # Unconditional consumption goes into debt
+    assert bucket.consume(30) == pytest.approx(3)
+    assert not bucket.try_consume(1)
+
+
+def test_metrics_registry():
+    registry = Metrics()
+    registry.inc('requests', client='a')
+    registry.inc('requests', 2, client='a')
+    registry.inc('requests', client='b')
+    registry.set('lag', 5)
+
+    assert registry.get('requests', client='a') == 3
+    assert registry.get('lag') == 5
+
+    registry.forget(client='a')
+    snapshot = registry.snapshot()
+    assert snapshot['requests'] == [{"labels": {"client": "b"}, "value": 1}]
+
+
+def test_counting_bloom_filter():
+    hashes = [encrypt_string(str(i)) for i in range(2000)]
+    bloom = CountingBloomFilter.build(hashes[:1000], capacity=1000, error_rate=0.01)
+
+    # No false negatives and about error_rate false positives
+    assert all(h in bloom for h in hashes[:1000])
+    assert sum(h in bloom for h in hashes[1000:]) < 50
+
+    for h in hashes[:500]:
+        bloom.remove(h)
+    assert all(h in bloom for h in hashes[500:1000])
+    assert sum(h in bloom for h in hashes[:500]) < 25
+    assert bloom.count == 500
+
+    # Not a hex string
+    bloom.add('not a hash')
+    assert 'not a hash' in bloom
+
+
+def test_batching_file_handler(tmp_path):
+    path = str(tmp_path / 'access.log')
+    handler = BatchingFileHandler(path, maxBytes=2000, backupCount=2, batch_size=10)
+    handler.setFormatter(JsonFormatter())
+    logger = logging.getLogger('test-batching')
+    logger.addHandler(handler)
+    logger.propagate = False
+    logger.setLevel(logging.INFO)
+    try:
+        for i in range(300):
+            logger.info('', extra={"access": {"i": i, "padding": 'x' * 20}})
+        logger.error('failed')
+    finally:
+        handler.close()
+        logger.removeHandler(handler)
+
+    # rotated by size, only the last backups are kept
+    assert os.path.getsize(path) <= 2000
+    assert os.path.exists(path + '.2') and not os.path.exists(path + '.3')
+    with open(path) as f:
+        lines = [json.loads(line) for line in f]
+    assert lines[-2] == {"i": 299, "padding": 'x' * 20}
+    assert lines[-1]["message"] == 'failed' and lines[-1]["level"] == 'ERROR'
+
+    # records that don't fit into the queue are counted in metrics
+    handler = BatchingFileHandler(path, queue_size=1)
+    writer_queue, handler.queue = handler.queue, queue.Queue(1)
+    dropped = metrics.get('log_records_dropped')
+    try:
+        for i in range(3):
+            handler.emit(logging.makeLogRecord({"msg": str(i)}))
+    finally:
+        handler.queue = writer_queue
+        handler.close()
+    assert handler.dropped == 2 and metrics.get('log_records_dropped') == dropped + 2
+
+
+def _hold_hash_lock(lock_path: str, acquired) -> None:
+    with HashLocks(lock_path).hold('ab' * 32):
+        acquired.value = time.time()
+
+
+def test_hash_locks_exclude_processes(tmp_path):
+    locks = HashLocks(str(tmp_path / '.locks'))
+    context = multiprocessing.get_context('fork')
+    acquired = context.Value('d', 0)
+
+    with locks.hold('ab' * 32):
+        child = context.Process(target=_hold_hash_lock, args=(locks.lock_path, acquired))
+        child.start()
+        time.sleep(0.5)
+        assert acquired.value == 0
+        released = time.time()
+    child.join(10)
+    assert acquired.value >= released
+
+    # other hashes aren't held up
+    with locks.hold('ab' * 32), locks.hold('cd' * 32):
+        pass
+
+
+def test_delta_round_trip():
+    base = os.urandom(50000)
+    versions = [
+        base,
+        base[:20000] + b'inserted' + base[20000:],
+        base[:10000] + base[15000:],
+        b'prefix' + base + b'suffix',
+        os.urandom(3000),
+        b'',
+    ]
+    for block_size in (512, 4096):
+        blocks = signature(io.BytesIO(base), block_size)
+        assert len(blocks) == -(-len(base) // block_size)
+        for version in versions:
+            delta = b''.join(compute_delta(version, blocks, block_size, len(base)))
+            stream = io.BufferedReader(DeltaStream(io.BytesIO(delta), base, len(base)))
+            assert stream.read() == version
+            if version == base:
+                assert len(delta) < 20 and stream.raw.literal_bytes == 0
+
+
+def test_delta_rejects_copies_out_of_base():
+    stream = DeltaStream(io.BytesIO(encode_copy(100, 10)), b'x' * 105, 105)
+    with pytest.raises(DeltaError):
+        stream.read()
+    with pytest.raises(DeltaError):
+        DeltaStream(io.BytesIO(b'Z'), b'', 0).read()
+
+
+def test_delta_output_is_limited():
+    # 13 bytes per op, each makes the whole base again
+    delta = encode_copy(0, 1000) * 100
+    assert len(DeltaStream(io.BytesIO(delta), b'x' * 1000, 1000, max_size=100000).read()) == 100000
+    stream = DeltaStream(io.BytesIO(delta), b'x' * 1000, 1000, max_size=50000)
+    with pytest.raises(DeltaTooLargeError):
+        stream.read()
+    assert stream.copied_bytes <= 50000
+
+
+@pytest.mark.parametrize('direct', [False, True])
+def test_caching_writer(tmp_path, direct):
+    data = os.urandom(300 * 1000 + 7)
+    path = tmp_path / 'written'
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT)
+    with CachingWriter(fd, policy=True, large=100 * 1000, window=64 * 1024, direct=direct) as writer:
+        for start in range(0, len(data), 65536 - 1):
+            writer.write(data[start:start + 65536 - 1])
+    assert path.read_bytes() == data
+
+    with StreamingReader(str(path), policy=True, large=100 * 1000, readahead=64 * 1024) as reader:
+        assert reader.streaming and reader.size == len(data)
+        assert b''.join(iter(lambda: reader.read(10000), b'')) == data
+
+
+def test_caching_spool(tmp_path):
+    data = os.urandom(200 * 1000)
+    with CachingSpool(str(tmp_path), window=16 * 1024) as spool:
+        # unlinked, nothing is left behind
+        assert not os.listdir(tmp_path)
+        for start in range(0, len(data), 10000):
+            spool.write(data[start:start + 10000])
+        spool.seek(0)
+        assert spool.read() == data
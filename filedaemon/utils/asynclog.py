@@ -0,0 +1,142 @@
+import io
+import os
+import json
+import queue
+import logging
+import threading
+
+from typing import List, Optional
+
+from .metrics import metrics
+
+
+class JsonFormatter(logging.Formatter):
+    """
+    One JSON object per line.
+    Records logged with an "access" dict in extra are written as the dict alone
+    """
+
+    def format(self, record: logging.LogRecord) -> str:
+        access = getattr(record, 'access', None)
+        if access is not None:
+            return json.dumps(access, default=str)
+
+        entry = {
+            "time": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["traceback"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BatchingFileHandler(logging.Handler):
+    """
+    File handler that never blocks the thread logging a record.
+
+    Records are put in a bounded queue, and a writer thread formats them
+    and writes them to the file in batches. Records that don't fit
+    into the queue are dropped and counted in log_records_dropped.
+    The file is rotated like with logging.handlers.RotatingFileHandler
+    """
+
+    def __init__(self, filename: str, maxBytes: int = 0, backupCount: int = 0, encoding: str = 'utf-8',
+                 queue_size: int = 10000, batch_size: int = 256):
+        super().__init__()
+        self.filename = os.path.abspath(filename)
+        self.max_bytes = maxBytes
+        self.backup_count = backupCount
+        self.encoding = encoding
+        self.batch_size = batch_size
+        self.dropped = 0
+        self.queue: 'queue.Queue[Optional[logging.LogRecord]]' = queue.Queue(queue_size)
+        self._stream: Optional[io.BufferedWriter] = None
+        self._writer = threading.Thread(target=self._write_forever, name='log-writer', daemon=True)
+        self._writer.start()
+
+    def emit(self, record: logging.LogRecord) -> None:
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+            metrics.inc('log_records_dropped')
+
+    def _open(self) -> io.BufferedWriter:
+        if self._stream is None:
+            self._stream = open(self.filename, 'ab')
+        return self._stream
+
+    def _discard(self) -> None:
+        if self._stream is not None:
+            try:
+                self._stream.close()
+            except OSError:
+                # buffered data that can't be written is lost
+                pass
+            self._stream = None
+
+    def _rotate(self) -> None:
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        if self.backup_count:
+            for i in range(self.backup_count - 1, 0, -1):
+                source = f'{self.filename}.{i}'
+                if os.path.exists(source):
+                    os.replace(source, f'{self.filename}.{i + 1}')
+            os.replace(self.filename, self.filename + '.1')
+        else:
+            open(self.filename, 'wb').close()
+
+    def _write(self, batch: List[logging.LogRecord]) -> None:
+        lines = []
+        for record in batch:
+            try:
+                lines.append(self.format(record))
+            except Exception:
+                self.handleError(record)
+        if not lines:
+            return
+
+        data = ('\n'.join(lines) + '\n').encode(self.encoding)
+        stream = self._open()
+        if self.max_bytes and stream.tell() and stream.tell() + len(data) > self.max_bytes:
+            self._rotate()
+            stream = self._open()
+        stream.write(data)
+        stream.flush()
+
+    def _write_forever(self) -> None:
+        while True:
+            record = self.queue.get()
+            batch = []
+            while record is not None:
+                batch.append(record)
+                if len(batch) == self.batch_size:
+                    break
+                try:
+                    record = self.queue.get_nowait()
+                except queue.Empty:
+                    break
+            try:
+                self._write(batch)
+            except OSError:
+                # the disk is full or the directory is gone, try the next batch
+                self._discard()
+            if record is None:
+                return
+
+    def close(self) -> None:
+        """
+        Write everything queued so far and stop the writer
+        """
+
+        if self._writer.is_alive():
+            self.queue.put(None)
+            self._writer.join()
+        if self._stream is not None:
+            self._stream.close()
+            self._stream = None
+        super().close()
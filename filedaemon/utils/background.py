@@ -0,0 +1,32 @@
+import logging
+import threading
+
+from typing import Any, Callable, Optional
+
+
+class PeriodicTask(threading.Thread):
+    """
+    Daemon thread that calls function every interval seconds
+    until it's stopped
+    """
+
+    def __init__(self, name: str, interval: float, function: Callable[[], Any], delay: Optional[float] = None):
+        super().__init__(name=name, daemon=True)
+        self.interval = interval
+        self.function = function
+        self.delay = interval if delay is None else delay
+        self._stopped = threading.Event()
+
+    def run(self) -> None:
+        timeout = self.delay
+        while not self._stopped.wait(timeout):
+            try:
+                self.function()
+            except Exception:
+                logging.getLogger('file').exception('%s failed', self.name)
+            timeout = self.interval
+
+    def stop(self, wait: bool = True) -> None:
+        self._stopped.set()
+        if wait and self.is_alive() and threading.current_thread() is not self:
+            self.join()
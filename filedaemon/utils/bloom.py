@@ -0,0 +1,64 @@
+import math
+
+from typing import Iterable, List
+
+from config import HASHING_METHOD
+
+
+class CountingBloomFilter(object):
+    """
+    Bloom filter with a small counter instead of a bit,
+    so keys can be removed as well as added.
+
+    False positives happen with error_rate probability
+    while there are no more than capacity keys, false negatives never do
+    """
+
+    def __init__(self, capacity: int, error_rate: float = 0.01):
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.size = max(8, int(-capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, round(self.size / capacity * math.log(2)))
+        self.counters = bytearray(self.size)
+        self.count = 0
+
+    def _positions(self, key: str) -> List[int]:
+        # Object hashes are uniformly distributed already,
+        # two halves of one make the rest with double hashing
+        try:
+            first, second = int(key[:16], 16), int(key[16:32], 16)
+        except ValueError:
+            digest = HASHING_METHOD(key.encode('utf-8')).hexdigest()
+            first, second = int(digest[:16], 16), int(digest[16:32], 16)
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key: str) -> None:
+        for position in self._positions(key):
+            # a saturated counter is never decremented again
+            if self.counters[position] < 255:
+                self.counters[position] += 1
+        self.count += 1
+
+    def remove(self, key: str) -> None:
+        """
+        Remove a key that was added. Removing any other key,
+        even one the filter has a false positive for, makes false negatives
+        """
+
+        positions = self._positions(key)
+        if not all(self.counters[position] for position in positions):
+            return
+        for position in positions:
+            if self.counters[position] < 255:
+                self.counters[position] -= 1
+        self.count -= 1
+
+    def __contains__(self, key: str) -> bool:
+        return all(self.counters[position] for position in self._positions(key))
+
+    @classmethod
+    def build(cls, keys: Iterable[str], capacity: int, error_rate: float = 0.01) -> 'CountingBloomFilter':
+        bloom = cls(capacity, error_rate)
+        for key in keys:
+            bloom.add(key)
+        return bloom
@@ -0,0 +1,243 @@
+"""
+rsync-style deltas.
+
+A signature lists a weak (adler32) and a strong checksum of every block of a base file.
+Whoever has a new version of the file finds the blocks it shares with the base
+by rolling the weak checksum over it byte by byte, and describes the new file
+as a delta: literal data and ranges of the base to copy. The delta is a stream of
+
+    b'L' + length (uint32) + literal bytes
+    b'C' + offset (uint64) + length (uint32)
+"""
+
+import io
+import os
+import struct
+import hashlib
+import zlib
+
+from typing import BinaryIO, Dict, Iterator, List, Optional, Tuple, Union
+
+
+OP_LITERAL = b'L'
+OP_COPY = b'C'
+_LITERAL = struct.Struct('>I')
+_COPY = struct.Struct('>QI')
+
+# adler32 modulus
+_MOD = 65521
+# literal data is split into ops of at most this size
+MAX_LITERAL = 2 ** 20
+
+Signature = List[Tuple[int, str]]
+
+
+class DeltaError(ValueError):
+    """
+    Raised if a delta is malformed or refers to data the base doesn't have
+    """
+
+    def __init__(self, message: str):
+        self.message = message
+        super().__init__(message)
+
+
+class DeltaTooLargeError(DeltaError):
+    """
+    Raised if a delta makes a file larger than it's allowed to be
+    """
+
+
+def strong_checksum(block: Union[bytes, memoryview]) -> str:
+    return hashlib.blake2b(block, digest_size=16).hexdigest()
+
+
+def signature(fileobj: BinaryIO, block_size: int) -> Signature:
+    """
+    (weak, strong) checksums of every block of fileobj, the last one can be shorter
+    """
+
+    blocks: Signature = []
+    while True:
+        block = fileobj.read(block_size)
+        if not block:
+            return blocks
+        blocks.append((zlib.adler32(block), strong_checksum(block)))
+
+
+def encode_literal(data: Union[bytes, memoryview]) -> Iterator[bytes]:
+    for start in range(0, len(data), MAX_LITERAL):
+        chunk = data[start:start + MAX_LITERAL]
+        yield OP_LITERAL + _LITERAL.pack(len(chunk))
+        yield bytes(chunk)
+
+
+def encode_copy(offset: int, length: int) -> bytes:
+    return OP_COPY + _COPY.pack(offset, length)
+
+
+def compute_delta(data: Union[bytes, memoryview], blocks: Signature, block_size: int,
+                  base_size: int) -> Iterator[bytes]:
+    """
+    Delta turning the base described by blocks into data.
+
+    The weak checksum is rolled in Python only over data the base doesn't have,
+    blocks that match are checked with zlib and skipped as a whole
+    """
+
+    table: Dict[int, List[Tuple[int, str]]] = {}
+    for index, (weak, strong) in enumerate(blocks):
+        table.setdefault(weak, []).append((index, strong))
+
+    # a shorter last block of the base can only match the end of data
+    tail: Optional[Tuple[int, int]] = None
+    tail_size = base_size - (len(blocks) - 1) * block_size if blocks else 0
+    if 0 < tail_size < block_size:
+        tail = (len(blocks) - 1, tail_size)
+        weak, strong = blocks[-1]
+        table[weak].remove((tail[0], strong))
+
+    size = len(data)
+    position = literal_from = 0
+    copy: Optional[List[int]] = None  # offset and length of the copy being extended
+    weak: Optional[int] = None
+    a = b = 0
+
+    def emit(offset: int, length: int) -> Iterator[bytes]:
+        nonlocal copy
+        if position > literal_from:
+            if copy is not None:
+                yield encode_copy(*copy)
+                copy = None
+            yield from encode_literal(data[literal_from:position])
+        if copy is not None and copy[0] + copy[1] == offset:
+            copy[1] += length
+            return
+        if copy is not None:
+            yield encode_copy(*copy)
+        copy = [offset, length]
+
+    while position + block_size <= size:
+        if weak is None:
+            weak = zlib.adler32(data[position:position + block_size])
+            a, b = weak & 0xffff, weak >> 16
+
+        candidates = table.get(weak)
+        if candidates:
+            strong = strong_checksum(data[position:position + block_size])
+            found = next((index for index, candidate in candidates if candidate == strong), None)
+            if found is not None:
+                yield from emit(found * block_size, block_size)
+                position = literal_from = position + block_size
+                weak = None
+                continue
+
+        if position + block_size < size:
+            out_byte, in_byte = data[position], data[position + block_size]
+            a = (a - out_byte + in_byte) % _MOD
+            b = (b - block_size * out_byte + a - 1) % _MOD
+            weak = a | b << 16
+        position += 1
+
+    if tail is not None and size - tail[1] >= literal_from:
+        index, length = tail
+        end = data[size - length:]
+        if zlib.adler32(end) == blocks[index][0] and strong_checksum(end) == blocks[index][1]:
+            position = size - length
+            yield from emit(index * block_size, length)
+            literal_from = size
+
+    position = size
+    if position > literal_from:
+        if copy is not None:
+            yield encode_copy(*copy)
+            copy = None
+        yield from encode_literal(data[literal_from:])
+    if copy is not None:
+        yield encode_copy(*copy)
+
+
+class DeltaStream(io.RawIOBase):
+    """
+    Readable stream of the file a delta describes.
+
+    Literal data is read from the delta, copies are read from the base right into
+    the caller's buffer with preadv, or sliced out of it if it's in memory.
+    A short delta can make a huge file, so the file is limited to max_size bytes
+    """
+
+    def __init__(self, delta: BinaryIO, base: Union[int, bytes, memoryview], base_size: int,
+                 max_size: Optional[int] = None):
+        super().__init__()
+        self._delta = delta
+        self._base = base
+        self._base_size = base_size
+        self.max_size = max_size
+        # bytes of the file made by the ops read so far
+        self._planned = 0
+        # op being read and how many of its bytes are left
+        self._op: Optional[bytes] = None
+        self._left = 0
+        self._offset = 0
+        self.literal_bytes = 0
+        self.copied_bytes = 0
+
+    def readable(self) -> bool:
+        return True
+
+    def _read_exactly(self, size: int) -> bytes:
+        data = b''
+        while len(data) < size:
+            chunk = self._delta.read(size - len(data))
+            if not chunk:
+                raise DeltaError('Delta is truncated')
+            data += chunk
+        return data
+
+    def _next_op(self) -> bool:
+        op = self._delta.read(1)
+        if not op:
+            return False
+        if op == OP_LITERAL:
+            self._left, = _LITERAL.unpack(self._read_exactly(_LITERAL.size))
+        elif op == OP_COPY:
+            self._offset, self._left = _COPY.unpack(self._read_exactly(_COPY.size))
+            if self._offset + self._left > self._base_size:
+                raise DeltaError(f'Delta copies bytes {self._offset}-{self._offset + self._left} '
+                                 f'of a {self._base_size} bytes long base')
+        else:
+            raise DeltaError(f'Unknown delta operation {op!r}')
+        self._planned += self._left
+        if self.max_size is not None and self._planned > self.max_size:
+            raise DeltaTooLargeError(f'Delta makes a file over {self.max_size} bytes')
+        self._op = op
+        return True
+
+    def readinto(self, buffer: Union[bytearray, memoryview]) -> int:
+        while not self._left:
+            if not self._next_op():
+                return 0
+
+        view = memoryview(buffer).cast('B')
+        size = min(len(view), self._left)
+        if self._op == OP_LITERAL:
+            read = self._delta.readinto(view[:size]) if hasattr(self._delta, 'readinto') else None
+            if read is None:
+                chunk = self._delta.read(size)
+                read = len(chunk)
+                view[:read] = chunk
+            if not read:
+                raise DeltaError('Delta is truncated')
+            self.literal_bytes += read
+        else:
+            if isinstance(self._base, int):
+                read = os.preadv(self._base, [view[:size]], self._offset)
+                if read == 0:
+                    raise DeltaError('Base is shorter than its signature')
+            else:
+                view[:size] = self._base[self._offset:self._offset + size]
+                read = size
+            self._offset += read
+            self.copied_bytes += read
+        self._left -= read
+        return read
@@ -0,0 +1,109 @@
+import os
+import re
+import json
+import mmap
+import zlib
+
+from typing import Any, Dict, Iterable, Optional, Sequence, Tuple
+
+
+MAGIC = b'FDINDEX1\n'
+CHUNK_SIZE = 4 * 2 ** 20  # 4mb
+
+_ESCAPED = re.compile(r'\\(.)')
+_UNESCAPE = {'t': '\t', 'n': '\n'}
+
+
+def escape(field: str) -> str:
+    return field.replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n')
+
+
+def unescape(field: str) -> str:
+    """
+    Field of a row as it was before write_index escaped it
+    """
+
+    if '\\' not in field:
+        return field
+    return _ESCAPED.sub(lambda match: _UNESCAPE.get(match.group(1), match.group(1)), field)
+
+
+def _line(row: Sequence[Any]) -> str:
+    line = '\t'.join(map(str, row))
+    # only a few rows have anything to escape
+    if line.count('\t') != len(row) - 1 or '\n' in line or '\\' in line:
+        line = '\t'.join(escape(str(field)) for field in row)
+    return line + '\n'
+
+
+def write_index(path: str, header: Dict[str, Any], rows: Iterable[Sequence[Any]]) -> None:
+    """
+    Atomically write rows as tab separated lines, tabs, newlines and backslashes
+    in fields are escaped, see unescape.
+    The header goes to the last line together with the checksum of the rows
+    """
+
+    temp_path = path + '.tmp'
+    crc, length, count = 0, 0, 0
+    with open(temp_path, 'wb') as f:
+        f.write(MAGIC)
+        for row in rows:
+            line = _line(row).encode('utf-8')
+            crc = zlib.crc32(line, crc)
+            length += len(line)
+            count += 1
+            f.write(line)
+        f.write(json.dumps({**header, "rows": count, "length": length, "crc32": crc}).encode('utf-8'))
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(temp_path, path)
+
+
+def _trailer(mapped: mmap.mmap) -> Tuple[Dict[str, Any], int]:
+    end = mapped.rfind(b'\n')
+    return json.loads(mapped[end + 1:]), end + 1
+
+
+def is_index(path: str) -> bool:
+    try:
+        with open(path, 'rb') as f:
+            return f.read(len(MAGIC)) == MAGIC
+    except FileNotFoundError:
+        return False
+
+
+def read_index(path: str) -> Optional[Tuple[Dict[str, Any], str]]:
+    """
+    Header and rows of an index file without checking them,
+    see verify_index
+
+    Returns:
+        None if it's not an index file
+    """
+
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size <= len(MAGIC):
+            return None
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            if mapped[:len(MAGIC)] != MAGIC:
+                return None
+            header, end = _trailer(mapped)
+            return header, mapped[len(MAGIC):end].decode('utf-8')
+
+
+def verify_index(path: str) -> bool:
+    """
+    Check rows of an index file against the checksum, a chunk at a time
+    """
+
+    try:
+        with open(path, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped:
+            header, end = _trailer(mapped)
+            if end - len(MAGIC) != header["length"]:
+                return False
+            crc = 0
+            for offset in range(len(MAGIC), end, CHUNK_SIZE):
+                crc = zlib.crc32(mapped[offset:min(offset + CHUNK_SIZE, end)], crc)
+            return crc == header["crc32"]
+    except (ValueError, KeyError):
+        return False
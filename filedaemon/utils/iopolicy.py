@@ -0,0 +1,259 @@
+"""
+Page cache policies by file size.
+
+Small files are cached as usual. Large ones are streamed around the page cache:
+downloads are read sequentially with readahead and drop what they've sent,
+uploads drop what they've written or bypass the cache with O_DIRECT,
+so one large transfer doesn't push the hot small files out of memory.
+"""
+
+import io
+import os
+import mmap
+import tempfile
+
+from typing import Any, Iterator, Tuple
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    fcntl = None
+
+from config import IO_CACHE_POLICY, IO_LARGE_FILE, IO_READAHEAD, IO_WRITE_WINDOW, IO_DIRECT_WRITES
+
+
+# O_DIRECT needs offsets and sizes aligned to the logical block size
+DIRECT_ALIGNMENT = 4096
+DIRECT_BUFFER_SIZE = 2 ** 20  # 1mb
+
+
+def advise(fd: int, offset: int, length: int, advice: str) -> None:
+    """
+    posix_fadvise where it's available, hints are never worth a failure
+    """
+
+    if not hasattr(os, 'posix_fadvise'):
+        return
+    try:
+        os.posix_fadvise(fd, offset, length, getattr(os, advice))
+    except OSError:
+        pass
+
+
+def io_samples() -> Iterator[Tuple[str, dict, float]]:
+    """
+    Bytes the process read and wrote, and how many of them reached the disk.
+    rchar - read_bytes is roughly what the page cache served
+    """
+
+    try:
+        with open('/proc/self/io', 'r') as f:
+            counters = dict(line.split(': ') for line in f.read().splitlines())
+    except (OSError, ValueError):
+        return
+    for name in ('rchar', 'wchar', 'read_bytes', 'write_bytes'):
+        if name in counters:
+            yield f'process_io_{name}', {}, int(counters[name])
+
+
+class DropBehind(object):
+    """
+    Drops pages of a file being written or read sequentially, a window behind.
+    Dropping a window starts its writeback, so by the next call it's clean and goes
+    """
+
+    def __init__(self, fd: int, window: int = IO_WRITE_WINDOW):
+        self.fd = fd
+        self.window = window
+        self.reset()
+
+    def reset(self) -> None:
+        self._dropped = self._advised = 0
+
+    def advance(self, position: int) -> None:
+        if position - self._advised < self.window:
+            return
+        advise(self.fd, self._advised, position - self._advised, 'POSIX_FADV_DONTNEED')
+        if self._dropped < self._advised:
+            advise(self.fd, self._dropped, self._advised - self._dropped, 'POSIX_FADV_DONTNEED')
+        self._dropped, self._advised = self._advised, position
+
+
+class CachingSpool(io.FileIO):
+    """
+    Unlinked file in directory a large multipart upload is parsed into
+    before it's hashed, written and read back around the page cache
+    """
+
+    def __init__(self, directory: str, window: int = IO_WRITE_WINDOW):
+        fd, path = tempfile.mkstemp(dir=directory)
+        os.unlink(path)
+        super().__init__(fd, 'r+')
+        self._behind = DropBehind(fd, window)
+
+    def write(self, data: Any) -> int:
+        written = super().write(data)
+        self._behind.advance(self.tell())
+        return written
+
+    def readinto(self, buffer: Any) -> int:
+        read = super().readinto(buffer)
+        self._behind.advance(self.tell())
+        return read
+
+    def seek(self, offset: int, whence: int = os.SEEK_SET) -> int:
+        position = super().seek(offset, whence)
+        self._behind.reset()
+        if position == 0:
+            advise(self.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+        return position
+
+
+def spool(directory: str, size: int, policy: bool = IO_CACHE_POLICY, large: int = IO_LARGE_FILE) -> Any:
+    """
+    Where a multipart upload of size bytes is parsed into,
+    None leaves it to werkzeug
+    """
+
+    if policy and size >= large:
+        return CachingSpool(directory)
+    return None
+
+
+class StreamingReader(io.FileIO):
+    """
+    Stored file opened for a download.
+    Large files are read ahead IO_READAHEAD bytes at a time
+    and the pages already sent are dropped behind the reader
+    """
+
+    def __init__(self, path: str, policy: bool = IO_CACHE_POLICY, large: int = IO_LARGE_FILE,
+                 readahead: int = IO_READAHEAD):
+        super().__init__(path, 'rb')
+        self.size = os.fstat(self.fileno()).st_size
+        self.streaming = policy and self.size >= large
+        self.readahead = readahead
+        self._advised = 0
+        self._dropped = 0
+        if self.streaming:
+            advise(self.fileno(), 0, 0, 'POSIX_FADV_SEQUENTIAL')
+            self._read_ahead(0)
+
+    def _read_ahead(self, position: int) -> None:
+        # half of the window is left to read
+        if self._advised < self.size and position + self.readahead // 2 >= self._advised:
+            advise(self.fileno(), self._advised, self.readahead, 'POSIX_FADV_WILLNEED')
+            self._advised += self.readahead
+        # what's a window behind was sent
+        if position - self._dropped >= 2 * self.readahead:
+            advise(self.fileno(), self._dropped, position - self.readahead - self._dropped, 'POSIX_FADV_DONTNEED')
+            self._dropped = position - self.readahead
+
+    def read(self, size: int = -1) -> bytes:
+        data = super().read(size)
+        if self.streaming and data:
+            self._read_ahead(self.tell())
+        return data
+
+    def readinto(self, buffer: Any) -> int:
+        read = super().readinto(buffer)
+        if self.streaming and read:
+            self._read_ahead(self.tell())
+        return read
+
+    def close(self) -> None:
+        if self.streaming and not self.closed:
+            advise(self.fileno(), 0, 0, 'POSIX_FADV_DONTNEED')
+        super().close()
+
+
+class CachingWriter(object):
+    """
+    Writer of an upload to a file descriptor it owns.
+
+    Once more than IO_LARGE_FILE bytes are written, the file is written with O_DIRECT
+    if IO_DIRECT_WRITES is set and the file system has it, otherwise what's written
+    is dropped a window behind
+    """
+
+    def __init__(self, fd: int, policy: bool = IO_CACHE_POLICY, large: int = IO_LARGE_FILE,
+                 window: int = IO_WRITE_WINDOW, direct: bool = IO_DIRECT_WRITES):
+        self.fd = fd
+        self.policy = policy
+        self.large = large
+        self.window = window
+        self.direct = direct and fcntl is not None and hasattr(os, 'O_DIRECT')
+        self.written = 0
+        self._behind = DropBehind(fd, window)
+        # aligned buffer of O_DIRECT writes, None until they start
+        self._buffer = None
+        self._buffered = 0
+
+    def __enter__(self) -> 'CachingWriter':
+        return self
+
+    def __exit__(self, *exc_info: Any) -> None:
+        self.close()
+
+    def _write_all(self, data: Any) -> None:
+        view = memoryview(data)
+        while view:
+            view = view[os.write(self.fd, view):]
+
+    def _start_direct(self) -> bool:
+        try:
+            fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) | os.O_DIRECT)
+        except OSError:
+            # tmpfs and some others don't have it
+            self.direct = False
+            return False
+        self._buffer = mmap.mmap(-1, DIRECT_BUFFER_SIZE)
+        return True
+
+    def _stop_direct(self) -> None:
+        fcntl.fcntl(self.fd, fcntl.F_SETFL, fcntl.fcntl(self.fd, fcntl.F_GETFL) & ~os.O_DIRECT)
+
+    def write(self, data: bytes) -> int:
+        size = len(data)
+        if self._buffer is not None:
+            view = memoryview(data)
+            while view:
+                taken = min(len(view), DIRECT_BUFFER_SIZE - self._buffered)
+                self._buffer[self._buffered:self._buffered + taken] = view[:taken]
+                self._buffered += taken
+                view = view[taken:]
+                if self._buffered == DIRECT_BUFFER_SIZE:
+                    self._write_all(self._buffer)
+                    self._buffered = 0
+            self.written += size
+            return size
+
+        if self.policy and self.direct and self.written + size > self.large:
+            # direct writes start at an aligned offset
+            head = -self.written % DIRECT_ALIGNMENT
+            if head < size:
+                self._write_all(data[:head])
+                self.written += head
+                if self._start_direct():
+                    self.write(data[head:])
+                    return size
+                data = data[head:]
+
+        self._write_all(data)
+        self.written += len(data)
+        if self.policy and self.written >= self.large:
+            self._behind.advance(self.written)
+        return size
+
+    def close(self) -> None:
+        try:
+            if self._buffer is not None:
+                # the tail isn't aligned, it's written through the cache
+                self._stop_direct()
+                self._write_all(self._buffer[:self._buffered])
+                self._buffer.close()
+                self._buffer = None
+            if self.policy and self.written >= self.large:
+                advise(self.fd, 0, 0, 'POSIX_FADV_DONTNEED')
+        finally:
+            os.close(self.fd)
@@ -0,0 +1,40 @@
+import math
+import time
+import threading
+
+from typing import Callable
+
+
+class DecayingAverage(object):
+    """
+    Exponentially weighted average of recent samples.
+    Without new samples it decays to 0 with half_life,
+    so a slow spell that's over stops counting
+    """
+
+    def __init__(self, weight: float = 0.1, half_life: float = 5, clock: Callable[[], float] = time.monotonic):
+        self.weight = weight
+        self.half_life = half_life
+        self._clock = clock
+        self._value = 0.0
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _decayed(self, now: float) -> float:
+        return self._value * math.pow(0.5, (now - self._updated) / self.half_life)
+
+    def add(self, sample: float) -> None:
+        with self._lock:
+            now = self._clock()
+            value = self._decayed(now)
+            self._value = value + self.weight * (sample - value)
+            self._updated = now
+
+    @property
+    def value(self) -> float:
+        with self._lock:
+            return self._decayed(self._clock())
+
+
+# seconds a write of an upload to the temp dir takes
+write_latency = DecayingAverage()
@@ -0,0 +1,62 @@
+import os
+import threading
+from contextlib import contextmanager
+
+from typing import Iterator, List, Optional
+
+try:
+    import fcntl
+except ImportError:  # pragma: no cover
+    # no other processes to exclude on Windows, thread locks are enough
+    fcntl = None
+
+
+class HashLocks(object):
+    """
+    Exclusive locks keyed by hash that hold across threads and processes.
+
+    Hashes are mapped onto a fixed number of ranges of lock_path, every range
+    is locked with a byte-range fcntl lock, so the daemon and offline tools exclude each other.
+    fcntl locks belong to a process, so threads of one are excluded by
+    a thread lock, one per stripes ranges.
+    """
+
+    def __init__(self, lock_path: str, stripes: int = 64, ranges: int = 4096):
+        # equal ranges always share a stripe
+        assert ranges % stripes == 0
+        self.lock_path = lock_path
+        self.ranges = ranges
+        self._stripes: List[threading.Lock] = [threading.Lock() for _ in range(stripes)]
+        self._fd: Optional[int] = None
+        self._pid: Optional[int] = None
+        self._open_lock = threading.Lock()
+
+    def range_of(self, hash_string: str) -> int:
+        try:
+            return int(hash_string[:8], 16) % self.ranges
+        except ValueError:
+            return hash(hash_string) % self.ranges
+
+    def _file(self) -> int:
+        # fcntl locks aren't inherited, forked workers open the file again
+        if self._fd is None or self._pid != os.getpid():
+            with self._open_lock:
+                if self._fd is None or self._pid != os.getpid():
+                    os.makedirs(os.path.dirname(self.lock_path), exist_ok=True)
+                    self._fd = os.open(self.lock_path, os.O_RDWR | os.O_CREAT, 0o644)
+                    self._pid = os.getpid()
+        return self._fd
+
+    @contextmanager
+    def hold(self, hash_string: str) -> Iterator[None]:
+        position = self.range_of(hash_string)
+        with self._stripes[position % len(self._stripes)]:
+            if fcntl is None:
+                yield
+                return
+            fd = self._file()
+            fcntl.lockf(fd, fcntl.LOCK_EX, 1, position)
+            try:
+                yield
+            finally:
+                fcntl.lockf(fd, fcntl.LOCK_UN, 1, position)
@@ -0,0 +1,197 @@
+import os
+import time
+import random
+import threading
+import collections
+import tracemalloc
+
+from typing import Any, Deque, Dict, Iterator, List, Optional, Tuple
+
+from .background import PeriodicTask
+from .metrics import metrics
+from config import MEMORY_TRACING, MEMORY_TRACE_FRAMES, MEMORY_SAMPLE_RATE, MEMORY_GAUGE_INTERVAL
+
+try:
+    import resource
+except ImportError:  # pragma: no cover
+    resource = None
+
+
+# allocations of the tracer itself and of imports aren't sites to look at
+IGNORED_FRAMES = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap>'),
+    tracemalloc.Filter(False, '<frozen importlib._bootstrap_external>'),
+    tracemalloc.Filter(False, '<unknown>'),
+)
+
+
+def rss_bytes() -> Optional[int]:
+    """
+    Resident set size of the process, or its peak where /proc isn't there
+    """
+
+    try:
+        with open('/proc/self/statm', 'r') as f:
+            return int(f.read().split()[1]) * os.sysconf('SC_PAGE_SIZE')
+    except (OSError, ValueError, IndexError):
+        pass
+    if resource is None:
+        return None
+    # kilobytes on linux, bytes on macOS
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+
+def open_fds() -> Optional[int]:
+    try:
+        return len(os.listdir('/proc/self/fd'))
+    except OSError:
+        return None
+
+
+class MemoryProfiler(object):
+    """
+    Memory diagnostics of the daemon.
+
+    RSS and open file descriptors are sampled every gauge_interval seconds.
+    With tracing on, every allocation is traced by tracemalloc keeping frames
+    frames of it, so top allocation sites can be looked at, and peak allocation
+    is measured for sample_rate of requests.
+
+    Tracing makes every allocation slower, keep it on for one canary node
+    rather than for the whole fleet
+    """
+
+    # gauge samples kept for the admin endpoint
+    HISTORY = 360
+
+    def __init__(self, tracing: bool = MEMORY_TRACING, frames: int = MEMORY_TRACE_FRAMES,
+                 sample_rate: float = MEMORY_SAMPLE_RATE, gauge_interval: float = MEMORY_GAUGE_INTERVAL):
+        self.tracing = tracing
+        self.frames = frames
+        self.sample_rate = sample_rate
+        self.gauge_interval = gauge_interval
+        self.task: Optional[PeriodicTask] = None
+        self.history: Deque[Dict[str, Any]] = collections.deque(maxlen=self.HISTORY)
+        self._baseline: Optional[tracemalloc.Snapshot] = None
+        # tracemalloc has a single peak for the process, so one request is measured at a time
+        self._measuring = threading.Lock()
+
+    def start(self) -> None:
+        if self.task is not None:
+            return
+        if self.tracing and not tracemalloc.is_tracing():
+            tracemalloc.start(self.frames)
+        self.sample()
+        self.task = PeriodicTask('memory-gauges', self.gauge_interval, self.sample)
+        self.task.start()
+        metrics.register('memory', self.samples)
+
+    def stop(self) -> None:
+        if self.task is not None:
+            self.task.stop()
+            self.task = None
+        if self.tracing and tracemalloc.is_tracing():
+            tracemalloc.stop()
+        self._baseline = None
+
+    def sample(self) -> Dict[str, Any]:
+        current = {"time": time.time(), "rss_bytes": rss_bytes(), "open_fds": open_fds()}
+        if tracemalloc.is_tracing():
+            current["traced_bytes"] = tracemalloc.get_traced_memory()[0]
+        self.history.append(current)
+        return current
+
+    def samples(self) -> Iterator[Tuple[str, dict, float]]:
+        if not self.history:
+            return
+        last = self.history[-1]
+        for name in ('rss_bytes', 'open_fds', 'traced_bytes'):
+            if last.get(name) is not None:
+                yield f'process_{name}', {}, last[name]
+
+    def begin(self) -> Optional[int]:
+        """
+        Start measuring the peak allocation of a request if it's sampled
+
+        Returns:
+            Optional[int]: bytes traced when it started, None if it isn't measured
+        """
+
+        if not tracemalloc.is_tracing() or random.random() >= self.sample_rate:
+            return None
+        if not self._measuring.acquire(blocking=False):
+            return None
+        # python 3.8 can't reset the peak, the current bytes are measured at the end
+        if hasattr(tracemalloc, 'reset_peak'):
+            tracemalloc.reset_peak()
+        return tracemalloc.get_traced_memory()[0]
+
+    def end(self, started: int, route: str) -> int:
+        """
+        Finish a measurement started with begin() and count it in metrics.
+        Allocations of requests sent at the same time are counted too,
+        so the peak is an upper bound
+
+        Returns:
+            int: bytes allocated at the peak of the request
+        """
+
+        try:
+            current, peak = tracemalloc.get_traced_memory() if tracemalloc.is_tracing() else (started, started)
+            peak = max((peak if hasattr(tracemalloc, 'reset_peak') else current) - started, 0)
+            metrics.inc('request_alloc_samples', route=route)
+            metrics.inc('request_alloc_peak_bytes_sum', peak, route=route)
+            if peak > metrics.get('request_alloc_peak_bytes_max', route=route):
+                metrics.set('request_alloc_peak_bytes_max', peak, route=route)
+            return peak
+        finally:
+            self._measuring.release()
+
+    def top(self, limit: int = 20, group: str = 'lineno', compare: bool = False) -> List[Dict[str, Any]]:
+        """
+        Allocation sites holding most of the traced memory
+
+        Args:
+            limit: number of sites
+            group: 'lineno', 'filename' or 'traceback'
+            compare: sites that grew most since the previous compared call instead
+
+        Raises:
+            ValueError: If group is unknown
+        """
+
+        if group not in ('lineno', 'filename', 'traceback'):
+            raise ValueError(f"Unknown group '{group}'")
+        if not tracemalloc.is_tracing():
+            return []
+
+        snapshot = tracemalloc.take_snapshot().filter_traces(IGNORED_FRAMES)
+        if compare:
+            baseline, self._baseline = self._baseline, snapshot
+            if baseline is None:
+                return []
+            statistics = snapshot.compare_to(baseline, group)
+        else:
+            statistics = snapshot.statistics(group)
+
+        sites: List[Dict[str, Any]] = []
+        for stat in statistics[:limit]:
+            site = {"site": [f'{frame.filename}:{frame.lineno}' for frame in stat.traceback],
+                    "size": stat.size, "count": stat.count}
+            if compare:
+                site.update(size_diff=stat.size_diff, count_diff=stat.count_diff)
+            sites.append(site)
+        return sites
+
+    @property
+    def status(self) -> Dict[str, Any]:
+        status: Dict[str, Any] = {"tracing": tracemalloc.is_tracing(), "frames": tracemalloc.get_traceback_limit(),
+                                  "sample_rate": self.sample_rate, "history": list(self.history)}
+        status.update(self.history[-1] if self.history else self.sample())
+        if status["tracing"]:
+            status["traced_bytes"], status["traced_peak_bytes"] = tracemalloc.get_traced_memory()
+        return status
+
+
+profiler = MemoryProfiler()
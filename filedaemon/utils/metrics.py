@@ -0,0 +1,75 @@
+import threading
+
+from typing import Any, Callable, Dict, Iterable, List, Tuple
+
+
+Labels = Tuple[Tuple[str, str], ...]
+Sample = Tuple[str, Dict[str, Any], float]
+
+
+class Metrics(object):
+    """
+    Process-wide registry of counters and gauges.
+    Every series is identified by its name and labels
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._counters: Dict[Tuple[str, Labels], float] = {}
+        self._gauges: Dict[Tuple[str, Labels], float] = {}
+        self._callbacks: Dict[str, Callable[[], Iterable[Sample]]] = {}
+
+    @staticmethod
+    def _key(name: str, labels: Dict[str, Any]) -> Tuple[str, Labels]:
+        return name, tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+    def inc(self, name: str, amount: float = 1, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + amount
+
+    def set(self, name: str, value: float, **labels: Any) -> None:
+        key = self._key(name, labels)
+        with self._lock:
+            self._gauges[key] = value
+
+    def register(self, name: str, callback: Callable[[], Iterable[Sample]]) -> None:
+        """
+        Register a callback that's called on every snapshot
+        and yields (gauge name, labels, value) samples
+        """
+
+        with self._lock:
+            self._callbacks[name] = callback
+
+    def forget(self, **labels: Any) -> None:
+        """
+        Drop every series that has all of passed labels
+        """
+
+        match = set(self._key('', labels)[1])
+        with self._lock:
+            for series in (self._counters, self._gauges):
+                for key in [k for k in series if match <= set(k[1])]:
+                    del series[key]
+
+    def get(self, name: str, **labels: Any) -> float:
+        key = self._key(name, labels)
+        with self._lock:
+            return self._counters.get(key, self._gauges.get(key, 0))
+
+    def snapshot(self) -> Dict[str, List[Dict[str, Any]]]:
+        with self._lock:
+            series = list(self._counters.items()) + list(self._gauges.items())
+            callbacks = list(self._callbacks.values())
+
+        result: Dict[str, List[Dict[str, Any]]] = {}
+        for (name, labels), value in series:
+            result.setdefault(name, []).append({"labels": dict(labels), "value": value})
+        for callback in callbacks:
+            for name, labels, value in callback():
+                result.setdefault(name, []).append({"labels": labels, "value": value})
+        return result
+
+
+metrics = Metrics()
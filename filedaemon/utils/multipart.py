@@ -0,0 +1,43 @@
+import os
+import uuid
+
+from typing import BinaryIO, Optional
+
+
+class MultipartFile(object):
+    """
+    Read-only multipart/form-data body with a single file field.
+    The file is streamed, never loaded in memory
+    """
+
+    def __init__(self, fileobj: BinaryIO, filename: str, field: str = 'file', size: Optional[int] = None,
+                 boundary: Optional[str] = None):
+        self.boundary = boundary = boundary or uuid.uuid4().hex
+        self.content_type = f'multipart/form-data; boundary={boundary}'
+        self._prefix = (f'--{boundary}\r\n'
+                        f'Content-Disposition: form-data; name="{field}"; filename="{filename}"\r\n'
+                        'Content-Type: application/octet-stream\r\n\r\n').encode('utf-8')
+        self._suffix = f'\r\n--{boundary}--\r\n'.encode('utf-8')
+        self._file = fileobj
+        if size is None:
+            position = fileobj.tell()
+            size = fileobj.seek(0, os.SEEK_END) - position
+            fileobj.seek(position)
+        self.length = len(self._prefix) + size + len(self._suffix)
+
+    def read(self, size: int = -1) -> bytes:
+        if size is None or size < 0:
+            data, self._prefix = self._prefix + self._file.read() + self._suffix, b''
+            self._suffix = b''
+            return data
+
+        if self._prefix:
+            data, self._prefix = self._prefix[:size], self._prefix[size:]
+            return data
+
+        data = self._file.read(size)
+        if data:
+            return data
+
+        data, self._suffix = self._suffix[:size], self._suffix[size:]
+        return data
@@ -0,0 +1,54 @@
+import sys
+import time
+import threading
+
+from typing import Optional, TextIO
+
+
+def verbose_size(size: float) -> str:
+    for unit in ('B', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            return f'{size:.1f} {unit}'
+        size /= 1024
+    return f'{size:.1f} TB'
+
+
+class Progress(object):
+    """
+    Thread-safe progress of a long operation,
+    printed at most once per interval seconds
+    """
+
+    def __init__(self, label: str, total: Optional[int] = None, stream: Optional[TextIO] = sys.stderr,
+                 interval: float = 1.0):
+        self.label = label
+        self.total = total
+        self.stream = stream
+        self.interval = interval
+        self.count = 0
+        self.bytes = 0
+        self.started = time.monotonic()
+        self._printed = self.started
+        self._lock = threading.Lock()
+
+    @property
+    def elapsed(self) -> float:
+        return max(time.monotonic() - self.started, 1e-9)
+
+    def __str__(self) -> str:
+        total = f'/{self.total}' if self.total is not None else ''
+        return (f'{self.label} {self.count}{total} files, {verbose_size(self.bytes)} in {self.elapsed:.1f}s '
+                f'({self.count / self.elapsed:.0f} files/s, {verbose_size(self.bytes / self.elapsed)}/s)')
+
+    def update(self, count: int = 1, size: int = 0) -> None:
+        with self._lock:
+            self.count += count
+            self.bytes += size
+            now = time.monotonic()
+            if self.stream is not None and now - self._printed >= self.interval:
+                self._printed = now
+                print(self, file=self.stream, flush=True)
+
+    def done(self) -> None:
+        if self.stream is not None:
+            print(self, file=self.stream, flush=True)
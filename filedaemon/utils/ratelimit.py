@@ -0,0 +1,59 @@
+import time
+import threading
+
+from typing import Callable, Optional
+
+
+class TokenBucket(object):
+    """
+    Thread-safe token bucket.
+    Refills with rate tokens per second up to capacity
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None, clock: Callable[[], float] = time.monotonic):
+        self.rate = float(rate)
+        self.capacity = float(capacity or rate)
+        self.tokens = self.capacity
+        self._clock = clock
+        self._updated = clock()
+        self._lock = threading.Lock()
+
+    def _refill(self) -> None:
+        now = self._clock()
+        self.tokens = min(self.capacity, self.tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def try_consume(self, amount: float = 1) -> bool:
+        """
+        Take amount of tokens if there are enough of them
+        """
+
+        with self._lock:
+            self._refill()
+            if self.tokens < amount:
+                return False
+            self.tokens -= amount
+            return True
+
+    def consume(self, amount: float) -> float:
+        """
+        Take amount of tokens unconditionally.
+        The bucket may go into debt
+
+        Returns:
+            float: seconds the caller should wait to pay the debt off
+        """
+
+        with self._lock:
+            self._refill()
+            self.tokens -= amount
+            return max(0.0, -self.tokens / self.rate)
+
+    def retry_after(self, amount: float = 1) -> float:
+        """
+        Seconds until amount of tokens will be available
+        """
+
+        with self._lock:
+            self._refill()
+            return max(0.0, (amount - self.tokens) / self.rate)